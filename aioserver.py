@@ -0,0 +1,145 @@
+import asyncio
+import socket
+import threading
+from utils import FrameReader
+from outbound import OutboundQueue
+
+# Event-loop front end for ServerNode clients (server.py --io asyncio).
+# One loop thread owns every client socket instead of one thread per client.
+# Message handling itself is shared with the threaded path through
+# ServerNode._client_hello / _handle_client_msg / _drop_client, and outbound
+# traffic goes through the same bounded queue as outbound.ThreadedOutbound.
+
+READ_CHUNK = 65536
+
+class AsyncClient(OutboundQueue):
+    # bounded outbound queue drained by a writer task; send_frame/sendall are thread-safe
+    def __init__(self, loop, writer, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = loop
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self._loop_thread = threading.current_thread()
+        self._event = asyncio.Event()
+        self.task = loop.create_task(self._writer_task())
+
+    def _wakeup_locked(self):
+        if threading.current_thread() is self._loop_thread:
+            self._event.set()
+        else:
+            # broadcasts may come from replication or other worker threads
+            self.loop.call_soon_threadsafe(self._event.set)
+
+    async def _writer_task(self):
+        try:
+            while True:
+                await self._event.wait()
+                self._event.clear()
+                while True:
+                    with self._lock:
+                        if self.closed:
+                            return
+                        idle = not self._has_work_locked()
+                        closing = self._closing
+                    if idle:
+                        if closing:
+                            return
+                        break
+                    frames = self._next_frames()
+                    if not frames:
+                        continue
+                    self.writer.writelines(frames)
+                    self.sent += len(frames)
+                    frames = None  # don't pin the last frame (often a whole STATE) while idle
+                    # backpressure: a slow client fills its own queue, not the loop
+                    await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self._lock:
+                self.closed = True
+                self._q.clear()
+            self.writer.close()
+
+
+class AsyncClientFrontend:
+    def __init__(self, node, host, port, backlog=1024, accept_batch=64):
+        self.node = node
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.accept_batch = accept_batch  # max accepts per loop iteration
+        self.loop = None
+        self.sock = None
+        self.tasks = set()
+
+    def start(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.host, self.port))
+        s.listen(self.backlog)
+        s.setblocking(False)
+        self.sock = s
+        # selector loop on every platform: add_reader is not available on the windows proactor
+        self.loop = asyncio.SelectorEventLoop()
+        threading.Thread(target=self._run, daemon=True).start()
+        return s
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.add_reader(self.sock, self._accept_ready)
+        self.loop.run_forever()
+
+    def _accept_ready(self):
+        # accept at most accept_batch clients before letting existing clients run
+        for _ in range(self.accept_batch):
+            try:
+                conn, addr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # EMFILE/ENFILE etc: leave the rest in the kernel backlog for the next iteration
+                if not self.node.stop_event.is_set():
+                    self.node.log.warning(f"accept client error: {e}")
+                return
+            conn.setblocking(False)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            task = self.loop.create_task(self._serve(conn))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _serve(self, conn):
+        reader, writer = await asyncio.open_connection(sock=conn)
+        client = AsyncClient(self.loop, writer, **self.node._outbound_options())
+        frames = FrameReader()
+        name = None
+        try:
+            while True:
+                data = await reader.read(READ_CHUNK)
+                if not data:
+                    break
+                # one read may carry many frames (pipelined moves)
+                frames.feed(data)
+                for msg in frames.messages():
+                    if name is None:
+                        # first frame is the HELLO handshake
+                        name = self.node._client_hello(client, msg)
+                        if name is None:
+                            return
+                    else:
+                        self.node._handle_client_msg(client, name, msg)
+        except Exception as e:
+            self.node.log.debug("client handler error: %s", e)
+        finally:
+            self.node._drop_client(client)
+
+    def stop(self):
+        if self.loop is None:
+            return
+        def _shutdown():
+            self.loop.remove_reader(self.sock)
+            self.sock.close()
+            for task in list(self.tasks):
+                task.cancel()
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(_shutdown)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# Board generation time and move validation throughput at growing n.
+# Validation is compared against the old per-call rebuild of the shifted row.
+#
+#   python3 bench/bench_board.py [--sizes 3 9 64 256] [--checks 200000]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game import GameState
+
+
+def shifted_check(n, r, c, val):
+    # what is_correct_move used to do on every call
+    expected = list(range(1, n+1))
+    expected_row = expected[r:] + expected[:r]
+    return expected_row[c] == val
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[3, 9, 64, 256])
+    parser.add_argument('--checks', type=int, default=200000)
+    parser.add_argument('--boards', type=int, default=20, help='boards generated per size')
+    args = parser.parse_args()
+
+    print(f"{'n':>5} {'generate ms':>12} {'grid checks/s':>15} {'shifted checks/s':>17}")
+    for n in args.sizes:
+        t0 = time.perf_counter()
+        for _ in range(args.boards):
+            g = GameState(n=n, blanks=n)
+        gen_ms = (time.perf_counter() - t0) / args.boards * 1e3
+
+        moves = [(random.randrange(n), random.randrange(n), random.randint(1, n)) for _ in range(1000)]
+        moves = moves * (args.checks // len(moves))
+        check = g.is_correct_move
+        t0 = time.perf_counter()
+        for r, c, val in moves:
+            check(r, c, val)
+        grid_rate = len(moves) / (time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        for r, c, val in moves:
+            shifted_check(n, r, c, val)
+        shifted_rate = len(moves) / (time.perf_counter() - t0)
+        print(f"{n:>5} {gen_ms:>12.3f} {grid_rate:>15,.0f} {shifted_rate:>17,.0f}")
+
+
+if __name__ == '__main__':
+    main()
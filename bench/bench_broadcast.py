@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Micro-benchmark: per-recipient send_msg vs encoding once and queueing the frame on
+# every client's outbound queue, as the server's broadcast does. Sockets are replaced by
+# a sink that only counts bytes, and the queues have no writer (they are emptied between
+# runs), so the numbers isolate serialization/fan-out cost from kernel send cost.
+#
+#   python3 bench/bench_broadcast.py [--recipients 100 1000 10000] [--repeat 5]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from outbound import OutboundQueue
+from utils import send_msg, encode_msg
+
+
+class NullSock:
+    def __init__(self):
+        self.nbytes = 0
+
+    def sendall(self, data):
+        self.nbytes += len(data)
+
+
+class QueueSink(OutboundQueue):
+    # an outbound queue without a writer: broadcasts only enqueue
+    def __init__(self):
+        super().__init__(maxlen=1 << 30)
+
+    def _wakeup_locked(self):
+        pass
+
+
+def sample_messages():
+    delta = {'type':'MOVE_DELTA','r':4,'c':7,'val':3,'player':'alice','score_delta':5,'version':1234}
+    n = 9
+    board = [[(r + c) % n + 1 for c in range(n)] for r in range(n)]
+    state = {'type':'STATE','state':{'n':n,'board':board,
+             'scores':{'player%d' % i: i for i in range(50)},'round':1,'version':1234}}
+    return [('MOVE_DELTA', delta), ('STATE 9x9', state)]
+
+
+def time_per_recipient(socks, msg, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for s in socks:
+            send_msg(s, msg)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def time_encode_once(conns, msg, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        frame = encode_msg(msg)
+        for conn in conns:
+            conn.send_frame(frame, droppable=True)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+        for conn in conns:
+            conn._q.clear()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recipients', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'message':<12} {'recipients':>10} {'send_msg ms':>12} {'encode-once ms':>15} {'speedup':>8}")
+    for label, msg in sample_messages():
+        for n in args.recipients:
+            slow = time_per_recipient([NullSock() for _ in range(n)], msg, args.repeat)
+            fast = time_encode_once([QueueSink() for _ in range(n)], msg, args.repeat)
+            print(f"{label:<12} {n:>10} {slow*1000:>12.3f} {fast*1000:>15.3f} {slow/fast:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Encode/decode cost and bytes on the wire per message type, JSON vs binary codec.
+#
+#   python3 bench/bench_codec.py [--iterations 20000] [--board 3 9 64]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codec import JSON, BINARY, decode
+
+
+def sample_messages(boards):
+    msgs = [
+        ('MOVE', {'type':'MOVE','r':4,'c':7,'val':3}),
+        ('MOVE_ACK', {'type':'MOVE_ACK','result':'fail','reason':'incorrect','version':1234}),
+        ('HEARTBEAT', {'type':'HEARTBEAT','node_id':3,'tcp_port':9003,'replication_port':9103}),
+        ('MOVE_DELTA', {'type':'MOVE_DELTA','r':4,'c':7,'val':3,'player':'alice',
+                        'score_delta':5,'version':1234}),
+    ]
+    for n in boards:
+        board = [[(r + c) % n + 1 for c in range(n)] for r in range(n)]
+        state = {'n':n,'board':board,'scores':{'player%d' % i: i for i in range(20)},
+                 'round':1,'version':1234}
+        msgs.append((f'STATE {n}x{n}', {'type':'STATE','state':state}))
+    return msgs
+
+
+def per_call_us(fn, arg, iterations):
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return (time.perf_counter() - t0) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--board', type=int, nargs='+', default=[3, 9, 64])
+    args = parser.parse_args()
+
+    print(f"{'message':<14} {'codec':<5} {'bytes':>8} {'encode us':>10} {'decode us':>10}")
+    for label, msg in sample_messages(args.board):
+        # big boards are slow in both codecs; scale iterations so each row takes similar time
+        n = msg.get('state', {}).get('n', 1)
+        iterations = max(20, args.iterations // (n * n))
+        for codec in (JSON, BINARY):
+            data = codec.encode(msg)
+            enc = per_call_us(codec.encode, msg, iterations)
+            dec = per_call_us(decode, data, iterations)
+            print(f"{label:<14} {codec.name:<5} {len(data):>8} {enc:>10.2f} {dec:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Failover time: start a local cluster, SIGKILL the primary and time until a surviving
+# node acks a MOVE again. Each trial uses a fresh cluster. Needs multicast on this host,
+# and no other servers on the same multicast group while it runs.
+#
+#   python3 bench/bench_failover.py [--nodes 3] [--trials 5] [--heartbeat-ms 100] [--phi-threshold 8]
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from utils import FrameReader, send_msg
+
+
+def start_node(nid, args):
+    cmd = [sys.executable, '-u', os.path.join(ROOT, 'server.py'), '--id', str(nid),
+           '--tcp-port', str(args.base_port + nid), '--replication-port', str(args.base_port + 100 + nid),
+           '--heartbeat-ms', str(args.heartbeat_ms), '--phi-threshold', str(args.phi_threshold)]
+    log = open(os.devnull, 'w') if not args.log else open(f"{args.log}.{nid}", 'a')
+    return subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+
+def try_move(port, timeout):
+    # -> True once the node at port is primary and acks a move
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    except OSError:
+        return False
+    try:
+        sock.settimeout(timeout)
+        reader = FrameReader(sock)
+        send_msg(sock, {'type':'HELLO','name':'bench'})
+        first = reader.recv()
+        if not first or first.get('type') != 'STATE' or first.get('note') != 'primary':
+            return False
+        state = first['state']
+        n = state['n']
+        r, c = [(r, c) for r in range(n) for c in range(n) if state['board'][r][c] == 0][0]
+        send_msg(sock, {'type':'MOVE','r':r,'c':c,'val':n + 1})
+        while True:
+            msg = reader.recv()
+            if not msg or msg.get('type') == 'ERROR':
+                return False
+            if msg.get('type') == 'MOVE_ACK':
+                return True
+    except (OSError, ValueError):
+        return False
+    finally:
+        sock.close()
+
+
+def find_primary(ports, deadline, timeout=0.2):
+    while time.time() < deadline:
+        for nid, port in ports.items():
+            if try_move(port, timeout):
+                return nid
+        time.sleep(0.01)
+    return None
+
+
+def trial(args):
+    procs = {nid: start_node(nid, args) for nid in range(1, args.nodes + 1)}
+    ports = {nid: args.base_port + nid for nid in procs}
+    try:
+        primary = find_primary(ports, time.time() + args.settle)
+        if primary is None:
+            return None
+        time.sleep(args.warmup)  # let the detectors learn the heartbeat rhythm
+        procs[primary].kill()
+        t0 = time.time()
+        del ports[primary]
+        if find_primary(ports, t0 + args.max_wait) is None:
+            return None
+        return (time.time() - t0) * 1000
+    finally:
+        for p in procs.values():
+            p.kill()
+            p.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--heartbeat-ms', type=float, default=100)
+    parser.add_argument('--phi-threshold', type=float, default=8.0)
+    parser.add_argument('--base-port', type=int, default=9700)
+    parser.add_argument('--settle', type=float, default=10.0, help='max seconds for the first primary')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds of steady heartbeats before the kill')
+    parser.add_argument('--max-wait', type=float, default=30.0, help='give up on a trial after this many seconds')
+    parser.add_argument('--log', default=None, help='append server output to LOG.<id>')
+    args = parser.parse_args()
+
+    times = []
+    for i in range(args.trials):
+        ms = trial(args)
+        print(f"trial {i + 1}: " + (f"{ms:.0f} ms" if ms is not None else "no failover"))
+        if ms is not None:
+            times.append(ms)
+    if times:
+        times.sort()
+        print(f"failover ms: min {times[0]:.0f}  median {times[len(times) // 2]:.0f}  max {times[-1]:.0f}")
+
+
+if __name__ == '__main__':
+    main()
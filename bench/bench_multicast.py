@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Control-plane packet rate vs cluster size: in-process ring-mode nodes heartbeat on the
+# multicast group while a listener counts datagrams, messages and bytes per second.
+# "single" sends every control message in its own datagram; "batched" packs each
+# node's heartbeat, primary announce and room ownership into one.
+# A second table compares the cost of a send with a socket per message (the old
+# send_multicast_message, kept here as the baseline) against the node's long-lived MulticastPublisher.
+#
+#   python3 bench/bench_multicast.py [--nodes 2 4 8 16] [--rooms 1000] [--seconds 3]
+import argparse
+import contextlib
+import io
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import ServerNode
+from codec import JSON
+from utils import create_multicast_socket, decode_msg, MulticastPublisher, MCAST_ADDR
+
+
+def send_multicast_message(msg):
+    # the old sender: a fresh socket for every message
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    s.sendto(JSON.encode(msg), MCAST_ADDR)
+    s.close()
+
+
+def count_packets(sock, stop, totals):
+    sock.settimeout(0.2)
+    while not stop.is_set():
+        try:
+            data, _ = sock.recvfrom(65536)
+        except OSError:
+            continue
+        msg = decode_msg(data)
+        totals[0] += 1
+        totals[1] += len(msg['msgs']) if msg.get('type') == 'BATCH' else 1
+        totals[2] += len(data)
+
+
+def run(count, batch, args, port):
+    nodes = [ServerNode(i + 1, tcp_port=port + i, replication_port=port + 500 + i, sharding='ring',
+                        heartbeat_ms=args.heartbeat_ms) for i in range(count)]
+    for node in nodes:
+        node.publisher.batch = batch
+    starters = [threading.Thread(target=node.start) for node in nodes]
+    for t in starters:
+        t.start()
+    for t in starters:
+        t.join()
+    time.sleep(args.settle)
+    # each room lives on its ring owner, so every node announces its share
+    for i in range(args.rooms):
+        room_id = f"room{i}"
+        nodes[nodes[0].ring.owner(room_id) - 1].rooms.get(room_id)
+    time.sleep(nodes[0].heartbeat_interval * 2)
+
+    totals = [0, 0, 0]
+    sock = create_multicast_socket()
+    stop = threading.Event()
+    counter = threading.Thread(target=count_packets, args=(sock, stop, totals))
+    counter.start()
+    time.sleep(args.seconds)
+    stop.set()
+    counter.join()
+    sock.close()
+    for node in nodes:
+        node.stop()
+    return [x / args.seconds for x in totals]
+
+
+def send_cost(count):
+    msg = {'type':'HEARTBEAT','node_id':1,'tcp_port':9001,'replication_port':9101}
+    t0 = time.perf_counter()
+    for _ in range(count):
+        send_multicast_message(msg)
+    per_call = (time.perf_counter() - t0) / count
+    publisher = MulticastPublisher()
+    t0 = time.perf_counter()
+    for _ in range(count):
+        publisher.send(msg)
+    shared = (time.perf_counter() - t0) / count
+    publisher.close()
+    return per_call * 1e6, shared * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, nargs='+', default=[2, 4, 8, 16])
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--heartbeat-ms', type=float, default=100)
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds for the ring to form')
+    parser.add_argument('--sends', type=int, default=5000, help='messages for the send-cost comparison')
+    parser.add_argument('--base-port', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'nodes':>5} {'mode':<8} {'packets/s':>10} {'msgs/s':>8} {'KiB/s':>7}")
+    port = args.base_port
+    for count in args.nodes:
+        for batch in (False, True):
+            with contextlib.redirect_stdout(io.StringIO()):  # the nodes' own logging
+                packets, msgs, nbytes = run(count, batch, args, port)
+            port += 1000
+            print(f"{count:>5} {'batched' if batch else 'single':<8} {packets:>10,.0f} {msgs:>8,.0f} {nbytes / 1024:>7.1f}")
+
+    per_call, shared = send_cost(args.sends)
+    print()
+    print(f"{'socket per send us':>19} {'publisher us':>13}")
+    print(f"{per_call:>19.1f} {shared:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
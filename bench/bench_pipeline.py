@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Per-move fan-out vs the batched move pipeline at several --tick-ms settings.
+# Movers and spectators are socketpairs served by a ServerNode's own client handlers,
+# so every run pays for the real apply, ack, broadcast and outbound queues.
+#
+#   python3 bench/bench_pipeline.py [--movers 16] [--spectators 64] [--seconds 3] [--ticks 0 1 5 20]
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import ServerNode
+from utils import FrameReader, send_msg
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def connect(node, name):
+    ours, theirs = socket.socketpair()
+    threading.Thread(target=node._handle_client, args=(theirs,), daemon=True).start()
+    send_msg(ours, {'type':'HELLO','name':name})
+    reader = FrameReader(ours)
+    state = reader.recv()['state']
+    return ours, reader, state
+
+
+def run(tick_ms, per_move, args):
+    node = ServerNode(1, tick_ms=tick_ms, board_size=args.board_size, blanks=args.board_size)
+    node.is_primary = True
+    if per_move:
+        # baseline: every move applied, acked and broadcast on its own
+        apply = node.pipeline.apply
+        node.pipeline.apply = lambda room, batch: [apply(room, [move]) for move in batch]
+    stop = threading.Event()
+    received = [0] * args.spectators
+
+    def spectate(i):
+        sock, reader, _ = connect(node, f"spectator{i}")
+        while True:
+            msg = reader.recv()
+            if not msg:
+                return
+            received[i] += 1
+
+    latencies = [[] for _ in range(args.movers)]
+
+    def move(i):
+        sock, reader, state = connect(node, f"mover{i}")
+        n = state['n']
+        r, c = [(r, c) for r in range(n) for c in range(n) if state['board'][r][c] == 0][0]
+        lat = latencies[i]
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            send_msg(sock, {'type':'MOVE','r':r,'c':c,'val':n + 1})  # always incorrect: a version bump
+            while reader.recv()['type'] != 'MOVE_ACK':
+                pass
+            lat.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=spectate, args=(i,), daemon=True) for i in range(args.spectators)]
+    for t in threads:
+        t.start()
+    time.sleep(0.2)
+    movers = [threading.Thread(target=move, args=(i,), daemon=True) for i in range(args.movers)]
+    t0 = time.perf_counter()
+    for t in movers:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in movers:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    time.sleep(0.2)
+    all_lat = [x for lat in latencies for x in lat]
+    stats = node.pipeline.stats()
+    sent = sum(conn.sent for conn in list(node.clients))
+    node.stop()
+    return (len(all_lat) / elapsed, percentile(all_lat, 0.5) * 1e3, percentile(all_lat, 0.99) * 1e3,
+            1.0 if per_move else stats['avg_batch'], sent / max(1, len(all_lat)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--movers', type=int, default=16)
+    parser.add_argument('--spectators', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--ticks', type=int, nargs='+', default=[0, 1, 5, 20])
+    parser.add_argument('--board-size', type=int, default=9)
+    args = parser.parse_args()
+
+    print(f"{'mode':<12} {'moves/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'avg batch':>10} {'frames/move':>12}")
+    rows = [('per-move', 0, True)] + [(f"tick {t}ms", t, False) for t in args.ticks]
+    for label, tick_ms, per_move in rows:
+        rate, p50, p99, batch, frames = run(tick_ms, per_move, args)
+        print(f"{label:<12} {rate:>9,.0f} {p50:>8.2f} {p99:>8.2f} {batch:>10.1f} {frames:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
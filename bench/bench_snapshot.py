@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Read/write contention on one room: writer threads apply moves while 10 to 1000 reader
+# threads each fetch the room's STATE frame every --poll-ms, the way a spectator polling
+# GET_STATE does (Room.state_frame). "locked" makes every read take the game lock first,
+# as reads of a changing room did before GameState published snapshots. "published" is
+# the lock-free read of the current Snapshot.
+#
+#   python3 bench/bench_snapshot.py [--readers 10 100 1000] [--writers 4] [--poll-ms 5] [--seconds 2]
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codec import JSON
+from game import GameState
+from rooms import Room
+
+
+class LockedGame(GameState):
+    __slots__ = ()
+
+    def snapshot(self):
+        with self._lock:
+            return self._published
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def run(locked, readers, args):
+    room = Room('bench', n=args.board_size, blanks=args.board_size * args.board_size // 2)
+    if locked:
+        game = room.game
+        room.game = LockedGame.__new__(LockedGame)
+        for slot in GameState.__slots__:
+            setattr(room.game, slot, getattr(game, slot))
+    game = room.game
+    n = game.n
+    blanks = [divmod(i, n) for i in range(n * n) if game.board[i] == 0]
+    go = threading.Event()
+    stop = threading.Event()
+    moves = [0] * args.writers
+    reads = [0] * readers
+    read_lat = [[] for _ in range(readers)]
+    write_lat = [[] for _ in range(args.writers)]
+
+    def write(i):
+        k = i
+        lat = write_lat[i]
+        go.wait()
+        while not stop.is_set():
+            r, c = blanks[k % len(blanks)]
+            k += args.writers
+            t0 = time.perf_counter()
+            game.apply_moves([(f"w{i}", r, c, n + 1)])  # always incorrect: a version bump, board unchanged
+            lat.append(time.perf_counter() - t0)
+            moves[i] += 1
+
+    def read(i):
+        lat = read_lat[i]
+        poll = args.poll_ms / 1000.0
+        go.wait()
+        time.sleep(poll * i / readers)  # spread the polls
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            room.state_frame(JSON)
+            lat.append(time.perf_counter() - t0)
+            reads[i] += 1
+            time.sleep(poll)
+
+    threads = [threading.Thread(target=read, args=(i,), daemon=True) for i in range(readers)]
+    threads += [threading.Thread(target=write, args=(i,), daemon=True) for i in range(args.writers)]
+    for t in threads:
+        t.start()
+    t0 = time.perf_counter()
+    go.set()
+    time.sleep(args.seconds)
+    stop.set()
+    elapsed = time.perf_counter() - t0
+    done_moves, done_reads = sum(moves), sum(reads)
+    for t in threads:
+        t.join()
+    rl = [x for lat in read_lat for x in lat]
+    wl = [x for lat in write_lat for x in lat]
+    return (done_moves / elapsed, percentile(wl, 0.99) * 1e6,
+            done_reads / elapsed, percentile(rl, 0.5) * 1e6, percentile(rl, 0.99) * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--poll-ms', type=float, default=5.0, help='pause between reads, per reader')
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--board-size', type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"{'readers':>7} {'mode':<10} {'moves/s':>9} {'write p99 us':>13} {'reads/s':>9} {'read p50 us':>12} {'read p99 us':>12}")
+    for readers in args.readers:
+        for locked in (True, False):
+            rate, wp99, rrate, rp50, rp99 = run(locked, readers, args)
+            print(f"{readers:>7} {'locked' if locked else 'published':<10} {rate:>9,.0f} {wp99:>13,.0f} "
+                  f"{rrate:>9,.0f} {rp50:>12,.1f} {rp99:>12,.0f}")
+
+
+if __name__ == '__main__':
+    main()
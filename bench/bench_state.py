@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Memory per room and snapshot (as_dict) latency at growing n.
+# The "lists" column is the old representation: a list of lists copied with deepcopy per call.
+#
+#   python3 bench/bench_state.py [--sizes 3 9 64 256] [--iterations 2000]
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from game import GameState
+
+
+def measure_bytes(build, count):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    keep = [build() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del keep
+    return (after - before) / count
+
+
+def per_call_us(fn, iterations):
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - t0) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[3, 9, 64, 256])
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'n':>5} {'board B':>10} {'lists B':>10} {'room B':>10} "
+          f"{'cached us':>10} {'rebuild us':>11} {'deepcopy us':>12}")
+    for n in args.sizes:
+        rooms = max(1, 2000 // (n * n))
+        g = GameState(n=n, blanks=n)
+        board_b = measure_bytes(lambda: g.board.__copy__(), rooms)
+        lists = [g.board[i:i+n].tolist() for i in range(0, n*n, n)]
+        lists_b = measure_bytes(lambda: deepcopy(lists), rooms)
+        room_b = measure_bytes(lambda: GameState(n=n, blanks=n), rooms)
+
+        iterations = max(20, args.iterations // n)
+        g.as_dict()
+        cached = per_call_us(g.as_dict, iterations)
+
+        def rebuild():
+            g._publish()  # what every move batch does
+            g.as_dict()
+        rebuilt = per_call_us(rebuild, iterations)
+        copied = per_call_us(lambda: deepcopy(lists), iterations)
+        print(f"{n:>5} {board_b:>10,.0f} {lists_b:>10,.0f} {room_b:>10,.0f} "
+              f"{cached:>10.2f} {rebuilt:>11.2f} {copied:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# Durable move throughput at several group-commit intervals, and recovery time vs log length.
+#
+# --movers threads each log a move, wait until the log calls it durable (fsynced, or written
+# for --fsync-ms -1) and only then log the next one, as a client waiting for its MOVE_ACK
+# does. moves/s is durable moves per second; ack ms is the wait per move.
+#
+#   python3 bench/bench_wal.py [--moves 5000] [--movers 16] [--fsync-ms 0 1 5 20 -1] [--recover 1000 10000 100000]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rooms import Room
+from wal import WriteAheadLog, replay
+
+
+def log_moves(wal, room, count):
+    # incorrect guesses on one blank: every one is a logged version bump
+    game = room.game
+    blank = game.board.index(0)
+    r, c = divmod(blank, game.n)
+    for _ in range(count):
+        ok, reason, delta = game.apply_move('bench', r, c, 0)
+        wal.append(room, delta)
+
+
+def durable_moves(wal, room, count, movers):
+    # -> sorted ack waits in seconds; each mover has one move in flight at a time
+    game = room.game
+    blank = game.board.index(0)
+    r, c = divmod(blank, game.n)
+    order = threading.Lock()  # apply + append in version order, as the room's pipeline does
+    waits = []
+
+    def mover(moves):
+        done = threading.Event()
+        for _ in range(moves):
+            done.clear()
+            t0 = time.perf_counter()
+            with order:
+                ok, reason, delta = game.apply_move('bench', r, c, 0)
+                wal.append(room, delta, done.set)
+            done.wait()
+            waits.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=mover, args=(count // movers,)) for _ in range(movers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(waits)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--moves', type=int, default=5000)
+    parser.add_argument('--movers', type=int, default=16, help='concurrent movers, one move in flight each')
+    parser.add_argument('--fsync-ms', type=int, nargs='+', default=[0, 1, 5, 20, -1])
+    parser.add_argument('--recover', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='log lengths (moves since the last snapshot) to recover')
+    parser.add_argument('--dir', default=None, help='where to write (default: a temp dir)')
+    args = parser.parse_args()
+
+    print(f"{'fsync ms':>9} {'moves/s':>10} {'ack ms p50':>11} {'ack ms p99':>11} {'fsyncs':>8}")
+    for fsync_ms in args.fsync_ms:
+        path = tempfile.mkdtemp(dir=args.dir)
+        try:
+            wal = WriteAheadLog(path, fsync_ms=fsync_ms, snapshot_every=10**9)
+            room = Room('bench', n=9, blanks=9)
+            wal.attach(room)
+            t0 = time.perf_counter()
+            waits = durable_moves(wal, room, args.moves, args.movers)
+            rate = len(waits) / (time.perf_counter() - t0)
+            wal.close()
+            p50 = waits[len(waits) // 2] * 1e3
+            p99 = waits[int(len(waits) * 0.99)] * 1e3
+            print(f"{fsync_ms:>9} {rate:>10,.0f} {p50:>11.2f} {p99:>11.2f} {wal.fsyncs:>8}")
+        finally:
+            shutil.rmtree(path)
+
+    print()
+    print(f"{'log moves':>10} {'log KiB':>8} {'recover ms':>11}")
+    for count in args.recover:
+        path = tempfile.mkdtemp(dir=args.dir)
+        try:
+            wal = WriteAheadLog(path, fsync_ms=-1, snapshot_every=10**9)
+            room = Room('bench', n=9, blanks=9)
+            wal.attach(room)
+            log_moves(wal, room, count)
+            wal.close()
+            size = os.path.getsize(os.path.join(path, 'bench', 'log'))
+            t0 = time.perf_counter()
+            recovered = WriteAheadLog(path, fsync_ms=-1)
+            for room_id, state, perm, deltas in recovered.recover():
+                replay(Room(room_id, n=9, blanks=9).game, state, perm, deltas)
+            ms = (time.perf_counter() - t0) * 1e3
+            print(f"{count:>10} {size / 1024:>8,.0f} {ms:>11.1f}")
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Moves/s vs --workers: one node at each setting, saturated by bench/loadgen.py bots that
+# send their next MOVE as soon as the last one is acked. Rooms spread over the workers,
+# so throughput should grow with the worker count until the box runs out of cores.
+# Give it cores for the workers and for the load generator's --procs.
+#
+#   python3 bench/bench_workers.py [--workers 0 1 2 4] [--bots 256] [--rooms 64] [--seconds 10]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(workers, args):
+    port = args.base_port
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), '--id', '1',
+                               '--tcp-port', str(port), '--replication-port', str(port + 100),
+                               '--workers', str(workers), '--codec', args.codec,
+                               '--board-size', str(args.board_size), '--blanks', str(args.blanks),
+                               '--log-level', 'warning'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    out = tempfile.NamedTemporaryFile(suffix='.json', delete=False).name
+    try:
+        time.sleep(2.0)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'bench', 'loadgen.py'),
+                        '--connect', f"127.0.0.1:{port}", '--bots', str(args.bots), '--rooms', str(args.rooms),
+                        '--rate', '100000', '--seconds', str(args.seconds), '--procs', str(args.procs),
+                        '--codec', args.codec, '--json', out], check=True, stdout=subprocess.DEVNULL)
+        with open(out) as fh:
+            return json.load(fh)
+    finally:
+        server.kill()
+        server.wait()
+        os.unlink(out)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--bots', type=int, default=256)
+    parser.add_argument('--rooms', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--procs', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='load generator processes')
+    parser.add_argument('--codec', default='bin')
+    parser.add_argument('--board-size', type=int, default=64)
+    parser.add_argument('--blanks', type=int, default=2048)
+    parser.add_argument('--base-port', type=int, default=9600)
+    args = parser.parse_args()
+
+    print(f"{'workers':>7} {'moves/s':>9} {'speedup':>8} {'ack p50 ms':>11} {'ack p99 ms':>11}")
+    base = None
+    for workers in args.workers:
+        result = run(workers, args)
+        rate = result['moves_per_s']
+        base = base or rate
+        print(f"{workers:>7} {rate:>9,.0f} {rate / base:>7.2f}x {result['ack_ms']['p50']:>11.2f} "
+              f"{result['ack_ms']['p99']:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
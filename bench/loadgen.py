@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# Headless load generator speaking the client protocol (HELLO / MOVE / GET_STATE over
+# utils framing). Thousands of asyncio bots spread over rooms each send a MOVE every
+# 1/--rate seconds and wait for its MOVE_ACK. --correct is the share of moves that try
+# to be right: a blank cell whose row and column leave one value, or the best guess
+# when none does. The rest are values already in the cell's row, so always wrong.
+#
+# Reports moves/s, MOVE_ACK latency (send to ack, at the mover) and broadcast latency
+# (send to the MOVE_DELTA arriving at --observers other bots in the room), plus ack
+# results (busy_<reason> for MOVEs and HELLOs the server's limits shed) and a
+# moves-per-second timeline. --json writes all of it for tracking runs.
+#
+# With no --connect it starts its own cluster of --nodes servers (--server-args are
+# passed through). --scenario failover SIGKILLs the node serving room0 --kill-at
+# seconds in; bots reconnect through the surviving nodes and the report adds the
+# time until the first ack after the kill and each disconnected bot's outage.
+# Bots are split over --procs processes so the generator is not the bottleneck.
+#
+# --spectators adds that many watch-only connections per room (HELLO role 'spectator').
+# Their broadcast latency is reported apart from the players', with how many each node
+# ended up serving: with backups up, the primary should hand all of them to relays.
+#
+#   python3 bench/loadgen.py [--bots 1000] [--rooms 50] [--rate 2] [--correct 0.5] [--seconds 30]
+#                            [--scenario steady|failover] [--kill-at 10] [--json results.json]
+#   python3 bench/loadgen.py --connect 127.0.0.1:9001 127.0.0.1:9002 --bots 200
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from utils import FrameReader, encode_msg, send_msg, raise_fd_limit
+from codec import CODECS, JSON
+from game import apply_delta_to_state
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def summary(values):
+    return {'count': len(values), 'p50': round(percentile(values, 0.5), 3),
+            'p90': round(percentile(values, 0.9), 3), 'p99': round(percentile(values, 0.99), 3),
+            'max': round(max(values), 3) if values else 0.0}
+
+
+class Run:
+    # what one worker process collects; merged by the parent
+    def __init__(self, args, addrs, start):
+        self.args = args
+        self.addrs = addrs
+        self.start = start
+        self.end = start + args.seconds
+        self.ack_ms = []
+        self.results = {}
+        self.timeline = [0] * (int(args.seconds) + 1)
+        self.sent = {}  # (room, version) -> monotonic send time of the move that made it
+        self.arrivals = []  # (room, version, monotonic arrival) seen by observers
+        self.outages = []  # (disconnected at, first ack after) per reconnect
+        self.connects = 0
+        self.watched = []  # (room, version, monotonic arrival) seen by spectators
+        self.watchers = {}  # port -> spectator connections it accepted
+
+    def count(self, key):
+        self.results[key] = self.results.get(key, 0) + 1
+
+
+class Bot:
+    def __init__(self, i, run):
+        args = run.args
+        self.run = run
+        self.name = f"bot{i}"
+        self.room = f"room{i % args.rooms}"
+        self.observer = i // args.rooms < args.observers
+        self.rng = random.Random(args.seed * 1000003 + i)
+        self.interval = 1.0 / args.rate
+        self.addr = None  # last server that served us, or where we were redirected
+        self.state = None
+        self.open = []  # cells blank when the last STATE arrived; filled ones are skipped lazily
+        self.ack = None
+        self.down_since = None
+        self.resyncing = False
+
+    async def main(self):
+        await asyncio.sleep(self.rng.random() * self.interval)  # spread the first moves
+        while time.monotonic() < self.run.end:
+            if not await self.connect():
+                return
+            self.run.connects += 1
+            self.reader_task = asyncio.ensure_future(self.read())
+            try:
+                await self.play()
+            except (OSError, ConnectionError, asyncio.TimeoutError):
+                if self.down_since is None:
+                    self.down_since = time.monotonic()
+            finally:
+                self.reader_task.cancel()
+                self.writer.close()
+
+    async def connect(self):
+        # HELLO to our last server first, then every known one, until one serves our room
+        delay = 0.02
+        while time.monotonic() < self.run.end:
+            for addr in ([self.addr] if self.addr else []) + self.run.addrs:
+                for _ in range(3):  # follow a couple of REDIRECTs
+                    result = await self.hello(addr)
+                    if result is True:
+                        self.addr = addr
+                        return True
+                    if not result:
+                        break
+                    addr = result
+            await asyncio.sleep(delay)
+            delay = min(self.run.args.retry_ms / 1000.0, delay * 2)
+        return False
+
+    async def hello(self, addr):
+        # True once served, a (host, port) to try on REDIRECT, None otherwise
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*addr), 1.0)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        frames = FrameReader(bufsize=4096)
+        writer.write(encode_msg({'type':'HELLO','name':self.name,'room':self.room,
+                                 'codecs':[self.run.args.codec,'json']}))
+        try:
+            first = None
+            while first is None:
+                data = await asyncio.wait_for(reader.read(65536), 2.0)
+                if not data:
+                    break
+                frames.feed(data)
+                msgs = frames.messages()
+                if msgs:
+                    first, rest = msgs[0], msgs[1:]
+        except (OSError, ValueError, asyncio.TimeoutError):
+            first = None
+        if first and first.get('type') == 'STATE' and first.get('note') == 'primary':
+            self.reader, self.writer, self.frames = reader, writer, frames
+            self.wire = CODECS.get(first.get('codec'), JSON)
+            self.set_state(first['state'])
+            for msg in rest:
+                self.handle(msg)
+            return True
+        writer.close()
+        if first and first.get('type') == 'REDIRECT':
+            return (first['host'], first['port'])
+        if first and first.get('error') == 'busy':
+            self.run.count(f"busy_{first.get('reason')}")
+        return None  # a backup with no primary yet, a full node, or the node went away
+
+    async def play(self):
+        run = self.run
+        loop = asyncio.get_event_loop()
+        next_at = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if next_at > now:
+                await asyncio.sleep(next_at - now)
+            if self.reader_task.done():
+                raise ConnectionError()
+            t0 = time.monotonic()
+            if t0 >= run.end:
+                return
+            next_at = max(next_at + self.interval, t0 - self.interval)  # late: skip, don't burst
+            r, c, val = self.pick()
+            self.ack = loop.create_future()
+            self.writer.write(encode_msg({'type':'MOVE','r':r,'c':c,'val':val}, self.wire))
+            try:
+                ack = await asyncio.wait_for(self.ack, run.args.ack_timeout)
+            except asyncio.TimeoutError:
+                run.count('timeout')
+                continue
+            now = time.monotonic()
+            if ack.get('type') == 'ERROR':
+                if ack.get('error') == 'busy':
+                    run.count(f"busy_{ack.get('reason')}")  # shed by the server's limits: keep going
+                    continue
+                run.count(ack.get('error', 'error'))
+                raise ConnectionError()  # e.g. not_primary: find the new one
+            run.ack_ms.append((now - t0) * 1000)
+            run.count(ack.get('reason', 'ok'))
+            if 'version' in ack:
+                run.sent[(self.room, ack['version'])] = t0
+            second = int(now - run.start)
+            if second < len(run.timeline):
+                run.timeline[second] += 1
+            if self.down_since is not None:
+                run.outages.append((self.down_since, now))
+                self.down_since = None
+
+    def pick(self):
+        # -> (r, c, val) following the --correct mix
+        state = self.state
+        n = state['n']
+        board = state['board']
+        cells = []
+        while self.open and len(cells) < 8:
+            k = self.rng.randrange(len(self.open))
+            r, c = self.open[k]
+            if board[r][c] != 0:
+                self.open[k] = self.open[-1]
+                self.open.pop()
+                continue
+            cells.append((r, c))
+        if not cells:
+            return 0, 0, 1  # board solved: cell_not_empty
+        if self.rng.random() >= self.run.args.correct:
+            r, c = cells[0]
+            taken = [v for v in board[r] if v] or [board[x][c] for x in range(n) if board[x][c]]
+            return r, c, self.rng.choice(taken) if taken else n + 1
+        best = None
+        for r, c in cells:
+            left = set(range(1, n + 1)).difference(board[r], (board[x][c] for x in range(n)))
+            if best is None or len(left) < len(best[2]):
+                best = (r, c, left)
+            if len(left) == 1:
+                break
+        r, c, left = best
+        return r, c, min(left) if left else n + 1
+
+    def set_state(self, state):
+        self.state = state
+        n = state['n']
+        self.open = [(r, c) for r in range(n) for c in range(n) if state['board'][r][c] == 0]
+        self.resyncing = False
+
+    async def read(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.frames.feed(data)
+                for msg in self.frames.messages():
+                    self.handle(msg)
+        except (OSError, ValueError):
+            pass
+        finally:
+            if self.ack is not None and not self.ack.done():
+                self.ack.set_exception(ConnectionError())
+
+    def handle(self, msg):
+        mtype = msg.get('type')
+        if mtype == 'MOVE_DELTA':
+            if self.observer and msg['player'] != self.name:
+                self.run.arrivals.append((self.room, msg['version'], time.monotonic()))
+            if self.resyncing:
+                return
+            if not apply_delta_to_state(self.state, msg):
+                self.resyncing = True
+                self.writer.write(encode_msg({'type':'GET_STATE'}, self.wire))
+        elif mtype == 'STATE':
+            if msg['state']['version'] >= self.state['version'] or self.resyncing:
+                self.set_state(msg['state'])
+        elif mtype in ('MOVE_ACK', 'ERROR'):
+            if self.ack is not None and not self.ack.done():
+                self.ack.set_result(msg)
+        elif mtype == 'REDIRECT':
+            # ring sharding moved our room: reconnect to its new owner
+            self.addr = (msg['host'], msg['port'])
+            self.writer.close()
+
+
+class Spectator:
+    # watch-only connection: follows REDIRECTs to a relay and times the MOVE_DELTAs it gets
+    def __init__(self, i, run):
+        self.run = run
+        self.name = f"spectator{i}"
+        self.room = f"room{i % run.args.rooms}"
+        k = i % len(run.addrs)
+        self.addrs = run.addrs[k:] + run.addrs[:k]  # start at different nodes, the primary included
+
+    async def main(self):
+        run = self.run
+        while time.monotonic() < run.end:
+            served = None
+            for addr in self.addrs:
+                for _ in range(3):  # follow a couple of REDIRECTs
+                    result = await self.hello(addr)
+                    if not result or len(result) == 4:
+                        break
+                    addr = result
+                if result and len(result) == 4:
+                    served = result
+                    break
+            if not served:
+                await asyncio.sleep(0.1)
+                continue
+            reader, writer, frames, port = served
+            run.watchers[port] = run.watchers.get(port, 0) + 1
+            try:
+                while time.monotonic() < run.end:
+                    data = await asyncio.wait_for(reader.read(65536), max(0.01, run.end - time.monotonic()))
+                    if not data:
+                        break
+                    frames.feed(data)
+                    now = time.monotonic()
+                    for msg in frames.messages():
+                        if msg.get('type') == 'MOVE_DELTA':
+                            run.watched.append((self.room, msg['version'], now))
+            except (OSError, ValueError, asyncio.TimeoutError):
+                pass
+            finally:
+                writer.close()
+
+    async def hello(self, addr):
+        # (reader, writer, frames, port) once served, a (host, port) REDIRECT target, or None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*addr), 1.0)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        frames = FrameReader(bufsize=4096)
+        writer.write(encode_msg({'type':'HELLO','name':self.name,'room':self.room,'role':'spectator',
+                                 'codecs':[self.run.args.codec,'json']}))
+        try:
+            first = None
+            while first is None:
+                data = await asyncio.wait_for(reader.read(65536), 2.0)
+                if not data:
+                    break
+                frames.feed(data)
+                msgs = frames.messages()
+                if msgs:
+                    first = msgs[0]
+        except (OSError, ValueError, asyncio.TimeoutError):
+            first = None
+        if first and first.get('type') == 'STATE':
+            return reader, writer, frames, addr[1]
+        writer.close()
+        if first and first.get('type') == 'REDIRECT':
+            return (first['host'], first['port'])
+        return None
+
+
+def worker(job):
+    args, addrs, start, part = job
+    run = Run(args, addrs, start)
+    bots = [Bot(i, run) for i in range(part, args.bots, args.procs)]
+    bots += [Spectator(i, run) for i in range(part, args.spectators * args.rooms, args.procs)]
+
+    async def main():
+        await asyncio.sleep(max(0.0, start - time.monotonic()))
+        await asyncio.gather(*(bot.main() for bot in bots))
+    asyncio.run(main())
+    return {k: v for k, v in vars(run).items() if k != 'args'}
+
+
+def serving_node(addrs, room, timeout=0.5):
+    # the address that serves `room` right now (follows one REDIRECT), or None
+    for addr in addrs:
+        for _ in range(2):
+            try:
+                sock = socket.create_connection(addr, timeout=timeout)
+            except OSError:
+                break
+            try:
+                sock.settimeout(timeout)
+                send_msg(sock, {'type':'HELLO','name':'loadgen','room':room})
+                first = FrameReader(sock).recv()
+            except (OSError, ValueError):
+                first = None
+            finally:
+                sock.close()
+            if not first:
+                break
+            if first.get('type') == 'STATE' and first.get('note') == 'primary':
+                return addr
+            if first.get('type') != 'REDIRECT':
+                break
+            addr = (first['host'], first['port'])
+    return None
+
+
+def start_cluster(args):
+    procs = {}
+    for nid in range(1, args.nodes + 1):
+        cmd = [sys.executable, '-u', os.path.join(ROOT, 'server.py'), '--id', str(nid),
+               '--tcp-port', str(args.base_port + nid), '--replication-port', str(args.base_port + 100 + nid)]
+        log = open(f"{args.log}.{nid}", 'a') if args.log else subprocess.DEVNULL
+        procs[args.base_port + nid] = subprocess.Popen(cmd + shlex.split(args.server_args),
+                                                       stdout=log, stderr=subprocess.STDOUT)
+    return procs
+
+
+def report(args, parts, kill):
+    ack_ms = [x for p in parts for x in p['ack_ms']]
+    sent = {}
+    for p in parts:
+        sent.update(p['sent'])
+    broadcast_ms = [(t - sent[(room, v)]) * 1000 for p in parts for room, v, t in p['arrivals']
+                    if (room, v) in sent]
+    spectator_ms = [(t - sent[(room, v)]) * 1000 for p in parts for room, v, t in p['watched']
+                    if (room, v) in sent]
+    watchers = {}
+    for p in parts:
+        for port, count in p['watchers'].items():
+            watchers[port] = watchers.get(port, 0) + count
+    results = {}
+    for p in parts:
+        for key, count in p['results'].items():
+            results[key] = results.get(key, 0) + count
+    timeline = [sum(p['timeline'][i] for p in parts) for i in range(int(args.seconds) + 1)]
+    out = {'config': {k: v for k, v in vars(args).items() if k != 'json'},
+           'moves': len(ack_ms), 'moves_per_s': round(len(ack_ms) / args.seconds, 1),
+           'ack_ms': summary(ack_ms), 'broadcast_ms': summary(broadcast_ms),
+           'results': results, 'connects': sum(p['connects'] for p in parts), 'timeline': timeline}
+    if args.spectators:
+        out['spectator_ms'] = summary(spectator_ms)
+        out['spectators_by_port'] = {str(port): count for port, count in sorted(watchers.items())}
+    if kill:
+        node, at = kill
+        outages = [o for p in parts for o in p['outages']]
+        after = [back for _, back in outages if back > at]
+        out['failover'] = {'killed': node, 'kill_at_s': args.kill_at,
+                           'first_ack_after_ms': round((min(after) - at) * 1000, 1) if after else None,
+                           'bots_reconnected': len(outages),
+                           'outage_ms': summary([(back - down) * 1000 for down, back in outages])}
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bots', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=2.0, help='moves per second per bot')
+    parser.add_argument('--correct', type=float, default=0.5, help='share of moves that try to be correct')
+    parser.add_argument('--seconds', type=float, default=30.0)
+    parser.add_argument('--observers', type=int, default=2, help='bots per room timing broadcast delivery')
+    parser.add_argument('--spectators', type=int, default=0, help='watch-only connections per room')
+    parser.add_argument('--codec', choices=sorted(CODECS), default='json')
+    parser.add_argument('--procs', type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)))
+    parser.add_argument('--ack-timeout', type=float, default=5.0, help='seconds before a MOVE counts as timed out')
+    parser.add_argument('--retry-ms', type=float, default=200, help='max backoff between reconnect rounds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenario', choices=['steady','failover'], default='steady')
+    parser.add_argument('--kill-at', type=float, default=10.0, help='seconds into the run (failover)')
+    parser.add_argument('--connect', nargs='+', default=None, metavar='HOST:PORT',
+                        help='drive an existing cluster instead of starting one')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--base-port', type=int, default=9800)
+    parser.add_argument('--server-args', default='--board-size 64 --blanks 1024',
+                        help='extra server.py flags for the cluster we start')
+    parser.add_argument('--settle', type=float, default=10.0, help='max seconds for the cluster to serve')
+    parser.add_argument('--log', default=None, help='append server output to LOG.<id>')
+    parser.add_argument('--json', default=None, help='write the results here')
+    args = parser.parse_args()
+    if args.scenario == 'failover' and args.connect:
+        parser.error('--scenario failover needs the cluster loadgen starts itself (no --connect)')
+
+    raise_fd_limit()
+    procs = {}
+    if args.connect:
+        addrs = [(h, int(p)) for h, p in (a.rsplit(':', 1) for a in args.connect)]
+    else:
+        procs = start_cluster(args)
+        addrs = [('127.0.0.1', port) for port in procs]
+    try:
+        deadline = time.monotonic() + args.settle
+        while serving_node(addrs, 'room0') is None:
+            if time.monotonic() > deadline:
+                sys.exit('no node is serving; is the cluster up?')
+            time.sleep(0.1)
+        time.sleep(0.5 if args.connect else 2.0)  # let backups attach before the clock starts
+        start = time.monotonic() + 1.0
+        jobs = [(args, addrs, start, part) for part in range(args.procs)]
+        with multiprocessing.Pool(args.procs) as pool:
+            pending = pool.map_async(worker, jobs)
+            kill = None
+            if args.scenario == 'failover':
+                time.sleep(max(0.0, start + args.kill_at - time.monotonic()))
+                victim = serving_node(addrs, 'room0')
+                if victim is not None:
+                    procs[victim[1]].kill()
+                    kill = (victim[1] - args.base_port, time.monotonic())
+            parts = pending.get()
+    finally:
+        for p in procs.values():
+            p.kill()
+            p.wait()
+
+    out = report(args, parts, kill)
+    print(f"bots {args.bots}  rooms {args.rooms}  rate {args.rate}/s  correct {args.correct}  "
+          f"seconds {args.seconds:g}  procs {args.procs}")
+    print(f"moves/s       {out['moves_per_s']:,.0f}  ({out['moves']:,} acked, {out['connects']:,} connects)")
+    for label, key in (('ack ms', 'ack_ms'), ('broadcast ms', 'broadcast_ms'), ('spectator ms', 'spectator_ms')):
+        s = out.get(key)
+        if s is None:
+            continue
+        print(f"{label:<13} p50 {s['p50']:.2f}  p90 {s['p90']:.2f}  p99 {s['p99']:.2f}  max {s['max']:.2f}")
+    print("results       " + '  '.join(f"{k} {v:,}" for k, v in sorted(out['results'].items())))
+    if args.spectators:
+        print("spectators at " + '  '.join(f"{port} {count:,}" for port, count in out['spectators_by_port'].items()))
+    if 'failover' in out:
+        f = out['failover']
+        first = f"{f['first_ack_after_ms']:.0f} ms" if f['first_ack_after_ms'] is not None else 'never'
+        print(f"failover      node {f['killed']} killed at {args.kill_at:g}s, first ack after {first}; "
+              f"{f['bots_reconnected']} bots out p50 {f['outage_ms']['p50']:.0f} ms  max {f['outage_ms']['max']:.0f} ms")
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(out, fh, indent=1)
+
+
+if __name__ == '__main__':
+    main()
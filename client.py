@@ -1,98 +1,324 @@
-
 #!/usr/bin/env python3
-import socket, argparse, time, threading
-from utils import send_msg, recv_msg, send_multicast_message, create_multicast_socket, MCAST_ADDR
-import json, sys
+import socket, argparse, time, threading, itertools
+from concurrent.futures import Future
+from utils import send_msg, FrameReader, decode_msg, create_multicast_socket
+from codec import CODECS, JSON
+from game import apply_delta_to_state
+import sys
 
 def discover_primary(timeout=3.0):
-    # listen for multicast PRIMARY announce for a short time
+    # listen for multicast PRIMARY announce for a short time -> (host, port) or None
     s = create_multicast_socket()
     s.settimeout(timeout)
     try:
         while True:
             data, addr = s.recvfrom(65536)
-            msg = json.loads(data.decode('utf-8'))
-            if msg.get('type') == 'PRIMARY':
-                return (addr[0], msg.get('tcp_port'))
+            msg = decode_msg(data)
+            # the primary's announce rides along with its heartbeats in a BATCH datagram
+            for m in (msg['msgs'] if msg.get('type') == 'BATCH' else (msg,)):
+                if m.get('type') == 'PRIMARY':
+                    return (addr[0], m.get('tcp_port'))
     except Exception:
-        return "Some error in discovering the primary server"
-
-def run_client(name, host='127.0.0.1', port=9001):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(5.0)
-    try:
-        s.connect((host, port))
-    except Exception as e:
-        print("failed connect to server:", e)
-        return
-    send_msg(s, {'type':'HELLO','name':name})
-    initial = recv_msg(s)
-    if not initial:
-        print("no response")
-        s.close()
-        return
-    if initial.get('type') == 'REDIRECT':
-        print("Server redirected to primary", initial)
+        return None
+    finally:
         s.close()
-        host = initial['host']; port = initial['port']
-        print("connecting to", host, port)
-        time.sleep(0.2)
-        run_client(name, host, port)
-        return
-    print("Initial:", initial.get('note'))
-    state = initial.get('state')
-    if state:
-        display_state(state)
-    # start thread to read server messages
-    t = threading.Thread(target=reader_thread, args=(s,), daemon=True)
-    t.start()
 
+class PuzzleClient:
+    # A player connection that survives failover.
+    #
+    # A background thread keeps one connection to whichever node serves our room. It tries
+    # the last node that served us, then the seed addresses, then a PRIMARY announce heard
+    # on multicast, following REDIRECTs, with exponential backoff between rounds. On
+    # reconnect HELLO carries the last version we saw. The server answers RESUME plus the
+    # moves we missed, or a full STATE when its history no longer reaches back that far.
+    #
+    # move() does not wait for the ack: each MOVE carries an id that the server echoes in
+    # its MOVE_ACK, so up to max_inflight moves can be on the wire at once. It returns a
+    # Future for the ack (or for an ERROR such as not_primary). Moves in flight when the
+    # connection drops fail with ConnectionError, because they may or may not have been
+    # applied. The caller decides whether to send them again.
+    #
+    # on_message(msg) sees every server message; state is the local copy of the room,
+    # kept current from STATE and MOVE_DELTA.
+    #
+    # spectate=True watches without playing: HELLO says role 'spectator', and the primary
+    # redirects us to a relay (a backup fanning out what it replicates) when it has one.
+
+    def __init__(self, name, room='default', seeds=(), codec='json', discover=True,
+                 max_inflight=1024, connect_timeout=2.0, backoff=(0.05, 2.0), on_message=None,
+                 spectate=False):
+        self.name = name
+        self.room = room
+        self.spectate = spectate
+        self.seeds = [tuple(a) for a in seeds]  # (host, port) to try when the last node is gone
+        self.codec = codec
+        self.discover = discover  # fall back to listening for a multicast PRIMARY announce
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff  # (first, max) seconds between connect rounds
+        self.on_message = on_message
+        self.state = None
+        self.addr = None  # node serving us now (or last)
+        self.connected = threading.Event()
+        self.reconnects = 0
+        self._last_delta = None  # the delta that produced state['version'], to check a RESUME against
+        self._resyncing = False
+        self._sock = None
+        self._wire = JSON
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending = {}  # move id -> Future
+        self._pending_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._closed = False
+        self._thread = None
+
+    def start(self, timeout=None):
+        # -> True once connected (False if timeout passes first); keeps reconnecting either way
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self.connected.wait(timeout)
+
+    def close(self):
+        self._closed = True
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join(5.0)
+
+    @property
+    def version(self):
+        return self.state['version'] if self.state else 0
+
+    def move(self, r, c, val, timeout=None):
+        # -> Future resolving to the MOVE_ACK (or ERROR) dict; blocks only while
+        # max_inflight moves are already waiting for acks or while we are reconnecting
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("too many moves in flight")
+        future = Future()
+        future.add_done_callback(lambda f: self._slots.release())
+        if not self.connected.wait(timeout):
+            future.set_exception(ConnectionError("not connected"))
+            return future
+        move_id = next(self._ids) & 0xFFFFFFFF
+        with self._pending_lock:
+            self._pending[move_id] = future
+        if not self._send({'type':'MOVE','r':r,'c':c,'val':val,'id':move_id}):
+            self._fail(move_id)
+        return future
+
+    def get_state(self):
+        # ask for a full STATE; it replaces `state` when it arrives
+        return self._send({'type':'GET_STATE'})
+
+    def _send(self, msg):
+        sock = self._sock
+        if sock is None:
+            return False
+        try:
+            with self._send_lock:
+                send_msg(sock, msg, self._wire)
+            return True
+        except OSError:
+            return False
+
+    def _fail(self, move_id):
+        with self._pending_lock:
+            future = self._pending.pop(move_id, None)
+        if future is not None and not future.done():
+            future.set_exception(ConnectionError("connection lost before the ack; the move may have been applied"))
+
+    def _run(self):
+        delay = self.backoff[0]
+        while not self._closed:
+            served = self._connect()
+            if served is None:
+                time.sleep(delay)
+                delay = min(self.backoff[1], delay * 2)
+                continue
+            delay = self.backoff[0]
+            sock, reader, first = served
+            self._sock = sock
+            self.connected.set()
+            try:
+                for msg in first:
+                    self._handle(msg)
+                while not self._closed:
+                    msg = reader.recv()
+                    if msg is None:
+                        break
+                    self._handle(msg)
+            except (OSError, ValueError):
+                pass
+            self.connected.clear()
+            self._sock = None
+            sock.close()
+            with self._pending_lock:
+                lost = list(self._pending)
+            for move_id in lost:
+                self._fail(move_id)
+            if not self._closed:
+                self.reconnects += 1
+
+    def _connect(self):
+        # -> (sock, reader, [first messages]) from a node serving our room, or None
+        candidates = ([self.addr] if self.addr else []) + [a for a in self.seeds if a != self.addr]
+        if self.discover and not candidates:
+            found = discover_primary(self.connect_timeout)
+            if found:
+                candidates.append(found)
+        for addr in candidates:
+            for _ in range(3):  # follow a couple of REDIRECTs
+                result = self._hello(addr)
+                if result is None:
+                    break
+                if isinstance(result, tuple) and len(result) == 3:
+                    self.addr = addr
+                    return result
+                addr = result
+        if self.discover and candidates:
+            # every node we knew of is gone or not serving: listen for the new primary
+            found = discover_primary(self.connect_timeout)
+            if found and found not in candidates:
+                result = self._hello(found)
+                if isinstance(result, tuple) and len(result) == 3:
+                    self.addr = found
+                    return result
+        return None
+
+    def _hello(self, addr):
+        # -> (sock, reader, messages) when served, a (host, port) REDIRECT target, or None
+        try:
+            sock = socket.create_connection(addr, timeout=self.connect_timeout)
+        except OSError:
+            return None
+        hello = {'type':'HELLO','name':self.name,'room':self.room,'codecs':[self.codec,'json']}
+        if self.spectate:
+            hello['role'] = 'spectator'
+        if self.state is not None:
+            hello['version'] = self.state['version']
+        reader = FrameReader(sock, bufsize=16384)
+        try:
+            send_msg(sock, hello)
+            early = []  # broadcasts can land before the reply to HELLO
+            while True:
+                msg = reader.recv()
+                if msg is None or msg.get('type') in ('STATE', 'RESUME', 'REDIRECT', 'ERROR'):
+                    break
+                early.append(msg)
+        except (OSError, ValueError):
+            msg = None
+        if msg and msg.get('type') in ('STATE', 'RESUME') and (self.spectate or msg.get('note') == 'primary'):
+            sock.settimeout(None)  # idle players are fine; a dead node shows up as EOF or a reset
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self._wire = CODECS.get(msg.get('codec'), JSON)
+            return sock, reader, [msg] + early
+        sock.close()
+        if msg and msg.get('type') == 'REDIRECT':
+            return (msg['host'], msg['port'])
+        return None  # a backup with no primary yet, or the node went away
+
+    def _handle(self, msg):
+        mtype = msg.get('type')
+        if mtype == 'STATE':
+            self.state = msg['state']
+            self._last_delta = None
+            self._resyncing = False
+        elif mtype == 'RESUME':
+            # the deltas that follow start at the version we already have
+            self._resyncing = False
+        elif mtype == 'MOVE_DELTA':
+            self._apply_delta(msg)
+        elif mtype in ('MOVE_ACK', 'ERROR') and 'id' in msg:
+            with self._pending_lock:
+                future = self._pending.pop(msg['id'], None)
+            if future is not None:
+                future.set_result(msg)
+            if msg.get('error') == 'not_primary' and not self.spectate and self._sock is not None:
+                self._sock.shutdown(socket.SHUT_RDWR)  # our node lost the room: find its new home
+        elif mtype == 'REDIRECT':
+            # ring sharding moved our room
+            self.addr = (msg['host'], msg['port'])
+            self._sock.shutdown(socket.SHUT_RDWR)
+        if self.on_message:
+            self.on_message(msg)
+
+    def _apply_delta(self, delta):
+        if self.state is None or self._resyncing:
+            return
+        if delta['version'] == self.state['version'] and self._last_delta is not None:
+            # start of a RESUME: a different move at our version means the node we reconnected to
+            # never saw ours (lost in failover), so our copy is off
+            if any(delta[k] != self._last_delta[k] for k in ('r', 'c', 'val', 'player')):
+                self._resync()
+            return
+        if not apply_delta_to_state(self.state, delta):
+            self._resync()  # missed a version
+            return
+        if delta['version'] == self.state['version']:
+            self._last_delta = delta
+
+    def _resync(self):
+        self._resyncing = True
+        self.get_state()
+
+def run_client(name, seeds=(), codec='json', room='default', spectate=False):
+    def show(msg):
+        mtype = msg.get('type')
+        if mtype in ('STATE', 'MOVE_DELTA'):
+            if client.state is not None:
+                display_state(client.state)
+        elif mtype == 'RESUME':
+            print("resumed room", msg.get('room'), "from version", msg.get('version'))
+        elif mtype == 'ERROR':
+            print("ERROR:", msg.get('error'))
+        elif mtype == 'REDIRECT':
+            print("room moved to", msg.get('host'), msg.get('port'))
+        elif mtype != 'MOVE_ACK':
+            print("MSG:", msg)
+
+    def acked(future):
+        try:
+            ack = future.result()
+        except ConnectionError as e:
+            print("Move lost:", e)
+            return
+        if ack.get('type') == 'MOVE_ACK':
+            print("Move ack:", ack.get('result'), ack.get('reason', ''))
+
+    client = PuzzleClient(name, room, seeds, codec, on_message=show, spectate=spectate)
+    if not client.start(timeout=10.0):
+        print("no server yet, still trying in the background")
+    else:
+        print("connected to", client.addr, "room:", room)
     try:
         while True:
             cmd = input("cmd (move r c val / state / exit): ").strip()
             if cmd == 'exit':
                 break
             if cmd == 'state':
-                send_msg(s, {'type':'GET_STATE'})
-                time.sleep(0.1)
+                client.get_state()
                 continue
             parts = cmd.split()
             if len(parts) == 4 and parts[0] == 'move':
+                if spectate:
+                    print("spectating: moves need a player connection")
+                    continue
                 try:
                     r = int(parts[1]); c = int(parts[2]); val = int(parts[3])
                 except:
                     print("invalid ints")
                     continue
-                send_msg(s, {'type':'MOVE','r':r,'c':c,'val':val})
-                time.sleep(0.1)
+                client.move(r, c, val).add_done_callback(acked)
                 continue
             print("unknown command")
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, EOFError):
         pass
     finally:
-        try: s.close()
-        except: pass
-
-def reader_thread(sock):
-    try:
-        while True:
-            msg = recv_msg(sock)
-            if not msg:
-                print("server closed")
-                break
-            mtype = msg.get('type')
-            if mtype == 'STATE':
-                display_state(msg.get('state'))
-            elif mtype == 'MOVE_ACK':
-                print("Move ack:", msg.get('result'), msg.get('reason', ''))
-                if msg.get('state'):
-                    display_state(msg.get('state'))
-            elif mtype == 'ERROR':
-                print("ERROR:", msg.get('error'))
-            else:
-                print("MSG:", msg)
-    except Exception as e:
-        print("reader error", e)
+        client.close()
 
 def display_state(state):
     print("=== GAME STATE v{} Round:{} ===".format(state.get('version'), state.get('round')))
@@ -105,19 +331,17 @@ def display_state(state):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--name', required=True)
-    parser.add_argument('--host', default=None)
+    parser.add_argument('--host', default=None, help='a node to start from (default: discover the primary via multicast)')
     parser.add_argument('--port', type=int, default=9001)
+    parser.add_argument('--seed', action='append', default=[], metavar='HOST:PORT',
+                        help='more nodes to try after a failover (repeatable)')
+    parser.add_argument('--room', default='default', help='game room to join')
+    parser.add_argument('--codec', choices=sorted(CODECS), default='json', help='preferred wire codec')
+    parser.add_argument('--spectate', action='store_true', help='watch the room from a relay node, no moves')
     args = parser.parse_args()
 
-    if args.host is None:
-        print("Discovering primary via multicast for 2s...")
-        primary = discover_primary(timeout=2.0)
-        if primary:
-            host, port = primary
-            print("Found primary at", host, port)
-            run_client(args.name, host, port)
-        else:
-            print("No primary discovered; using default 127.0.0.1")
-            run_client(args.name, '127.0.0.1', args.port)
-    else:
-        run_client(args.name, args.host, args.port)
+    seeds = [(args.host, args.port)] if args.host else []
+    seeds += [(h, int(p)) for h, p in (s.rsplit(':', 1) for s in args.seed)]
+    if not seeds:
+        print("Discovering primary via multicast...")
+    run_client(args.name, seeds, args.codec, args.room, args.spectate)
@@ -0,0 +1,324 @@
+import json
+import struct
+import sys
+import codecs
+from array import array
+from itertools import chain
+
+# Wire codecs for TCP frames and multicast datagrams.
+#
+# Payloads are self-describing, so a receiver never needs to know which codec the
+# sender picked: JSON always starts with '{', binary records start with a small
+# tag byte. The codec only decides how a sender *encodes*.
+#
+#   json - json.dumps of the message dict (default)
+#   bin  - struct-packed records for the fixed-shape hot messages (MOVE and MOVE_ACK,
+#          each with an optional u32 'id' for pipelined moves, HEARTBEAT, MOVE_DELTA,
+#          STATE/STATE_UPDATE with a packed board, and BATCH, several multicast
+#          messages in one datagram);
+#          anything else (or any message with extra fields) falls back to JSON.
+#
+# Clients pick a codec in HELLO: {'type':'HELLO', ..., 'codecs':['bin','json']}.
+# The server answers with 'codec' in its first STATE and uses it from then on.
+
+JSON_START = ord('{')
+
+TAG_MOVE = 1
+TAG_MOVE_ACK = 2
+TAG_HEARTBEAT = 3
+TAG_MOVE_DELTA = 4
+TAG_STATE = 5
+TAG_STATE_UPDATE = 6
+TAG_BATCH = 7
+TAG_MOVE_ID = 8
+
+_MOVE = struct.Struct('>BHHH')             # tag, r, c, val
+_MOVE_ID = struct.Struct('>BHHHI')         # tag, r, c, val, id
+_MOVE_ACK = struct.Struct('>BBBI')         # tag, flags, reason code, version
+_HEARTBEAT = struct.Struct('>BiHH')        # tag, node_id, tcp_port, replication_port
+_MOVE_DELTA = struct.Struct('>BHHHiIHB')   # tag, r, c, val, score_delta, version, len(player), len(room)
+_STATE = struct.Struct('>BHIIBBBH')        # tag, n, version, round, board width, len(note), len(room), nscores
+_NAME = struct.Struct('>H')
+_SCORE = struct.Struct('>i')
+_U32_S = struct.Struct('>I')
+
+_ACK_OK = 1
+_ACK_HAS_VERSION = 2
+_ACK_HAS_REASON = 4
+_ACK_HAS_ID = 8  # u32 id follows the record
+ACK_REASONS = ['', 'out_of_bounds', 'cell_not_empty', 'incorrect']
+_ACK_REASON_CODES = {r: i for i, r in enumerate(ACK_REASONS)}
+
+_U16 = 0xFFFF
+_U32 = 0xFFFFFFFF
+
+
+def _is_u16(v):
+    return type(v) is int and 0 <= v <= _U16
+
+def _is_u32(v):
+    return type(v) is int and 0 <= v <= _U32
+
+def _is_i32(v):
+    return type(v) is int and -0x80000000 <= v <= 0x7FFFFFFF
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+
+class BinaryCodec:
+    name = 'bin'
+
+    def encode(self, obj):
+        packer = _PACKERS.get(obj.get('type'))
+        data = packer(obj) if packer else None
+        if data is None:
+            return JSON.encode(obj)
+        return data
+
+
+def _pack_move(m):
+    if not {'type', 'r', 'c', 'val'} <= m.keys() <= {'type', 'r', 'c', 'val', 'id'}:
+        return None
+    if not (_is_u16(m['r']) and _is_u16(m['c']) and _is_u16(m['val'])):
+        return None
+    if 'id' in m:
+        if not _is_u32(m['id']):
+            return None
+        return _MOVE_ID.pack(TAG_MOVE_ID, m['r'], m['c'], m['val'], m['id'])
+    return _MOVE.pack(TAG_MOVE, m['r'], m['c'], m['val'])
+
+def _pack_move_ack(m):
+    if not m.keys() <= {'type', 'result', 'reason', 'version', 'id'}:
+        return None
+    flags = _ACK_OK if m.get('result') == 'ok' else 0
+    if m.get('result') not in ('ok', 'fail'):
+        return None
+    reason = 0
+    if 'reason' in m:
+        if m['reason'] not in _ACK_REASON_CODES:
+            return None
+        flags |= _ACK_HAS_REASON
+        reason = _ACK_REASON_CODES[m['reason']]
+    version = 0
+    if 'version' in m:
+        if not _is_u32(m['version']):
+            return None
+        flags |= _ACK_HAS_VERSION
+        version = m['version']
+    if 'id' in m:
+        if not _is_u32(m['id']):
+            return None
+        return _MOVE_ACK.pack(TAG_MOVE_ACK, flags | _ACK_HAS_ID, reason, version) + _U32_S.pack(m['id'])
+    return _MOVE_ACK.pack(TAG_MOVE_ACK, flags, reason, version)
+
+def _pack_heartbeat(m):
+    if m.keys() != {'type', 'node_id', 'tcp_port', 'replication_port'}:
+        return None
+    if not (_is_i32(m['node_id']) and _is_u16(m['tcp_port']) and _is_u16(m['replication_port'])):
+        return None
+    return _HEARTBEAT.pack(TAG_HEARTBEAT, m['node_id'], m['tcp_port'], m['replication_port'])
+
+def _pack_room(m):
+    # optional room id (replication tags deltas/snapshots with it); None if it does not fit
+    room = m.get('room', '')
+    if not isinstance(room, str):
+        return None
+    room = room.encode('utf-8')
+    return room if len(room) <= 255 else None
+
+def _pack_move_delta(m):
+    if not {'type', 'r', 'c', 'val', 'player', 'score_delta', 'version'} <= m.keys() <= \
+            {'type', 'r', 'c', 'val', 'player', 'score_delta', 'version', 'room'}:
+        return None
+    if not (_is_u16(m['r']) and _is_u16(m['c']) and _is_u16(m['val'])
+            and _is_i32(m['score_delta']) and _is_u32(m['version'])):
+        return None
+    if not isinstance(m['player'], str):
+        return None
+    player = m['player'].encode('utf-8')
+    room = _pack_room(m)
+    if len(player) > _U16 or room is None:
+        return None
+    return _MOVE_DELTA.pack(TAG_MOVE_DELTA, m['r'], m['c'], m['val'], m['score_delta'],
+                            m['version'], len(player), len(room)) + player + room
+
+def _pack_board(board, n):
+    # row-major, one byte per cell while values fit, else big-endian u16
+    width = 1 if n < 256 else 2
+    cells = array('B' if width == 1 else 'H', chain.from_iterable(board))
+    if width == 2 and sys.byteorder == 'little':
+        cells.byteswap()
+    return width, cells.tobytes()
+
+def _pack_state_msg(tag, m):
+    if not m.keys() <= {'type', 'state', 'note', 'room'}:
+        return None
+    st = m['state']
+    if st.keys() != {'n', 'board', 'scores', 'round', 'version'}:
+        return None
+    n = st['n']
+    if not (_is_u16(n) and _is_u32(st['version']) and _is_u32(st['round'])):
+        return None
+    note = m.get('note', '')
+    if not isinstance(note, str):
+        return None
+    note = note.encode('utf-8')
+    room = _pack_room(m)
+    if len(note) > 255 or room is None or len(st['scores']) > _U16:
+        return None
+    width, board = _pack_board(st['board'], n)
+    parts = [_STATE.pack(tag, n, st['version'], st['round'], width, len(note), len(room),
+                         len(st['scores'])),
+             board, note, room]
+    for player, score in st['scores'].items():
+        if not isinstance(player, str):
+            return None
+        name = player.encode('utf-8')
+        if len(name) > _U16 or not _is_i32(score):
+            return None
+        parts.append(_NAME.pack(len(name)))
+        parts.append(name)
+        parts.append(_SCORE.pack(score))
+    return b''.join(parts)
+
+def _pack_batch(m):
+    # tag, then each message as a u16 length + its own payload (binary record or JSON)
+    if m.keys() != {'type', 'msgs'}:
+        return None
+    parts = [bytes((TAG_BATCH,))]
+    for sub in m['msgs']:
+        data = BINARY.encode(sub)
+        if len(data) > _U16:
+            return None
+        parts.append(_NAME.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+_PACKERS = {
+    'MOVE': _pack_move,
+    'MOVE_ACK': _pack_move_ack,
+    'HEARTBEAT': _pack_heartbeat,
+    'MOVE_DELTA': _pack_move_delta,
+    'STATE': lambda m: _pack_state_msg(TAG_STATE, m),
+    'STATE_UPDATE': lambda m: _pack_state_msg(TAG_STATE_UPDATE, m),
+    'BATCH': _pack_batch,
+}
+
+
+def _unpack_move(buf):
+    _, r, c, val = _MOVE.unpack_from(buf)
+    return {'type': 'MOVE', 'r': r, 'c': c, 'val': val}
+
+def _unpack_move_id(buf):
+    _, r, c, val, move_id = _MOVE_ID.unpack_from(buf)
+    return {'type': 'MOVE', 'r': r, 'c': c, 'val': val, 'id': move_id}
+
+def _unpack_move_ack(buf):
+    _, flags, reason, version = _MOVE_ACK.unpack_from(buf)
+    msg = {'type': 'MOVE_ACK', 'result': 'ok' if flags & _ACK_OK else 'fail'}
+    if flags & _ACK_HAS_REASON:
+        msg['reason'] = ACK_REASONS[reason]
+    if flags & _ACK_HAS_VERSION:
+        msg['version'] = version
+    if flags & _ACK_HAS_ID:
+        msg['id'] = _U32_S.unpack_from(buf, _MOVE_ACK.size)[0]
+    return msg
+
+def _unpack_heartbeat(buf):
+    _, node_id, tcp_port, repl_port = _HEARTBEAT.unpack_from(buf)
+    return {'type': 'HEARTBEAT', 'node_id': node_id, 'tcp_port': tcp_port,
+            'replication_port': repl_port}
+
+def _unpack_move_delta(buf):
+    _, r, c, val, score_delta, version, nlen, rlen = _MOVE_DELTA.unpack_from(buf)
+    off = _MOVE_DELTA.size
+    player = codecs.utf_8_decode(buf[off:off + nlen])[0]
+    msg = {'type': 'MOVE_DELTA', 'r': r, 'c': c, 'val': val, 'player': player,
+           'score_delta': score_delta, 'version': version}
+    if rlen:
+        off += nlen
+        msg['room'] = codecs.utf_8_decode(buf[off:off + rlen])[0]
+    return msg
+
+def _unpack_state_msg(buf, mtype):
+    _, n, version, rnd, width, nlen, rlen, nscores = _STATE.unpack_from(buf)
+    off = _STATE.size
+    size = n * n * width
+    cells = array('B' if width == 1 else 'H')
+    cells.frombytes(buf[off:off + size])
+    if width == 2 and sys.byteorder == 'little':
+        cells.byteswap()
+    off += size
+    cells = cells.tolist()
+    board = [cells[i:i + n] for i in range(0, n * n, n)]
+    note = codecs.utf_8_decode(buf[off:off + nlen])[0]
+    off += nlen
+    room = codecs.utf_8_decode(buf[off:off + rlen])[0]
+    off += rlen
+    scores = {}
+    for _ in range(nscores):
+        (klen,) = _NAME.unpack_from(buf, off)
+        off += _NAME.size
+        name = codecs.utf_8_decode(buf[off:off + klen])[0]
+        off += klen
+        (scores[name],) = _SCORE.unpack_from(buf, off)
+        off += _SCORE.size
+    msg = {'type': mtype, 'state': {'n': n, 'board': board, 'scores': scores,
+                                    'round': rnd, 'version': version}}
+    if nlen:
+        msg['note'] = note
+    if rlen:
+        msg['room'] = room
+    return msg
+
+def _unpack_batch(buf):
+    msgs = []
+    off = 1
+    while off < len(buf):
+        (size,) = _NAME.unpack_from(buf, off)
+        off += _NAME.size
+        msgs.append(decode(buf[off:off + size]))
+        off += size
+    return {'type': 'BATCH', 'msgs': msgs}
+
+_UNPACKERS = {
+    TAG_MOVE: _unpack_move,
+    TAG_MOVE_ACK: _unpack_move_ack,
+    TAG_HEARTBEAT: _unpack_heartbeat,
+    TAG_MOVE_DELTA: _unpack_move_delta,
+    TAG_STATE: lambda buf: _unpack_state_msg(buf, 'STATE'),
+    TAG_STATE_UPDATE: lambda buf: _unpack_state_msg(buf, 'STATE_UPDATE'),
+    TAG_BATCH: _unpack_batch,
+    TAG_MOVE_ID: _unpack_move_id,
+}
+
+
+def decode(buf):
+    # buf: bytes, bytearray or memoryview holding exactly one payload
+    if not len(buf):
+        raise ValueError('empty payload')
+    tag = buf[0]
+    if tag == JSON_START:
+        return json.loads(codecs.utf_8_decode(buf)[0])
+    unpack = _UNPACKERS.get(tag)
+    if unpack is None:
+        raise ValueError(f"unknown binary tag {tag}")
+    return unpack(buf)
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {c.name: c for c in (JSON, BINARY)}
+
+
+def negotiate(offered):
+    # first codec in the peer's preference list that we support; JSON otherwise
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
@@ -0,0 +1,71 @@
+import math
+import threading
+from collections import deque
+
+# Phi-accrual failure detector (Hayashibara et al.), fed by multicast heartbeats.
+#
+# Instead of a fixed timeout, each peer's heartbeat inter-arrival times are kept in a
+# sliding window. phi(now) is -log10 of the probability that a heartbeat would still
+# be on its way after the silence seen so far, under a normal distribution fitted to
+# that window:
+#   phi 1 ~ 10% chance the peer is fine, phi 3 ~ 0.1%, phi 8 ~ 1e-8
+# A peer is suspected once phi crosses the threshold. A steady peer is suspected
+# within a few intervals of its last heartbeat; a jittery one gets more slack
+# automatically.
+
+class PhiAccrualDetector:
+    def __init__(self, interval, threshold=8.0, window=100, min_std=None):
+        self.interval = interval  # expected heartbeat interval (s), seeds a new peer's history
+        self.threshold = threshold
+        self.window = window
+        self.min_std = min_std if min_std is not None else interval / 4
+        self._peers = {}  # node_id -> [last arrival, deque of intervals, sum, sum of squares]
+        self._lock = threading.Lock()
+
+    def heartbeat(self, node_id, now):
+        with self._lock:
+            peer = self._peers.get(node_id)
+            if peer is None:
+                # first contact: assume the expected interval until real samples arrive
+                peer = self._peers[node_id] = [now, deque(), 0.0, 0.0]
+                self._add(peer, self.interval)
+                return
+            gap = now - peer[0]
+            peer[0] = now
+            if gap > 0:
+                self._add(peer, gap)
+
+    def _add(self, peer, gap):
+        samples = peer[1]
+        if len(samples) == self.window:
+            old = samples.popleft()
+            peer[2] -= old
+            peer[3] -= old * old
+        samples.append(gap)
+        peer[2] += gap
+        peer[3] += gap * gap
+
+    def phi(self, node_id, now):
+        with self._lock:
+            peer = self._peers.get(node_id)
+            if peer is None:
+                return 0.0
+            last, samples, total, squares = peer
+            count = len(samples)
+            mean = total / count
+            std = max(self.min_std, math.sqrt(max(0.0, squares / count - mean * mean)))
+        # logistic approximation of the normal CDF
+        y = (now - last - mean) / std
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if now - last > mean:
+            p_later = e / (1.0 + e)
+        else:
+            p_later = 1.0 - 1.0 / (1.0 + e)
+        return -math.log10(max(p_later, 1e-300))
+
+    def suspect(self, node_id, now):
+        return self.phi(node_id, now) > self.threshold
+
+    def remove(self, node_id):
+        with self._lock:
+            self._peers.pop(node_id, None)
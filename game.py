@@ -1,78 +1,219 @@
 
 import random
 import threading
-from copy import deepcopy
+import time
+from array import array
+from collections import deque
+from itertools import chain, islice
 
 # Simple NxN puzzle: a Latin-square-like puzzle for demo.
 # We create a complete nxn board with numbers 1..n in each row/col, then remove k cells.
+# The complete board is kept as the solution: a flat row-major array('H'), so checking
+# a move is one index. The live board is a flat array('H') too (0 means blank).
+#
+# Snapshots: every change ends by publishing a new immutable Snapshot (private copies of
+# the board and scores) with one reference assignment. Readers (as_dict, snapshot) only
+# load that reference and never take the lock, so GET_STATE and broadcasts do not queue
+# behind movers, and a reader never sees half of a set_state. A batch of moves publishes
+# once. Snapshot.as_dict() builds the wire-format dict once and hands the same object to
+# every caller, so callers must treat it as read-only.
+#
+# history keeps the last few deltas so a backup that is a little behind can be caught
+# up with just the moves it missed (deltas_since) instead of a full snapshot.
+
+class Snapshot:
+    __slots__ = ('n', 'version', 'round', 'board', 'scores', '_dict')
+
+    def __init__(self, n, version, round, board, scores):
+        self.n = n
+        self.version = version
+        self.round = round
+        self.board = board  # array('H') owned by this snapshot, never written after publish
+        self.scores = scores  # dict owned by this snapshot, likewise
+        self._dict = None
+
+    def as_dict(self):
+        # two readers racing here both build an equal dict; whichever is stored last is kept
+        d = self._dict
+        if d is None:
+            n, board = self.n, self.board
+            d = self._dict = {
+                'n': n,
+                'board': [board[i:i+n].tolist() for i in range(0, n*n, n)],
+                'scores': self.scores,
+                'round': self.round,
+                'version': self.version
+            }
+        return d
+
 
 class GameState:
-    def __init__(self, n=3, blanks=3):
+    __slots__ = ('n', 'board', 'locked', 'scores', 'round', 'version',
+                 'perm', 'solution', 'history', '_lock', '_published')
+
+    def __init__(self, n=3, blanks=3, history=1024):
         self.n = n
-        self.board = []  # 2D list, 0 means blank
+        self.board = None  # array('H'), n*n, row-major, 0 means blank
         self.locked = {}  # (r,c) -> player name locking it (if needed)
         self.scores = {}  # player -> score
         self.round = 1
         self.version = 0
+        self.perm = None  # (rows, cols, symbols) that generated the solution
+        self.solution = None  # array('H'), n*n, row-major
+        self._published = None  # Snapshot of the current state; replaced, never modified
+        self.history = deque(maxlen=history)  # last deltas, consecutive versions ending at self.version
         self._generate_complete_board()
         self._remove_blanks(blanks)
         self._lock = threading.Lock()
+        self._publish()
 
     def _generate_complete_board(self):
+        # the cyclic square (r + c) % n with its rows, columns and symbols randomly permuted:
+        # still a Latin square, but not the predictable shifted one
         n = self.n
-        # generate a simple Latin square by shifting
-        base = list(range(1, n+1))
-        self.board = [base[i:] + base[:i] for i in range(n)]
+        self._build_solution([random.sample(range(n), n) for _ in range(3)])
+        self.board = array('H', self.solution)
+
+    def _build_solution(self, perm):
+        rows, cols, syms = perm
+        # symbol table doubled so (r + c) needs no modulo
+        table = [s + 1 for s in syms] * 2
+        solution = array('H')
+        for r in rows:
+            solution.extend([table[r + c] for c in cols])
+        self.perm = (list(rows), list(cols), list(syms))
+        self.solution = solution
 
     def _remove_blanks(self, k):
         n = self.n
-        cells = [(r,c) for r in range(n) for c in range(n)]
-        random.shuffle(cells)
-        for i in range(min(k, len(cells))):
-            r,c = cells[i]
-            self.board[r][c] = 0
+        # sample k cells rather than shuffling all n*n of them
+        for i in random.sample(range(n*n), min(k, n*n)):
+            self.board[i] = 0
+
+    def _publish(self):
+        # writers only, lock held: the swap is a single reference store
+        self._published = Snapshot(self.n, self.version, self.round, array('H', self.board), dict(self.scores))
+
+    def snapshot(self):
+        return self._published
 
     def as_dict(self):
+        return self._published.as_dict()
+
+    def add_player(self, player):
         with self._lock:
-            return {
-                'n': self.n,
-                'board': deepcopy(self.board),
-                'scores': dict(self.scores),
-                'round': self.round,
-                'version': self.version
-            }
+            if player not in self.scores:
+                self.scores[player] = 0
+                self._publish()
 
     def is_correct_move(self, r, c, val):
         # correct if val equals the value in the underlying Latin square
-        # But since blanks are actually set to 0 in board, recreate expected board
-        expected = list(range(1, self.n+1))
-        expected_row = expected[r:] + expected[:r]
-        return expected_row[c] == val
+        return self.solution[r * self.n + c] == val
 
     def apply_move(self, player, r, c, val):
+        # returns (ok, reason, delta); delta is None when the move did not change the state
         with self._lock:
-            if r < 0 or c < 0 or r >= self.n or c >= self.n:
-                return False, "out_of_bounds"
-            if self.board[r][c] != 0:
-                return False, "cell_not_empty"
-            if not self.is_correct_move(r,c,val):
-                # incorrect
-                self.scores.setdefault(player, 0)
-                self.scores[player] -= 1
-                self.version += 1
-                return False, "incorrect"
-            # correct
-            self.board[r][c] = val
-            self.scores.setdefault(player, 0)
-            self.scores[player] += 5
+            result = self._apply_move_locked(player, r, c, val)
+            if result[2]:
+                self._publish()
+            return result
+
+    def apply_moves(self, moves, lock_wait=None):
+        # a batch of (player, r, c, val) under one lock acquisition -> [(ok, reason, delta)]
+        # lock_wait: optional histogram (metrics.py) fed the time spent acquiring the lock
+        if lock_wait is None:
+            with self._lock:
+                return self._apply_moves_locked(moves)
+        t0 = time.perf_counter()
+        with self._lock:
+            lock_wait.observe(time.perf_counter() - t0)
+            return self._apply_moves_locked(moves)
+
+    def _apply_moves_locked(self, moves):
+        before = self.version
+        results = [self._apply_move_locked(*move) for move in moves]
+        if self.version != before:
+            self._publish()
+        return results
+
+    def _apply_move_locked(self, player, r, c, val):
+        if r < 0 or c < 0 or r >= self.n or c >= self.n:
+            return False, "out_of_bounds", None
+        i = r * self.n + c
+        if self.board[i] != 0:
+            return False, "cell_not_empty", None
+        self.scores.setdefault(player, 0)
+        if self.solution[i] != val:
+            # incorrect: cell stays blank, so the delta carries val 0
+            self.scores[player] -= 1
             self.version += 1
-            return True, "ok"
+            return False, "incorrect", self._delta(r, c, 0, player, -1)
+        # correct
+        self.board[i] = val
+        self.scores[player] += 5
+        self.version += 1
+        return True, "ok", self._delta(r, c, val, player, 5)
 
-    def set_state(self, state_dict):
+    def _delta(self, r, c, val, player, score_delta):
+        delta = {'r': r, 'c': c, 'val': val, 'player': player,
+                 'score_delta': score_delta, 'version': self.version}
+        self.history.append(delta)
+        return delta
+
+    def deltas_since(self, version):
+        # deltas after `version` up to now, or None if history no longer reaches back that far
+        with self._lock:
+            if version > self.version:
+                return None
+            if version == self.version:
+                return []
+            h = self.history
+            if not h or h[0]['version'] > version + 1:
+                return None
+            return list(islice(h, version + 1 - h[0]['version'], None))
+
+    def apply_delta(self, delta):
+        # apply a MOVE_DELTA produced by apply_move on the primary.
+        # returns False on a version gap: the caller must resync with a full snapshot.
         with self._lock:
+            v = delta['version']
+            if v <= self.version:
+                return True  # already have it
+            if v != self.version + 1:
+                return False
+            if delta['val']:
+                self.board[delta['r'] * self.n + delta['c']] = delta['val']
+            player = delta['player']
+            self.scores[player] = self.scores.get(player, 0) + delta['score_delta']
+            self.version = v
+            self._publish()
+            self._delta(delta['r'], delta['c'], delta['val'], player, delta['score_delta'])
+            return True
+
+    def set_state(self, state_dict, perm=None):
+        # perm: the primary's solution permutations (replication only, clients never get them)
+        with self._lock:
+            if perm is not None:
+                self._build_solution(perm)
             self.n = state_dict['n']
-            self.board = state_dict['board']
-            self.scores = state_dict['scores']
+            self.board = array('H', chain.from_iterable(state_dict['board']))
+            self.scores = dict(state_dict['scores'])
             self.round = state_dict.get('round', self.round)
             self.version = state_dict.get('version', self.version)
+            self._publish()
+            self.history.clear()
+
 
+def apply_delta_to_state(state, delta):
+    # same as GameState.apply_delta for a plain state dict (clients keep one of these)
+    v = delta['version']
+    if v <= state['version']:
+        return True
+    if v != state['version'] + 1:
+        return False
+    if delta['val']:
+        state['board'][delta['r']][delta['c']] = delta['val']
+    scores = state['scores']
+    scores[delta['player']] = scores.get(delta['player'], 0) + delta['score_delta']
+    state['version'] = v
+    return True
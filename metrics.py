@@ -0,0 +1,154 @@
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Low-overhead node metrics, scraped in Prometheus text format (server.py --metrics-port).
+#
+#   Counter   - monotonically increasing total, optionally one per label value
+#   Histogram - fixed buckets; observe() is one bisect and two adds under a lock
+#   Gauge     - read from a callback at scrape time, so the hot path pays nothing;
+#               the callback returns a number or {label value: number}
+#
+# Everything is registered on a Registry; render() produces the exposition text that
+# MetricsServer serves on GET /metrics.
+
+LATENCY_BUCKETS = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label  # label name when inc() is given a key
+        self.value = 0
+        self.values = {}  # label value -> total
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, key=None):
+        with self._lock:
+            if key is None:
+                self.value += amount
+            else:
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        if self.label is None:
+            return [(self.name, '', self.value)]
+        with self._lock:
+            values = sorted(self.values.items())
+        return [(self.name, f'{{{self.label}="{key}"}}', v) for key, v in values]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot: above every bucket
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        out = []
+        running = 0
+        for bound, count in zip(self.buckets, counts):
+            running += count
+            out.append((self.name + '_bucket', f'{{le="{bound:g}"}}', running))
+        running += counts[-1]
+        out.append((self.name + '_bucket', '{le="+Inf"}', running))
+        out.append((self.name + '_sum', '', total))
+        out.append((self.name + '_count', '', running))
+        return out
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label  # label name when fn returns {label value: number}
+
+    def samples(self):
+        value = self.fn()
+        if self.label is None:
+            return [(self.name, '', value)]
+        return [(self.name, f'{{{self.label}="{key}"}}', v) for key, v in sorted(value.items())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, fn, label=None):
+        return self._add(Gauge(name, help, fn, label))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                continue  # a gauge whose source is gone (e.g. mid-shutdown)
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    # GET /metrics over plain HTTP, one thread per scrape
+    def __init__(self, registry, port, host='127.0.0.1'):
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry_.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # scrapes are not worth a log line
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self.httpd.server_address[1]
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
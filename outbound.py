@@ -0,0 +1,167 @@
+import socket
+import threading
+from collections import deque
+from codec import JSON
+
+# Bounded per-client outbound queues.
+# Broadcasts only enqueue a pre-encoded frame; a dedicated writer (thread or
+# asyncio task) drains the queue, so one slow client cannot stall the mover.
+#
+# Overflow policies:
+#   drop_stale - drop queued broadcast frames (MOVE_DELTA/STATE) and send the
+#                client one fresh STATE snapshot in their place
+#   disconnect - close the slow consumer
+# Direct replies (MOVE_ACK, ERROR, ...) are never dropped; if the queue is full
+# of replies the client is disconnected under either policy.
+
+OVERFLOW_POLICIES = ('drop_stale', 'disconnect')
+
+
+class OutboundQueue:
+    def __init__(self, maxlen=256, policy='drop_stale', resync=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {policy!r}")
+        self.maxlen = maxlen
+        self.policy = policy
+        self.resync = resync  # callable(conn) -> frame with a fresh full STATE
+        self.name = None
+        self.codec = JSON  # negotiated in HELLO
+        self.room = None  # rooms.Room joined in HELLO
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.overflow_disconnect = False
+        self._q = deque()
+        self._lock = threading.Lock()
+        self._resync_pending = False
+        self._closing = False
+
+    @property
+    def depth(self):
+        return len(self._q)
+
+    def send_frame(self, frame, droppable=False):
+        # queue one encoded frame; returns False if the connection is (now) closed
+        with self._lock:
+            if self.closed or self._closing:
+                return False
+            if droppable and self._resync_pending:
+                # a fresh snapshot is already due, it will include this update
+                self.dropped += 1
+                return True
+            if len(self._q) >= self.maxlen:
+                if not (self.policy == 'drop_stale' and self._drop_stale_locked()):
+                    self.overflow_disconnect = True
+                    self._abort_locked()
+                    return False
+                if droppable:
+                    self.dropped += 1
+                    self._wakeup_locked()
+                    return True
+            self._q.append((frame, droppable))
+            if len(self._q) > self.high_water:
+                self.high_water = len(self._q)
+            self._wakeup_locked()
+        return True
+
+    # socket-like so utils.send_msg(conn, obj) queues a direct reply
+    def sendall(self, data):
+        if not self.send_frame(data):
+            raise ConnectionError('client connection closed')
+
+    def _drop_stale_locked(self):
+        kept = deque(item for item in self._q if not item[1])
+        ndropped = len(self._q) - len(kept)
+        if not ndropped:
+            return False
+        self.dropped += ndropped
+        self._q = kept
+        if self.resync is not None:
+            self._resync_pending = True
+        return True
+
+    def _next_frames(self):
+        # writer side: everything queued so far (one write instead of one per frame)
+        with self._lock:
+            resync = self._resync_pending
+            self._resync_pending = False
+            if not resync:
+                frames = [item[0] for item in self._q]
+                self._q.clear()
+                return frames
+        # build the snapshot outside our lock (it takes the game lock);
+        # frames queued after the drop go out on the next pass, behind it
+        return [self.resync(self)]
+
+    def _has_work_locked(self):
+        return bool(self._q) or self._resync_pending
+
+    def stats(self):
+        return {'name': self.name, 'room': self.room.room_id if self.room else None,
+                'depth': len(self._q), 'high_water': self.high_water,
+                'sent': self.sent, 'dropped': self.dropped,
+                'overflow_disconnect': self.overflow_disconnect}
+
+    def close(self):
+        # graceful: the writer flushes what is queued (e.g. a REDIRECT) then closes
+        with self._lock:
+            if self.closed:
+                return
+            self._closing = True
+            self._wakeup_locked()
+
+    def _abort_locked(self):
+        self.closed = True
+        self._q.clear()
+        self._resync_pending = False
+        self._wakeup_locked()
+
+    # subclass hooks
+    def _wakeup_locked(self):
+        raise NotImplementedError
+
+
+class ThreadedOutbound(OutboundQueue):
+    # one writer thread per client socket (server.py --io threads)
+    def __init__(self, sock, **kwargs):
+        super().__init__(**kwargs)
+        self.sock = sock
+        try:
+            self.peer = sock.getpeername()
+        except OSError:
+            self.peer = None
+        self._cond = threading.Condition(self._lock)
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def _wakeup_locked(self):
+        self._cond.notify()
+
+    def _writer(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self.closed and not self._closing and not self._has_work_locked():
+                        self._cond.wait()
+                    if self.closed or (self._closing and not self._has_work_locked()):
+                        break
+                frames = self._next_frames()
+                if not frames:
+                    continue
+                self.sock.sendall(frames[0] if len(frames) == 1 else b''.join(frames))
+                self.sent += len(frames)
+                frames = None  # don't pin the last frame (often a whole STATE) while idle
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self.closed = True
+                self._q.clear()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                self.sock.close()
+            except OSError:
+                pass
@@ -0,0 +1,73 @@
+import logging
+import threading
+
+# Per-room move pipeline (server.py --tick-ms).
+#
+# A MOVE handler only queues (conn, player, r, c, val, move_id) on its room. Queued
+# moves are drained in batches, and apply(room, batch) handles each batch as a unit: one
+# GameState lock acquisition, one replication write, one broadcast frame per codec.
+# Every mover still gets its own MOVE_ACK.
+#
+#   tick_ms 0 - the thread that queues a move drains the room right away, taking along
+#               whatever other movers queued in the meantime (no added latency)
+#   tick_ms N - one ticker thread drains every room with queued moves once per N ms
+#
+# At most one drain per room runs at a time, so a room's deltas reach the log, the
+# backups and the clients in version order.
+
+
+class MovePipeline:
+    def __init__(self, apply, tick_ms=0):
+        self.apply = apply  # callable(room, [(conn, player, r, c, val, move_id)])
+        self.tick_ms = tick_ms
+        self.batches = 0
+        self.moves = 0
+        self.max_batch = 0
+        self._ready = set()  # rooms with queued moves, for the ticker
+        self._ready_lock = threading.Lock()
+        self._stop = threading.Event()
+        if tick_ms > 0:
+            threading.Thread(target=self._ticker, daemon=True).start()
+
+    def submit(self, room, conn, player, r, c, val, move_id=None):
+        room.moves.append((conn, player, r, c, val, move_id))
+        if self.tick_ms > 0:
+            with self._ready_lock:
+                self._ready.add(room)
+            return
+        self.drain(room)
+
+    def drain(self, room):
+        # a move queued while another thread drains is picked up by that thread's next pass
+        while room.moves:
+            if not room.drain_lock.acquire(blocking=False):
+                return
+            try:
+                batch = []
+                while room.moves:
+                    batch.append(room.moves.popleft())
+                self.batches += 1
+                self.moves += len(batch)
+                self.max_batch = max(self.max_batch, len(batch))
+                self.apply(room, batch)
+            finally:
+                room.drain_lock.release()
+
+    def _ticker(self):
+        interval = self.tick_ms / 1000.0
+        while not self._stop.wait(interval):
+            with self._ready_lock:
+                rooms, self._ready = self._ready, set()
+            for room in rooms:
+                try:
+                    self.drain(room)
+                except Exception as e:
+                    logging.getLogger('puzzle').error(f"move pipeline error in room {room.room_id}: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {'tick_ms': self.tick_ms, 'batches': self.batches, 'moves': self.moves,
+                'avg_batch': round(self.moves / self.batches, 2) if self.batches else 0.0,
+                'max_batch': self.max_batch}
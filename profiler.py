@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from utils import send_msg, FrameReader
+
+# Runtime profiling for a ServerNode (server.py --profile, or an ADMIN message).
+#
+#   timings  - count / total / max wall time per client message type (MOVE, GET_STATE, ...)
+#              and per move-path stage (apply_batch, broadcast, replicate), recorded by the
+#              handler threads themselves
+#   sampling - a thread reads sys._current_frames() every interval_ms and counts each
+#              thread's stack. Threads parked in a known wait (socket reads, condition
+#              waits, accept/select, sleep loops) are skipped unless idle=True, so the
+#              samples show where handler threads burn time, not where they sit.
+#
+# dump() writes the samples as collapsed stacks ("outer;...;leaf count" per line), the
+# input of flamegraph.pl, speedscope and similar. report() is a text summary: the timing
+# table, then the top-N functions by own (leaf) and total (anywhere on the stack) samples.
+#
+# When off, the only cost is the `enabled` check the node does per message and per batch.
+#
+# Admin messages are accepted from loopback only, in place of HELLO on the client port:
+#   {'type':'ADMIN','cmd':'profile','action':'start'|'stop'|'report'|'dump','top':20}
+#   -> {'type':'PROFILE','enabled':bool,'report':text,'path':collapsed stacks file}
+# stop also dumps. From a shell:
+#
+#   python3 profiler.py --port 9001 start|stop|report|dump [--top 20]
+
+# leaf functions of a thread blocked rather than running
+# (a thread blocked on a lock inside a Python function, e.g. the game lock in apply_moves,
+# shows that function as its leaf and is counted: lock waits are what we want to see)
+IDLE = frozenset(('wait', 'accept', 'recv', 'recv_into', 'recvfrom', 'recv_fds', 'select', 'poll',
+                  'serve_forever', 'readinto', '_wait_for_tstate_lock'))
+
+
+class Profiler:
+    def __init__(self, interval_ms=5.0, idle=False, out_dir='.', name='node', idle_funcs=()):
+        self.interval = interval_ms / 1000.0
+        self.idle = idle  # also count threads parked in a wait (wall clock instead of busy time)
+        self.out_dir = out_dir
+        self.name = name
+        self.idle_funcs = IDLE | frozenset(idle_funcs)  # the owner's own sleep loops
+        self.enabled = False
+        self.started = None
+        self.samples = 0
+        self._stacks = Counter()  # (code, ...) leaf first -> samples
+        self._timings = {}  # key -> [count, total seconds, max seconds]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._switch = None  # the interpreter's switch interval, restored by stop()
+
+    def start(self):
+        with self._lock:
+            if self.enabled:
+                return
+            self._stacks = Counter()
+            self._timings = {}
+            self.samples = 0
+            self.started = time.monotonic()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sampler, args=(self._stop,), daemon=True)
+            self.enabled = True
+            # the sampler only runs once it gets the GIL, which mostly changes hands when a thread
+            # blocks, i.e. when it is idle; a short switch interval lets it land mid-work too
+            self._switch = sys.getswitchinterval()
+            sys.setswitchinterval(min(self._switch, self.interval / 10))
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self._stop.set()
+            sys.setswitchinterval(self._switch)
+        self._thread.join(1.0)
+
+    def record(self, key, seconds):
+        with self._lock:
+            t = self._timings.get(key)
+            if t is None:
+                self._timings[key] = [1, seconds, seconds]
+                return
+            t[0] += 1
+            t[1] += seconds
+            if seconds > t[2]:
+                t[2] = seconds
+
+    def _sampler(self, stop):
+        me = threading.get_ident()
+        idle_funcs = self.idle_funcs
+        while not stop.wait(self.interval):
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if not self.idle and frame.f_code.co_name in idle_funcs:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                stacks.append(tuple(codes))
+            # formatted at dump time: a sample only stores code objects
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
+
+    @staticmethod
+    def _frame_name(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def collapsed(self):
+        with self._lock:
+            stacks = list(self._stacks.items())
+        lines = [';'.join(self._frame_name(code) for code in reversed(stack)) + f" {count}"
+                 for stack, count in stacks]
+        return sorted(lines)
+
+    def dump(self, path=None):
+        # -> the file written
+        if path is None:
+            path = os.path.join(self.out_dir, f"profile-{self.name}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, 'w') as fh:
+            fh.write('\n'.join(self.collapsed()) + '\n')
+        return path
+
+    def report(self, top=20):
+        with self._lock:
+            stacks = list(self._stacks.items())
+            timings = sorted(self._timings.items(), key=lambda kv: -kv[1][1])
+            samples = self.samples
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        lines = [f"profile {self.name}: {elapsed:.1f} s, {samples} samples every {self.interval * 1000:g} ms "
+                 f"({'all threads' if self.idle else 'waiting threads skipped'})",
+                 f"{'timing':<16} {'count':>9} {'total ms':>10} {'mean us':>9} {'max us':>9}"]
+        for key, (count, total, worst) in timings:
+            lines.append(f"{key:<16} {count:>9} {total * 1000:>10.1f} {total / count * 1e6:>9.1f} {worst * 1e6:>9.0f}")
+        own = Counter()
+        anywhere = Counter()
+        for stack, count in stacks:
+            own[stack[0]] += count
+            for code in set(stack):
+                anywhere[code] += count
+        hits = sum(own.values())
+        for title, counts in (('own', own), ('total', anywhere)):
+            lines.append(f"top {top} by {title} samples ({hits} thread samples)")
+            for code, count in counts.most_common(top):
+                lines.append(f"  {count / hits * 100:5.1f}% {count:>7}  {self._frame_name(code)}")
+        return '\n'.join(lines)
+
+    def stats(self):
+        return {'enabled': self.enabled, 'samples': self.samples, 'interval_ms': self.interval * 1000,
+                'stacks': len(self._stacks)}
+
+
+def admin(host, port, action, top=20, timeout=10.0):
+    # send one profile ADMIN message to a node -> its PROFILE reply
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        send_msg(sock, {'type':'ADMIN','cmd':'profile','action':action,'top':top})
+        return FrameReader(sock).recv()
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['start', 'stop', 'report', 'dump'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9001, help="the node's client port")
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+    reply = admin(args.host, args.port, args.action, args.top)
+    if not reply or reply.get('type') != 'PROFILE':
+        sys.exit(f"unexpected reply: {reply}")
+    print("profiling", "on" if reply['enabled'] else "off")
+    if reply.get('report'):
+        print(reply['report'])
+    if reply.get('path'):
+        print("collapsed stacks:", reply['path'])
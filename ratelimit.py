@@ -0,0 +1,122 @@
+import threading
+import time
+from metrics import Counter
+
+# Admission control and overload shedding (server.py --max-clients, --max-rooms,
+# --player-rate, --room-rate, --max-queued).
+#
+#   connections - a node takes at most max_clients clients; past that a HELLO gets
+#                 ERROR 'busy' and the connection is closed
+#   rooms       - a HELLO may create its room (the id is the client's choice) only while the
+#                 node holds fewer than max_rooms; rooms are kept for good, so this is the cap
+#   per player  - a token bucket per (room, player name): `rate` moves/s, bursts of `burst`
+#   per room    - a token bucket per room shared by all its players
+#   queue       - a MOVE for a room that already has max_queued moves waiting for the
+#                 move pipeline is shed instead of queued
+#
+# A MOVE over a limit gets ERROR 'busy' with a reason (and retry_ms for the rate limits)
+# and costs nothing else: no version bump, no log write, no replication, no broadcast.
+# Limits of 0 are off. Every rejection is counted by reason.
+
+SWEEP_EVERY = 4096  # moves between sweeps of idle player buckets
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'lock')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic() if now is None else now
+        self.lock = threading.Lock()
+
+    def take(self, now):
+        # -> 0.0 if a token was taken, else seconds until the next one
+        with self.lock:
+            tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if tokens >= 1.0:
+                self.tokens = tokens - 1.0
+                return 0.0
+            self.tokens = tokens
+            return (1.0 - tokens) / self.rate
+
+    def full(self, now):
+        # refilled to burst by now: the same as a fresh bucket, so safe to forget
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class Admission:
+    def __init__(self, max_clients=0, player_rate=0.0, player_burst=0, room_rate=0.0, room_burst=0,
+                 max_queued=0, counter=None, max_rooms=0):
+        self.max_clients = max_clients
+        self.max_rooms = max_rooms
+        self.player_rate = player_rate
+        self.player_burst = player_burst or max(1, int(player_rate))  # default: one second's worth
+        self.room_rate = room_rate
+        self.room_burst = room_burst or max(1, int(room_rate))
+        self.max_queued = max_queued
+        # labelled by reason; pass the node's metrics counter to have it scraped
+        self.rejected = counter or Counter('puzzle_rejected_total', 'requests shed', label='reason')
+        self._players = {}  # (room_id, name) -> TokenBucket
+        self._rooms = {}  # room_id -> TokenBucket
+        self._lock = threading.Lock()  # guards bucket creation and sweeps
+        self._moves = 0
+
+    def admit(self, clients):
+        # -> None to serve a new client, else the reason to turn it away
+        if self.max_clients and clients >= self.max_clients:
+            self.rejected.inc(key='max_clients')
+            return 'max_clients'
+        return None
+
+    def admit_room(self, rooms):
+        # -> None to let a HELLO create a new room, else the reason to turn it away
+        if self.max_rooms and rooms >= self.max_rooms:
+            self.rejected.inc(key='max_rooms')
+            return 'max_rooms'
+        return None
+
+    def check_move(self, room, player):
+        # -> None to queue the MOVE, else (reason, retry_ms) for the ERROR 'busy'
+        if self.max_queued and len(room.moves) >= self.max_queued:
+            self.rejected.inc(key='queue_full')
+            return 'queue_full', 0
+        if not (self.player_rate or self.room_rate):
+            return None
+        now = time.monotonic()
+        if self.player_rate:
+            wait = self._bucket(self._players, (room.room_id, player), self.player_rate, self.player_burst, now).take(now)
+            if wait:
+                self.rejected.inc(key='player_rate')
+                return 'player_rate', int(wait * 1000) + 1
+        if self.room_rate:
+            wait = self._bucket(self._rooms, room.room_id, self.room_rate, self.room_burst, now).take(now)
+            if wait:
+                self.rejected.inc(key='room_rate')
+                return 'room_rate', int(wait * 1000) + 1
+        self._moves += 1
+        if self._moves % SWEEP_EVERY == 0:
+            self._sweep(now)
+        return None
+
+    def _bucket(self, buckets, key, rate, burst, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = buckets.get(key)
+                if bucket is None:
+                    bucket = buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _sweep(self, now):
+        # players come and go: drop buckets that have refilled, a new one would be identical
+        with self._lock:
+            for buckets in (self._players, self._rooms):
+                for key in [k for k, b in list(buckets.items()) if b.full(now)]:
+                    del buckets[key]
+
+    def stats(self):
+        return {'max_clients': self.max_clients, 'max_rooms': self.max_rooms, 'player_rate': self.player_rate,
+                'room_rate': self.room_rate, 'max_queued': self.max_queued, 'rejected': dict(self.rejected.values)}
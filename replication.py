@@ -0,0 +1,200 @@
+import threading
+import time
+from collections import deque
+from outbound import ThreadedOutbound
+
+# Primary side of replication: one queued, batching writer per backup, cumulative
+# acks from the backups, and deferred client acks for the durability levels.
+#
+# Every record the primary ships (MOVE_DELTA, STATE_UPDATE, or STATE_BEGIN + STATE_ROWS
+# for a big board streamed in chunks) is tagged with its room
+# and that room's GameState.version. Records to one backup are queued in order and
+# its writer sends everything queued in one write, so the mover never waits on a
+# backup socket. After each burst a backup answers
+#   {'type':'REPL_ACK','count':records applied on this link,'versions':{room: version}}
+# Versions only grow per room, so the ack is cumulative: acking v10 covers v1..v10.
+#
+# Durability (server.py --durability) decides when a move's MOVE_ACK goes out:
+#   async  - right away, backups catch up in the background
+#   one    - once one backup has the move
+#   quorum - once a majority of the room's nodes (primary included) have it
+# A move that is not covered within ack_timeout is acked anyway with 'durable': False.
+
+DURABILITY_LEVELS = ('async', 'one', 'quorum')
+
+
+class ReplicaPeer(ThreadedOutbound):
+    def __init__(self, node_id, sock, maxlen):
+        # replication records are never dropped: a backup that falls this far behind is
+        # disconnected and gets fresh snapshots when it reconnects
+        super().__init__(sock, maxlen=maxlen, policy='disconnect')
+        self.node_id = node_id
+        self.name = f"node {node_id}"
+        self.acked = {}  # room_id -> highest version this backup has applied
+        self.records = 0  # records queued to this backup
+        self.acked_records = 0
+        self.last_ack = None
+        self._inflight = deque()  # (record number, monotonic time queued) not yet acked
+        self.ship_lock = threading.Lock()  # keeps record numbers in queue order
+
+    def ship(self, frame, records=1):
+        # frame may hold several records back to back (a batch of deltas)
+        with self.ship_lock:
+            return self.ship_locked(frame, records)
+
+    def ship_locked(self, frame, records=1):
+        self.records += records
+        self._inflight.append((self.records, time.monotonic()))
+        return self.send_frame(frame)
+
+    def ship_all(self, frames):
+        # frames go out back to back, with no other record between them
+        with self.ship_lock:
+            return all([self.ship_locked(frame) for frame in frames])
+
+    def ack(self, count, versions):
+        self.acked_records = max(self.acked_records, count)
+        while self._inflight and self._inflight[0][0] <= count:
+            self._inflight.popleft()
+        for room_id, version in versions.items():
+            if version > self.acked.get(room_id, -1):
+                self.acked[room_id] = version
+        self.last_ack = time.monotonic()
+
+    def lag(self):
+        # (records shipped but not acked, age in ms of the oldest of them)
+        oldest = self._inflight[0][1] if self._inflight else None
+        age = (time.monotonic() - oldest) * 1000 if oldest is not None else 0.0
+        return self.records - self.acked_records, age
+
+    def stats(self):
+        records, age = self.lag()
+        return {'node': self.node_id, 'queued': self.depth, 'sent': self.sent,
+                'lag_records': records, 'lag_ms': round(age, 1),
+                'overflow_disconnect': self.overflow_disconnect}
+
+
+class Replicator:
+    def __init__(self, durability='async', ack_timeout=1.0, queue=262144):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"unknown durability level {durability!r}")
+        self.durability = durability
+        self.ack_timeout = ack_timeout
+        self.queue = queue  # max records queued per backup
+        self.peers = {}  # node_id -> ReplicaPeer
+        self._lock = threading.Lock()  # guards _waiters, _ready and _draining
+        self._waiters = {}  # room_id -> deque of [version, needed, peers, callback, deadline]
+        self._ready = {}  # room_id -> deque of (callback, durable) released, in version order
+        self._draining = set()  # rooms whose _ready a thread is running
+        self.timeouts = 0
+        if durability != 'async':
+            threading.Thread(target=self._expirer, daemon=True).start()
+
+    def add_peer(self, node_id, sock, initial=()):
+        # register a backup; `initial()` (its catch-up frames) is queued before any record
+        # another thread ships to it
+        peer = ReplicaPeer(node_id, sock, self.queue)
+        with peer.ship_lock:
+            old = self.peers.get(node_id)
+            self.peers[node_id] = peer
+            for frame in initial():
+                peer.ship_locked(frame)
+        if old is not None:
+            old.close()
+        return peer
+
+    def remove_peer(self, peer):
+        if self.peers.get(peer.node_id) is peer:
+            del self.peers[peer.node_id]
+        peer.close()
+
+    def ship(self, frame, targets=None, records=1):
+        # queue frame (holding `records` records) to targets (node ids, None = every backup);
+        # returns the peers it went to
+        if targets is None:
+            peers = list(self.peers.values())
+        else:
+            peers = [self.peers[nid] for nid in targets if nid in self.peers]
+        shipped = [peer for peer in peers if peer.ship(frame, records)]
+        for peer in peers:
+            if peer.closed:
+                self.remove_peer(peer)
+        return shipped
+
+    def required(self, replicas):
+        # backups that must hold a move before it is acked, out of `replicas` configured
+        if self.durability == 'one':
+            return min(1, replicas)
+        if self.durability == 'quorum':
+            return (replicas + 1) // 2  # majority of replicas + 1 nodes, primary included
+        return 0
+
+    def after_durable(self, room_id, version, peers, replicas, callback):
+        # callback(durable) once `required(replicas)` of peers have acked room_id at version
+        needed = self.required(replicas)
+        if needed == 0:
+            callback(True)
+            return
+        waiter = [version, needed, peers, callback, time.monotonic() + self.ack_timeout]
+        with self._lock:
+            self._waiters.setdefault(room_id, deque()).append(waiter)
+        # the acks may already be in (or the peers gone)
+        self._release(room_id)
+
+    def on_ack(self, peer, msg):
+        versions = msg.get('versions') or {}
+        peer.ack(msg.get('count', 0), versions)
+        for room_id in versions:
+            self._release(room_id)
+
+    def _release(self, room_id, now=None):
+        # fire waiters in version order; stop at the first one still waiting.
+        # Callbacks run outside _lock but one room at a time: the thread that finds the
+        # room idle drains its _ready queue, any other thread releasing the same room only
+        # appends, so a room's acks and broadcasts never overtake each other
+        with self._lock:
+            waiters = self._waiters.get(room_id)
+            ready = None
+            while waiters:
+                version, needed, peers, callback, deadline = waiters[0]
+                have = sum(1 for p in peers if p.acked.get(room_id, -1) >= version)
+                if have >= needed:
+                    durable = True
+                elif now is not None and now >= deadline:
+                    durable = False
+                    self.timeouts += 1
+                else:
+                    break
+                waiters.popleft()
+                if ready is None:
+                    ready = self._ready.setdefault(room_id, deque())
+                ready.append((callback, durable))
+            if waiters is not None and not waiters:
+                del self._waiters[room_id]
+            if ready is None or room_id in self._draining:
+                return
+            self._draining.add(room_id)
+        try:
+            while True:
+                with self._lock:
+                    if not ready:
+                        del self._ready[room_id]
+                        self._draining.discard(room_id)
+                        return
+                    callback, durable = ready.popleft()
+                callback(durable)
+        except BaseException:
+            with self._lock:
+                self._draining.discard(room_id)
+            raise
+
+    def _expirer(self):
+        interval = min(0.05, self.ack_timeout / 4)
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            for room_id in list(self._waiters):
+                self._release(room_id, now)
+
+    def stats(self):
+        return [peer.stats() for peer in list(self.peers.values())]
@@ -0,0 +1,57 @@
+import bisect
+import hashlib
+
+# Consistent-hash ring used to spread rooms over nodes (server.py --sharding ring).
+# Each node gets `vnodes` points on the ring; a room belongs to the first node
+# clockwise from the room's hash, and its backups are the next distinct nodes.
+# Adding or removing a node only moves the rooms on the arcs next to its points
+# (about 1/N of them), everything else keeps its owner.
+#
+# Keys are hashed with md5, not hash(): every node must place a room the same way,
+# and str hashes are randomized per process.
+
+DEFAULT_VNODES = 64
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+        self.vnodes = vnodes
+        self.nodes = frozenset()
+        self._points = []  # sorted hashes
+        self._owners = []  # node id at each point
+        self.set_nodes(nodes)
+
+    def set_nodes(self, nodes):
+        # returns True if membership changed
+        nodes = frozenset(nodes)
+        if nodes == self.nodes:
+            return False
+        ring = sorted((_hash(f"{nid}#{i}"), nid) for nid in nodes for i in range(self.vnodes))
+        # swap both lists in one go; readers never see a half-built ring
+        self._points, self._owners = [p for p, _ in ring], [nid for _, nid in ring]
+        self.nodes = nodes
+        return True
+
+    def owners(self, key, count=1):
+        # [primary, backup, backup, ...]: up to `count` distinct nodes for key
+        points, owners = self._points, self._owners
+        if not points:
+            return []
+        count = min(count, len(self.nodes))
+        i = bisect.bisect(points, _hash(key))
+        found = []
+        for j in range(len(points)):
+            nid = owners[(i + j) % len(points)]
+            if nid not in found:
+                found.append(nid)
+                if len(found) == count:
+                    break
+        return found
+
+    def owner(self, key):
+        found = self.owners(key, 1)
+        return found[0] if found else None
@@ -0,0 +1,116 @@
+import threading
+from collections import deque
+from game import GameState
+from utils import encode_msg
+
+# Many independent game rooms per node.
+# Each room has its own GameState (and so its own move lock) and its own client
+# set, so moves, broadcasts and replication in one room never touch another.
+# The room table itself is guarded by a small set of sharded creation locks;
+# lookups of existing rooms take no lock at all.
+#
+# Each room also caches its encoded STATE frames. Only the served snapshot's frames
+# are kept (at most one per codec/note), so a reconnect storm after a failover is
+# served from one buffer instead of re-encoding the board per client. Like the game's
+# published snapshot, the cache is swapped as one (snapshot, frames) tuple, so
+# GET_STATE takes no lock at all.
+
+DEFAULT_ROOM = 'default'
+
+
+class Room:
+    def __init__(self, room_id, n=3, blanks=3, history=1024):
+        self.room_id = room_id
+        self.game = GameState(n=n, blanks=blanks, history=history)
+        self.clients = {}  # conn -> player name, for broadcasts scoped to this room
+        self.lock = threading.Lock()  # guards clients, held_acks, in_flight and durable_snapshot
+        self.moves = deque()  # (conn, player, r, c, val, move_id) waiting for the move pipeline
+        self.drain_lock = threading.Lock()  # held by the one thread draining moves
+        # acks of batches that changed nothing, held (in a list) while the room's last batch that
+        # did is still waiting to be durable, so acks never overtake it (server._apply_moves)
+        self.held_acks = None
+        # move batches applied but not yet durable, and while there are any, the snapshot of the
+        # last durable version: STATE serves that, so clients never see moves that may be lost
+        self.in_flight = 0
+        self.durable_snapshot = None
+        # ring sharding (server.py --sharding ring): is this node the room's primary, and
+        # which nodes it replicates the room to
+        self.primary = False
+        self.replicas = []
+        # (GameState.snapshot() the frames were built from, {(codec name, note, hello) -> framed STATE})
+        self._frames = (None, {})
+
+    def join(self, conn, name):
+        with self.lock:
+            self.clients[conn] = name
+
+    def leave(self, conn):
+        with self.lock:
+            self.clients.pop(conn, None)
+
+    def members(self):
+        return list(self.clients)
+
+    def snapshot(self):
+        # the state clients may see: the live one, or the last durable one while moves are in flight.
+        # Live is read first: the pipeline sets durable_snapshot before applying a batch.
+        live = self.game.snapshot()
+        snap = self.durable_snapshot
+        return live if snap is None else snap
+
+    def state_frame(self, codec, note=None, hello=False):
+        # framed STATE for the served snapshot; hello adds the negotiated codec name
+        # every change publishes a new Snapshot object, so identity is the cache key
+        snap = self.snapshot()
+        key = (codec.name, note, hello)
+        cached_snap, frames = self._frames
+        if cached_snap is snap:
+            frame = frames.get(key)
+            if frame is not None:
+                return frame
+        else:
+            frames = {}
+        msg = {'type':'STATE','state':snap.as_dict(),'room':self.room_id}
+        if note:
+            msg['note'] = note
+        if hello:
+            msg['codec'] = codec.name
+        frame = encode_msg(msg, codec)
+        # copy-on-write; a racing reader's insert may be lost, which only costs a re-encode
+        frames = dict(frames)
+        frames[key] = frame
+        self._frames = (snap, frames)
+        return frame
+
+
+class RoomManager:
+    def __init__(self, n=3, blanks=3, shards=64, on_create=None, history=1024):
+        self.n = n
+        self.blanks = blanks
+        self.history = history  # deltas each room keeps for backup catch-up
+        self.on_create = on_create  # callable(room), run before the room is visible to anyone else
+        self.rooms = {}  # room_id -> Room
+        self._shard_locks = [threading.Lock() for _ in range(shards)]
+
+    def get(self, room_id, create=True):
+        room = self.rooms.get(room_id)
+        if room is not None or not create:
+            return room
+        # only creation is serialized, and only against rooms in the same shard
+        with self._shard_locks[hash(room_id) % len(self._shard_locks)]:
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = Room(room_id, self.n, self.blanks, self.history)
+                if self.on_create is not None:
+                    self.on_create(room)
+                self.rooms[room_id] = room
+        return room
+
+    def remove(self, room_id):
+        return self.rooms.pop(room_id, None)
+
+    def all(self):
+        return list(self.rooms.values())
+
+    def __len__(self):
+        return len(self.rooms)
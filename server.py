@@ -1,13 +1,26 @@
 
 #!/usr/bin/env python3
 import argparse
+import itertools
+import logging
 import socket
 import threading
 import time
-import json
 import sys
-from utils import create_multicast_socket, send_multicast_message, send_msg, recv_msg, MCAST_ADDR
-from game import GameState
+from utils import create_multicast_socket, MulticastPublisher, send_msg, raise_fd_limit, MCAST_ADDR
+from utils import encode_msg, send_frame, FrameReader, decode_msg, node_logger
+from codec import CODECS, JSON, negotiate
+from rooms import RoomManager, DEFAULT_ROOM
+from ring import HashRing
+from wal import WriteAheadLog, replay
+from replication import Replicator, DURABILITY_LEVELS
+from pipeline import MovePipeline
+from failure import PhiAccrualDetector
+from metrics import Registry, MetricsServer
+from ratelimit import Admission
+from profiler import Profiler
+from aioserver import AsyncClientFrontend
+from outbound import ThreadedOutbound, OVERFLOW_POLICIES
 
 # Message types on multicast:
 # HELLO {type:'HELLO', node_id, tcp_port, replication_port}
@@ -15,37 +28,144 @@ from game import GameState
 # HEARTBEAT {type:'HEARTBEAT', node_id}
 # ELECTION {type:'ELECTION', node_id}
 # ELECTION_OK {type:'ELECTION_OK', node_id}
+# ROOMS {type:'ROOMS', node_id, rooms:[room_id...]}  rooms the sender is primary for (ring mode)
+# BATCH {type:'BATCH', msgs:[...]}  several of the above in one datagram
 
-HEARTBEAT_INTERVAL = 1.0
-HEARTBEAT_TIMEOUT = 3.0
+# Failure detection: every node multicasts a HEARTBEAT each heartbeat interval, and a
+# phi-accrual detector (failure.py) suspects a peer once its silence is improbably long
+# for the heartbeat gaps seen from it so far. Elections run as soon as the primary is
+# suspected and finish when the winner's PRIMARY announce arrives; they never wait
+# out fixed sleeps, so failover takes a few heartbeat intervals.
+HEARTBEAT_INTERVAL = 0.1
+PHI_THRESHOLD = 8.0
+ELECTION_TIMEOUT = 0.5  # wait for a higher node's PRIMARY after an ELECTION before asking again
+# Control traffic leaves through one MulticastPublisher per node. Each heartbeat datagram
+# also carries the primary's PRIMARY announce and, in ring mode, the rooms this node has
+# just taken over (ROOMS), with the full list every OWNERSHIP_REFRESH heartbeats.
+OWNERSHIP_REFRESH = 10
+MAX_ROOM_ID = 64  # characters; any id JSON-escapes to well under one multicast datagram
+SNAPSHOT_CHUNK_CELLS = 16384  # boards bigger than this are streamed to backups in row chunks
+MAX_ROOMS = 10000  # rooms a node lets HELLOs create (ids are client-chosen and rooms are never evicted)
 
 class ServerNode:
-    def __init__(self, node_id, host='0.0.0.0', tcp_port=9001, replication_port=9101):
+    def __init__(self, node_id, host='0.0.0.0', tcp_port=9001, replication_port=9101,
+                 io_mode='threads', backlog=128, accept_batch=64,
+                 client_queue=256, overflow='drop_stale', codec='json', board_size=3, blanks=3,
+                 sharding='single', replicas=1, data_dir=None, fsync_ms=10, snapshot_every=1000,
+                 durability='async', ack_timeout_ms=1000, history=1024, tick_ms=0,
+                 heartbeat_ms=HEARTBEAT_INTERVAL * 1000, phi_threshold=PHI_THRESHOLD,
+                 election_timeout_ms=ELECTION_TIMEOUT * 1000, metrics_port=None, workers=0,
+                 max_clients=0, player_rate=0.0, player_burst=0, room_rate=0.0, room_burst=0, max_queued=0,
+                 max_rooms=MAX_ROOMS,
+                 profile=False, profile_dir='.', profile_interval_ms=5.0, profile_idle=False):
         self.node_id = int(node_id)
+        self.log = node_logger(self.node_id)
         self.host = host
         self.tcp_port = tcp_port
         self.replication_port = replication_port
+        self.io_mode = io_mode  # 'threads' (thread per client) or 'asyncio' (single event loop)
+        self.backlog = backlog
+        self.accept_batch = accept_batch
+        self.frontend = None
+        self.client_queue = client_queue  # max frames queued per client
+        self.overflow = overflow  # outbound overflow policy, see outbound.py
+        self.codec = CODECS[codec]  # encoding for our own cluster traffic (heartbeats, replication)
         self.is_primary = False
+        # 'single': one elected primary serves every room; 'ring': each room has its own
+        # primary and `replicas` backups, placed on a consistent-hash ring of live nodes
+        self.sharding = sharding
+        self.ring_replicas = replicas
+        self.ring = HashRing([self.node_id])
         self.known_nodes = {}  # node_id -> (host, tcp_port, replication_port, last_seen)
         self.primary_info = None
+        self.heartbeat_interval = heartbeat_ms / 1000.0
+        self.election_timeout = election_timeout_ms / 1000.0
+        self.detector = PhiAccrualDetector(self.heartbeat_interval, phi_threshold)
+        self._election_needed = threading.Event()  # set to make the elector run an election
+        self._primary_seen = threading.Event()  # set by every PRIMARY announce
+        self._follow_lock = threading.Lock()
+        self._following = None  # node id of the primary our replication link goes to
         self.mcast_sock = create_multicast_socket()
+        self.publisher = MulticastPublisher(codec=self.codec)
+        self.room_owners = {}  # room_id -> node id that last announced it owns the room (ring mode)
         self.mcast_running = True
-        self.game = GameState(n=3, blanks=3)
-        self.replication_sockets = {}  # node_id -> socket (for primary to send updates)
+        # optional write-ahead move log; rooms found on disk are recovered in start()
+        self.wal = WriteAheadLog(data_dir, fsync_ms, snapshot_every) if data_dir else None
+        self.rooms = RoomManager(n=board_size, blanks=blanks, on_create=self._room_created, history=history)
+        # primary side of replication: per-backup queues, acks, durability (replication.py)
+        self.replicator = Replicator(durability, ack_timeout_ms / 1000.0)
+        # MOVEs are queued per room and applied, logged, replicated and broadcast in batches
+        self.pipeline = MovePipeline(self._apply_moves, tick_ms)
         self.backup_connections = {}  # for backups to primary (not used as dict here)
         self.client_handlers = []
-        self.clients = {}  # client socket -> name
+        self.clients = {}  # client conn -> name, across all rooms (each Room keeps its own set)
         self.lock = threading.Lock()
         self.server_sock = None
         self.replication_server_sock = None
         self.stop_event = threading.Event()
+        # Prometheus-style metrics (metrics.py), served on --metrics-port when set
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.metrics = Registry()
+        self._register_metrics()
+        # connection cap, per-player and per-room move rate limits, queue shedding (ratelimit.py)
+        self.admission = Admission(max_clients, player_rate, player_burst, room_rate, room_burst, max_queued,
+                                   self.metrics.counter('puzzle_rejected_total', 'HELLOs and MOVEs turned away busy',
+                                                        label='reason'), max_rooms)
+        # --workers: rooms are served by worker processes while we are primary (workers.py)
+        self.worker_count = workers
+        self.workers = None
+        self._relay_turn = itertools.count()  # round robin over relays for redirected spectators
+        # per-message timings and stack sampling, from --profile or an ADMIN message (profiler.py)
+        self.profile = profile
+        self.profiler = Profiler(profile_interval_ms, profile_idle, profile_dir, f"node{self.node_id}",
+                                 idle_funcs=('_mcast_listener', '_ring_maintainer', '_expirer', '<module>'))
+
+    def _register_metrics(self):
+        m = self.metrics
+        self.m_moves = m.counter('puzzle_moves_total', 'MOVEs applied')
+        self.m_batches = m.counter('puzzle_move_batches_total', 'move batches applied')
+        self.m_apply = m.histogram('puzzle_move_apply_seconds', 'applying one move batch, lock wait included')
+        self.m_lock_wait = m.histogram('puzzle_game_lock_wait_seconds', 'waiting for a room game lock to apply a batch')
+        self.m_serialize = m.histogram('puzzle_serialize_seconds', 'encoding one batch for clients or backups')
+        self.m_fanout = m.histogram('puzzle_broadcast_fanout_seconds', 'queueing one batch to every client in a room')
+        m.gauge('puzzle_is_primary', 'this node is the elected primary', lambda: int(self.is_primary))
+        m.gauge('puzzle_known_nodes', 'peers currently heard on multicast', lambda: len(self.known_nodes))
+        m.gauge('puzzle_rooms', 'rooms held by this node', lambda: len(self.rooms.all()))
+        m.gauge('puzzle_clients', 'connected clients', lambda: len(self.clients))
+        m.gauge('puzzle_client_queue_depth', 'frames queued to clients',
+                lambda: self._queue_depths(), label='stat')
+        m.gauge('puzzle_replication_lag_records', 'deltas shipped but not yet acked, per backup',
+                lambda: self._backup_stat('lag_records'), label='backup')
+        m.gauge('puzzle_replication_lag_ms', 'age of the oldest unacked delta, per backup',
+                lambda: self._backup_stat('lag_ms'), label='backup')
+        m.gauge('puzzle_replication_queue_depth', 'frames queued to each backup',
+                lambda: self._backup_stat('queued'), label='backup')
+
+    def _queue_depths(self):
+        depths = [conn.stats()['depth'] for conn in list(self.clients)]
+        return {'total': sum(depths), 'max': max(depths, default=0)}
+
+    def _backup_stat(self, key):
+        return {peer['node']: peer[key] for peer in self.replicator.stats()}
 
     def start(self):
-        print(f"[{self.node_id}] starting node. tcp:{self.tcp_port} repl:{self.replication_port}")
+        self.log.info(f"starting node. tcp:{self.tcp_port} repl:{self.replication_port}")
+        if self.wal:
+            self._recover()
+        if self.worker_count:
+            from workers import WorkerPool  # workers.py subclasses ServerNode
+            self.workers = WorkerPool(self, self.worker_count)
+            self.workers.start(self._worker_options())
+            self.log.info(f"started {self.worker_count} room workers")
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+            port = self.metrics_server.start()
+            self.log.info(f"metrics on http://127.0.0.1:{port}/metrics")
         threading.Thread(target=self._mcast_listener, daemon=True).start()
         time.sleep(0.2)
         # announce presence
-        send_multicast_message({'type':'HELLO','node_id':self.node_id,'tcp_port':self.tcp_port,'replication_port':self.replication_port})
+        self.publisher.send({'type':'HELLO','node_id':self.node_id,'tcp_port':self.tcp_port,'replication_port':self.replication_port})
         # small delay to collect HELLOs
         threading.Thread(target=self._heartbeat_sender, daemon=True).start()
         threading.Thread(target=self._heartbeat_checker, daemon=True).start()
@@ -53,172 +173,522 @@ class ServerNode:
         threading.Thread(target=self._start_tcp_servers, daemon=True).start()
         # start election after short delay
         time.sleep(0.5)
-        threading.Thread(target=self._start_election_if_needed, daemon=True).start()
+        if self.sharding == 'ring':
+            # no cluster-wide primary: the ring picks one per room
+            threading.Thread(target=self._ring_maintainer, daemon=True).start()
+        else:
+            threading.Thread(target=self._elector, daemon=True).start()
+            self._election_needed.set()
+        if self.profile:
+            self.profiler.start()
+            self.log.info("profiling (python3 profiler.py stop writes the report)")
 
     def _mcast_listener(self):
-        print(f"[{self.node_id}] multicast listener started")
+        self.log.info("multicast listener started")
         while self.mcast_running:
             try:
                 data, addr = self.mcast_sock.recvfrom(65536)
-                msg = json.loads(data.decode('utf-8'))
-                t = msg.get('type')
-                nid = msg.get('node_id')
-                if t == 'HELLO':
-                    self.known_nodes[nid] = (addr[0], msg['tcp_port'], msg['replication_port'], time.time())
-                elif t == 'PRIMARY':
-                    # primary announce
-                    self.primary_info = (nid, addr[0], msg['tcp_port'], msg['replication_port'])
-                    print(f"[{self.node_id}] saw primary announce: {self.primary_info}")
-                elif t == 'HEARTBEAT':
-                    # primary heartbeat - update last seen
-                    if nid in self.known_nodes:
-                        host, tcp, repl, _ = self.known_nodes[nid]
-                        self.known_nodes[nid] = (host, tcp, repl, time.time())
-                    else:
-                        self.known_nodes[nid] = (addr[0], msg.get('tcp_port', None), msg.get('replication_port', None), time.time())
-                elif t == 'ELECTION':
-                    # if we have higher id, reply OK
-                    if self.node_id > nid:
-                        send_multicast_message({'type':'ELECTION_OK','node_id':self.node_id})
-                        # start our own election
-                        threading.Thread(target=self._start_election_if_needed, daemon=True).start()
-                elif t == 'ELECTION_OK':
-                    # someone higher exists
-                    pass
+                msg = decode_msg(data)
+                for m in (msg['msgs'] if msg.get('type') == 'BATCH' else (msg,)):
+                    self._handle_mcast(m, addr)
             except Exception as e:
                 # ignore for clean shutdown
                 if not self.stop_event.is_set():
-                    print(f"[{self.node_id}] mcast listen error: {e}")
+                    self.log.warning(f"mcast listen error: {e}")
+
+    def _handle_mcast(self, msg, addr):
+        t = msg.get('type')
+        nid = msg.get('node_id')
+        if t in ('HELLO', 'HEARTBEAT') and nid is not None:
+            self.detector.heartbeat(nid, time.monotonic())
+        if t == 'HELLO':
+            self.known_nodes[nid] = (addr[0], msg['tcp_port'], msg['replication_port'], time.time())
+            if nid != self.node_id:
+                # a node joined: tell it who we are (and who leads) without waiting a heartbeat
+                self.publisher.send(*self._heartbeat_msgs(full=True))
+        elif t == 'PRIMARY':
+            # primary announce
+            self._primary_announced(nid, addr[0], msg['tcp_port'], msg['replication_port'])
+        elif t == 'HEARTBEAT':
+            # heartbeat - update last seen
+            if nid in self.known_nodes:
+                host, tcp, repl, _ = self.known_nodes[nid]
+                self.known_nodes[nid] = (host, tcp, repl, time.time())
+            else:
+                self.known_nodes[nid] = (addr[0], msg.get('tcp_port', None), msg.get('replication_port', None), time.time())
+        elif t == 'ROOMS':
+            for room_id in msg.get('rooms', ()):
+                self.room_owners[room_id] = nid
+        elif t == 'ELECTION':
+            if self.is_primary:
+                # still here: repeat the announce instead of letting an election start
+                self._announce_primary()
+            elif self.node_id > nid:
+                # if we have higher id, reply OK and hold our own election
+                self.publisher.send({'type':'ELECTION_OK','node_id':self.node_id})
+                self._election_needed.set()
+        elif t == 'ELECTION_OK':
+            # someone higher exists
+            pass
 
     def _heartbeat_sender(self):
+        beats = 0
         while not self.stop_event.is_set():
-            send_multicast_message({'type':'HEARTBEAT','node_id':self.node_id,'tcp_port':self.tcp_port,'replication_port':self.replication_port})
-            time.sleep(HEARTBEAT_INTERVAL)
+            # one datagram: heartbeat, primary announce, and any queued room ownership
+            self.publisher.flush(*self._heartbeat_msgs(full=beats % OWNERSHIP_REFRESH == 0))
+            beats += 1
+            self.stop_event.wait(self.heartbeat_interval)
+
+    def _heartbeat_msgs(self, full=False):
+        msgs = [{'type':'HEARTBEAT','node_id':self.node_id,'tcp_port':self.tcp_port,'replication_port':self.replication_port}]
+        if self.is_primary:
+            msgs.append(self._primary_msg())
+        if full and self.sharding == 'ring':
+            msgs.extend(self._rooms_msgs([room.room_id for room in self.rooms.all() if room.primary]))
+        return msgs
+
+    def _rooms_msgs(self, room_ids):
+        # as many ids per ROOMS as fit in one of the publisher's datagrams (ROOMS is always JSON)
+        budget = self.publisher.max_datagram - len(JSON.encode({'type':'ROOMS','node_id':self.node_id,'rooms':[]}))
+        msgs = []
+        chunk = []
+        size = 0
+        for room_id in room_ids:
+            cost = len(JSON.encode(room_id)) + 2  # quoted id and its ', ' separator
+            if chunk and size + cost > budget:
+                msgs.append({'type':'ROOMS','node_id':self.node_id,'rooms':chunk})
+                chunk = []
+                size = 0
+            chunk.append(room_id)
+            size += cost
+        if chunk:
+            msgs.append({'type':'ROOMS','node_id':self.node_id,'rooms':chunk})
+        return msgs
+
+    def _announce_rooms(self, room_ids):
+        # rooms we just became primary for go out with the next heartbeat
+        for msg in self._rooms_msgs(room_ids):
+            self.publisher.queue(msg)
 
     def _heartbeat_checker(self):
-        while not self.stop_event.is_set():
-            now = time.time()
-            # find primary in known nodes
-            primary = None
-            for nid, (host,tcp,repl,last) in list(self.known_nodes.items()):
-                if now - last > HEARTBEAT_TIMEOUT:
-                    print(f"[{self.node_id}] node {nid} timed out (last {last})")
-                    del self.known_nodes[nid]
-            # check primary heartbeat via primary_info if set
-            if self.primary_info:
-                pid, host, tcp, repl = self.primary_info
-                # if we haven't seen primary recently
-                last = self.known_nodes.get(pid, (None,None,None,0))[3]
-                if now - last > HEARTBEAT_TIMEOUT:
-                    print(f"[{self.node_id}] primary {pid} heartbeat missing -> start election")
-                    self.primary_info = None
-                    threading.Thread(target=self._start_election_if_needed, daemon=True).start()
-            time.sleep(1.0)
+        # a few checks per heartbeat interval, so a suspicion is acted on within a fraction of one
+        while not self.stop_event.wait(self.heartbeat_interval / 4):
+            now = time.monotonic()
+            for nid in list(self.known_nodes):
+                if nid != self.node_id and self.detector.suspect(nid, now):
+                    self.log.warning(f"node {nid} suspected (phi {self.detector.phi(nid, now):.1f})")
+                    self.known_nodes.pop(nid, None)
+                    self.detector.remove(nid)
+            # the primary is gone once the detector has dropped it
+            info = self.primary_info
+            if info and info[0] != self.node_id and info[0] not in self.known_nodes:
+                self.log.warning(f"primary {info[0]} heartbeat missing -> start election")
+                self.primary_info = None
+                self._election_needed.set()
 
     def _start_tcp_servers(self):
         # client server
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((self.host, self.tcp_port))
-        s.listen(8)
-        self.server_sock = s
-        print(f"[{self.node_id}] client TCP server listening on {self.tcp_port}")
-        threading.Thread(target=self._accept_clients, daemon=True).start()
+        if self.io_mode == 'asyncio':
+            self.frontend = AsyncClientFrontend(self, self.host, self.tcp_port,
+                                                backlog=self.backlog, accept_batch=self.accept_batch)
+            self.server_sock = self.frontend.start()
+            self.log.info(f"client asyncio server listening on {self.tcp_port}")
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.host, self.tcp_port))
+            s.listen(self.backlog)
+            self.server_sock = s
+            self.log.info(f"client TCP server listening on {self.tcp_port}")
+            threading.Thread(target=self._accept_clients, daemon=True).start()
         # replication server (primary will accept connections from backups)
         rs = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         rs.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         rs.bind((self.host, self.replication_port))
         rs.listen(8)
         self.replication_server_sock = rs
-        print(f"[{self.node_id}] replication TCP server listening on {self.replication_port}")
+        self.log.info(f"replication TCP server listening on {self.replication_port}")
         threading.Thread(target=self._accept_replication_connections, daemon=True).start()
 
     def _accept_clients(self):
         while not self.stop_event.is_set():
             try:
                 client_sock, addr = self.server_sock.accept()
-                print(f"[{self.node_id}] client connected {addr}")
+                # acks and broadcasts are small writes: don't let Nagle hold them back
+                client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.log.debug("client connected %s", addr)
                 t = threading.Thread(target=self._handle_client, args=(client_sock,), daemon=True)
                 t.start()
                 self.client_handlers.append(t)
             except Exception as e:
                 if not self.stop_event.is_set():
-                    print(f"[{self.node_id}] accept client error: {e}")
+                    self.log.warning(f"accept client error: {e}")
 
-    def _handle_client(self, sock):
+    def _worker_options(self):
+        # a room lives in one worker, so its rate limits hold as they are; the connection and room caps are split
+        a = self.admission
+        return {'node_id': self.node_id, 'client_queue': self.client_queue, 'overflow': self.overflow,
+                'codec': self.codec.name, 'board_size': self.rooms.n, 'blanks': self.rooms.blanks,
+                'history': self.rooms.history, 'tick_ms': self.pipeline.tick_ms,
+                'durability': self.replicator.durability,
+                'max_clients': -(-a.max_clients // self.worker_count), 'player_rate': a.player_rate,
+                'player_burst': a.player_burst, 'room_rate': a.room_rate, 'room_burst': a.room_burst,
+                'max_queued': a.max_queued, 'max_rooms': -(-a.max_rooms // self.worker_count),
+                'data_dir': self.wal.data_dir if self.wal else None,
+                'fsync_ms': self.wal.fsync_ms if self.wal else 10,
+                'snapshot_every': self.wal.snapshot_every if self.wal else 1000}
+
+    def _handle_client(self, sock, initial=b''):
+        # initial: bytes the front process already read off a handed-over socket (workers.py)
+        reader = FrameReader(sock)
+        if initial:
+            reader.feed(initial)
         try:
             # simple handshake: expect {'type':'HELLO','name':...}
-            hello = recv_msg(sock)
-            if not hello:
-                sock.close()
+            hello = reader.recv()
+        except Exception:
+            hello = None
+        if not isinstance(hello, dict) or not hello:
+            sock.close()
+            return
+        # the room's worker serves players and spectators; a spectator this process can send to a
+        # relay goes on to _client_hello for the REDIRECT
+        if (self.workers and self.is_primary and hello.get('type') == 'HELLO'
+                and not (hello.get('role') == 'spectator' and self._relay_candidates(str(hello.get('room', DEFAULT_ROOM))))
+                and self.workers.hand_off(sock, hello, reader.pending())):
+            return
+        conn = ThreadedOutbound(sock, **self._outbound_options())
+        try:
+            name = self._client_hello(conn, hello)
+            if name is None:
                 return
-            name = hello.get('name','anon')
-            with self.lock:
-                self.clients[sock] = name
-                self.game.scores.setdefault(name, 0)
-            # send initial state (if primary known)
-            # If I'm primary, serve; if backup, redirect client to primary
-            if not self.is_primary:
-                # if we know primary, tell client to connect to primary
-                if self.primary_info:
-                    pid, phost, ptcp, prepl = self.primary_info
-                    send_msg(sock, {'type':'REDIRECT','host':phost,'port':ptcp,'reason':'not_primary'})
-                    sock.close()
-                    return
-                else:
-                    # no primary known yet: accept as spectator
-                    send_msg(sock, {'type':'STATE','state': self.game.as_dict(), 'note':'spectator'})
-            else:
-                send_msg(sock, {'type':'STATE','state': self.game.as_dict(), 'note':'primary'})
-
             while True:
-                msg = recv_msg(sock)
+                msg = reader.recv()
                 if not msg:
                     break
-                mtype = msg.get('type')
-                if mtype == 'MOVE':
-                    r = msg.get('r'); c = msg.get('c'); val = msg.get('val')
-                    player = name
-                    # only primary accepts moves
-                    if not self.is_primary:
-                        send_msg(sock, {'type':'ERROR','error':'not_primary'})
-                        continue
-                    ok, reason = self.game.apply_move(player, r, c, val)
-                    # after applying, broadcast updated state to clients and replicate to backups
-                    state = self.game.as_dict()
-                    if ok:
-                        send_msg(sock, {'type':'MOVE_ACK','result':'ok','state':state})
-                        self._broadcast_state_to_clients(state)
-                        self._replicate_state_to_backups(state)
-                    else:
-                        send_msg(sock, {'type':'MOVE_ACK','result':'fail','reason':reason,'state':state})
-                elif mtype == 'GET_STATE':
-                    send_msg(sock, {'type':'STATE','state': self.game.as_dict()})
-                else:
-                    send_msg(sock, {'type':'ERROR','error':'unknown'})
+                self._handle_client_msg(conn, name, msg)
         except Exception as e:
-            print(f"[{self.node_id}] client handler error: {e}")
+            if not conn.closed:
+                self.log.debug("client handler error: %s", e)
         finally:
-            with self.lock:
-                if sock in self.clients:
-                    del self.clients[sock]
+            self._drop_client(conn)
+
+    def _outbound_options(self):
+        return {'maxlen': self.client_queue, 'policy': self.overflow, 'resync': self._resync_frame}
+
+    def _resync_frame(self, conn):
+        # replaces broadcasts dropped from a slow client's queue
+        return conn.room.state_frame(conn.codec, 'resync')
+
+    # Protocol handling shared by the threaded handler above and the asyncio front end.
+    # conn is an outbound.OutboundQueue: outbound.ThreadedOutbound or aioserver.AsyncClient.
+
+    def _client_hello(self, conn, hello):
+        # returns the player name, or None if the client was redirected away
+        if hello.get('type') == 'ADMIN':
+            self._admin(conn, hello)
+            return None
+        # names end up as score keys and in binary frames: always a str (JSON would turn 12345 into "12345" on backups)
+        name = str(hello.get('name','anon'))
+        room_id = str(hello.get('room', DEFAULT_ROOM))
+        if not room_id or len(room_id) > MAX_ROOM_ID:
+            # ids go out in ROOMS announces and name the room's log directory
+            send_msg(conn, {'type':'ERROR','error':'bad_room','room':room_id[:MAX_ROOM_ID]})
+            return None
+        # HELLO role 'spectator': watch only. Spectators are served by relays (backups holding
+        # the room), which fan out what they replicate, so the primary only carries players.
+        spectator = hello.get('role') == 'spectator'
+        # send initial state (if primary known)
+        # If I'm primary, serve; if backup, redirect client to primary
+        if self.sharding == 'ring':
+            # redirect to the room's owner, unless the room is ours right now
+            room = self.rooms.get(room_id, create=False)
+            owner = self.node_id if room is not None and room.primary else self._room_owner(room_id)
+            relay = spectator and room is not None and self._relays(room)
+            if owner != self.node_id and owner in self.known_nodes and not relay:
+                ohost, otcp, _, _ = self.known_nodes[owner]
+                send_msg(conn, {'type':'REDIRECT','host':ohost,'port':otcp,'reason':'not_owner','room':room_id})
+                return None
+        elif not self.is_primary:
+            # if we know primary, tell client to connect to primary; a relay keeps spectators
+            # of rooms it holds (a room it does not hold would get a board of its own making)
+            relay = spectator and self._relays(None) and self.rooms.get(room_id, create=False) is not None
+            if self.primary_info and not relay:
+                pid, phost, ptcp, prepl = self.primary_info
+                send_msg(conn, {'type':'REDIRECT','host':phost,'port':ptcp,'reason':'not_primary'})
+                return None
+        if spectator:
+            # rooms we hold are on our backups too (new rooms are shipped at creation)
+            nid = self._pick_relay(room_id)
+            if nid is not None:
+                rhost, rtcp, _, _ = self.known_nodes[nid]
+                send_msg(conn, {'type':'REDIRECT','host':rhost,'port':rtcp,'reason':'relay','room':room_id})
+                return None
+        busy = self.admission.admit(len(self.clients))
+        if busy:
+            # shed new connections first: the clients already here keep their service
+            send_msg(conn, {'type':'ERROR','error':'busy','reason':busy})
+            return None
+        conn.name = name
+        # wire codec: first of the client's offered codecs we support (JSON if none offered)
+        conn.codec = negotiate(hello.get('codecs'))
+        # only the room's primary makes new rooms: elsewhere the board would not be the primary's
+        # (with --workers that is the room's worker; its first player's HELLO creates it there)
+        create = self.sharding == 'ring' or (self._serves_id(room_id) and not self.workers)
+        room = self.rooms.get(room_id, create=False)
+        if room is None and create:
+            busy = self.admission.admit_room(len(self.rooms))
+            if busy:
+                send_msg(conn, {'type':'ERROR','error':'busy','reason':busy,'room':room_id})
+                return None
+            room = self.rooms.get(room_id)
+        if room is None:
+            send_msg(conn, {'type':'ERROR','error':'no_room','room':room_id})
+            return None
+        conn.room = room
+        with self.lock:
+            self.clients[conn] = name
+        room.join(conn, name)
+        if not spectator and self._serves(room):
+            # the room's scores change only on its primary, so spectators and replicas don't drift
+            room.game.add_player(name)
+        if self._serves(room):
+            note = 'primary'
+        elif self._relays(room):
+            note = 'relay'
+        else:
+            note = 'spectator'  # no primary known yet: accept as spectator
+        since = hello.get('version')
+        # a reconnecting client sends the last version it saw: if our history still has the moves
+        # after it, it gets RESUME and just those (from `since` itself, so it can check we agree on it)
+        deltas = room.game.deltas_since(since - 1) if type(since) is int and since > 0 else None
+        if deltas:
+            durable = room.snapshot().version
+            deltas = [delta for delta in deltas if delta['version'] <= durable]
+        if not deltas:
+            send_frame(conn, room.state_frame(conn.codec, note, hello=True))
+            return name
+        resume = {'type':'RESUME','room':room_id,'note':note,'codec':conn.codec.name,'version':since}
+        send_frame(conn, b''.join([encode_msg(resume, conn.codec)] +
+                                  [encode_msg(dict(delta, type='MOVE_DELTA'), conn.codec) for delta in deltas]))
+        return name
+
+    def _admin(self, conn, msg):
+        # operator commands, loopback only (profiler.py sends them)
+        peer = getattr(conn, 'peer', None)
+        if isinstance(peer, tuple) and peer[0] not in ('127.0.0.1', '::1', '::ffff:127.0.0.1'):
+            send_msg(conn, {'type':'ERROR','error':'forbidden'})
+            return
+        if msg.get('cmd') != 'profile':
+            send_msg(conn, {'type':'ERROR','error':'unknown'})
+            return
+        prof = self.profiler
+        action = msg.get('action')
+        reply = {'type':'PROFILE'}
+        if action == 'start':
+            prof.start()
+            self.log.info("profiling started")
+        elif action == 'stop':
+            prof.stop()
+            reply['path'] = prof.dump()
+            reply['report'] = prof.report(msg.get('top', 20))
+            self.log.info(f"profiling stopped, stacks in {reply['path']}")
+        elif action == 'report':
+            reply['report'] = prof.report(msg.get('top', 20))
+        elif action == 'dump':
+            reply['path'] = prof.dump()
+        else:
+            send_msg(conn, {'type':'ERROR','error':'unknown'})
+            return
+        reply['enabled'] = prof.enabled
+        send_msg(conn, reply)
+
+    def _handle_client_msg(self, conn, name, msg):
+        if not self.profiler.enabled:
+            return self._client_msg(conn, name, msg)
+        t0 = time.perf_counter()
+        try:
+            self._client_msg(conn, name, msg)
+        finally:
+            self.profiler.record(msg.get('type'), time.perf_counter() - t0)
+
+    def _client_msg(self, conn, name, msg):
+        mtype = msg.get('type')
+        if mtype == 'MOVE':
+            r = msg.get('r'); c = msg.get('c'); val = msg.get('val')
+            move_id = msg.get('id')  # optional; echoed in the MOVE_ACK so clients can pipeline MOVEs
+            room = conn.room
+            # only primary accepts moves
+            if not self._serves(room):
+                send_msg(conn, self._with_id({'type':'ERROR','error':'not_primary'}, move_id), conn.codec)
+                return
+            if not all(type(v) is int for v in (r, c, val)):
+                send_msg(conn, self._with_id({'type':'ERROR','error':'bad_move'}, move_id), conn.codec)
+                return
+            busy = self.admission.check_move(room, name)
+            if busy:
+                # turned away before it can bump the version, be logged, replicated or broadcast
+                reason, retry_ms = busy
+                send_msg(conn, self._with_id({'type':'ERROR','error':'busy','reason':reason,'retry_ms':retry_ms},
+                                             move_id), conn.codec)
+                return
+            self.pipeline.submit(room, conn, name, r, c, val, move_id)
+        elif mtype == 'GET_STATE':
+            # also used by clients to resync after a version gap
+            send_frame(conn, conn.room.state_frame(conn.codec))
+        elif mtype == 'STATS':
+            send_msg(conn, {'type':'STATS','clients': self.client_queue_stats(),
+                            'replication': self.replicator.stats(),
+                            'pipeline': self.pipeline.stats(),
+                            'multicast': self.publisher.stats(),
+                            'admission': self.admission.stats(),
+                            'profiler': self.profiler.stats(),
+                            'workers': self.workers.stats() if self.workers else None}, conn.codec)
+        else:
+            send_msg(conn, {'type':'ERROR','error':'unknown'}, conn.codec)
+
+    def _drop_client(self, conn):
+        with self.lock:
+            if conn in self.clients:
+                del self.clients[conn]
+        room = getattr(conn, 'room', None)
+        if room is not None:
+            room.leave(conn)
+        try:
+            conn.close()
+        except:
+            pass
+
+    def _apply_moves(self, room, batch):
+        # move pipeline callback: apply a room's queued moves as one batch (pipeline.py)
+        if not self._serves(room):
+            # the room moved away while these were queued
+            for conn, _, _, _, _, move_id in batch:
+                self._reply(conn, self._with_id({'type':'ERROR','error':'not_primary'}, move_id))
+            return
+        with room.lock:
+            if not room.in_flight:
+                room.durable_snapshot = room.game.snapshot()
+            room.in_flight += 1
+        t0 = time.perf_counter()
+        results = room.game.apply_moves([(player, r, c, val) for _, player, r, c, val, _ in batch], self.m_lock_wait)
+        elapsed = time.perf_counter() - t0
+        self.m_apply.observe(elapsed)
+        if self.profiler.enabled:
+            self.profiler.record('apply_batch', elapsed)
+        self.m_moves.inc(len(batch))
+        self.m_batches.inc()
+        acks = []
+        deltas = []
+        for (conn, _, _, _, _, move_id), (ok, reason, delta) in zip(batch, results):
+            if ok:
+                ack = {'type':'MOVE_ACK','result':'ok'}
+            else:
+                ack = {'type':'MOVE_ACK','result':'fail','reason':reason}
+            if move_id is not None:
+                ack['id'] = move_id
+            if delta:
+                ack['version'] = delta['version']
+                deltas.append(delta)
+            acks.append((conn, ack))
+        if not deltas:
+            with room.lock:
+                room.in_flight -= 1
+                if not room.in_flight:
+                    room.durable_snapshot = None
+                if room.held_acks is not None:
+                    room.held_acks.extend(acks)
+                    return
+            self._send_acks(acks)
+            return
+        snap = room.game.snapshot()  # the pipeline is the room's only mover: this is the batch's state
+        held = []
+        with room.lock:
+            room.held_acks = held
+        # every version bump (incorrect moves too) is logged and goes out as a delta so peers can spot gaps
+        peers = self._replicate_deltas_to_backups(room, deltas)
+
+        def durable(ok):
+            # MOVE_ACKs and the broadcast wait for the --durability level of the batch's last move
+            if not ok:
+                for conn, ack in acks:
+                    if 'version' in ack:
+                        ack['durable'] = False
+            with room.lock:
+                room.in_flight -= 1
+                room.durable_snapshot = snap if room.in_flight else None
+            self._send_acks(acks)
+            self._broadcast_deltas_to_clients(room, deltas)
+            with room.lock:
+                if room.held_acks is held:
+                    room.held_acks = None
+                self._send_acks(held)
+
+        def logged():
+            # ... and, with --data-dir, for the group commit that puts it on disk
+            self.replicator.after_durable(room.room_id, deltas[-1]['version'], peers,
+                                          self._replica_count(room), durable)
+        if self.wal:
+            for delta in deltas[:-1]:
+                self.wal.append(room, delta)
+            self.wal.append(room, deltas[-1], logged)
+        else:
+            logged()
+
+    def _send_acks(self, acks):
+        # one frame per mover per batch, so a client pipelining MOVEs gets all its acks in one write
+        parts = {}
+        for conn, ack in acks:
+            parts.setdefault(conn, []).append(encode_msg(ack, conn.codec))
+        for conn, frames in parts.items():
             try:
-                sock.close()
-            except:
+                send_frame(conn, b''.join(frames))
+            except ConnectionError:
                 pass
 
-    def _broadcast_state_to_clients(self, state):
-        # send STATE to all connected clients
-        for sock, name in list(self.clients.items()):
-            try:
-                send_msg(sock, {'type':'STATE','state':state})
-            except:
-                # client dead
-                try:
-                    sock.close()
-                except:
-                    pass
-                del self.clients[sock]
+    @staticmethod
+    def _with_id(msg, move_id):
+        if move_id is not None:
+            msg['id'] = move_id
+        return msg
+
+    def _reply(self, conn, msg):
+        try:
+            send_msg(conn, msg, conn.codec)
+        except ConnectionError:
+            pass
+
+    def _broadcast_deltas_to_clients(self, room, deltas):
+        # queue one frame per client for a whole batch: its MOVE_DELTA frames back to back, or the
+        # room's STATE when that is smaller. Full STATE otherwise only goes out on connect/GET_STATE.
+        # Only enqueues: each client's writer does the actual send.
+        start = time.perf_counter()
+        msgs = [dict(delta, type='MOVE_DELTA') for delta in deltas]
+        n = room.game.n
+        frames = {}  # encoded once per codec in use, not once per client
+        for conn in room.members():
+            frame = frames.get(conn.codec.name)
+            if frame is None:
+                t0 = time.perf_counter()
+                frame = b''.join(encode_msg(msg, conn.codec) for msg in msgs)
+                if len(msgs) * 4 >= n * n:
+                    # a STATE at the batch's last version (now durable); clients skip deltas they already have
+                    state = room.state_frame(conn.codec)
+                    if len(state) < len(frame):
+                        frame = state
+                frames[conn.codec.name] = frame
+                self.m_serialize.observe(time.perf_counter() - t0)
+            if not conn.send_frame(frame, droppable=True):
+                # client dead or disconnected for overflowing its queue
+                room.leave(conn)
+        elapsed = time.perf_counter() - start
+        self.m_fanout.observe(elapsed)
+        if self.profiler.enabled:
+            self.profiler.record('broadcast', elapsed)
+
+    def client_queue_stats(self):
+        # per-client outbound queue depth / high-water / drops
+        return [conn.stats() for conn in list(self.clients)]
 
     def _accept_replication_connections(self):
         # This accepts connections but used primarily to let backups connect to primary's replication port.
@@ -226,153 +696,471 @@ class ServerNode:
             try:
                 conn, addr = self.replication_server_sock.accept()
                 # store last bytes to identify node? We'll accept and store socket for primary to write if we are primary
-                print(f"[{self.node_id}] replication incoming connection from {addr}")
+                self.log.info(f"replication incoming connection from {addr}")
                 # For simplicity: store and keep reading in thread if backup -> primary
                 t = threading.Thread(target=self._handle_replication_conn, args=(conn,), daemon=True)
                 t.start()
             except Exception as e:
                 if not self.stop_event.is_set():
-                    print(f"[{self.node_id}] accept replication error: {e}")
+                    self.log.warning(f"accept replication error: {e}")
 
     def _handle_replication_conn(self, conn):
-        # If we are backup connecting to primary's replication port, primary will send STATE updates.
         # If we are primary and a backup connected to us, we keep the socket to write updates out.
-        # First message from connecting peer should be {'type':'REPL_HELLO','node_id':...}
-        hello = recv_msg(conn)
+        # First message from connecting peer should be {'role':'backup','node_id':...}
+        reader = FrameReader(conn, bufsize=65536)
+        hello = reader.recv()
         if not hello:
             conn.close()
             return
         if hello.get('role') == 'backup':
             # backup connected to primary: store socket for writing
             peer_id = hello.get('node_id')
-            print(f"[{self.node_id}] backup {peer_id} connected for replication")
-            self.replication_sockets[peer_id] = conn
-            # keep connection alive
-            try:
-                while True:
-                    time.sleep(1.0)
-                    # optionally read keepalive
-                    # try receiving (non-block) to detect closure
-                    conn.settimeout(0.1)
-                    try:
-                        dat = conn.recv(1)
-                        if not dat:
-                            break
-                        # else ignore
-                    except socket.timeout:
-                        pass
-                    except Exception:
-                        break
-            finally:
-                print(f"[{self.node_id}] replication socket for {peer_id} closed")
-                if peer_id in self.replication_sockets:
-                    del self.replication_sockets[peer_id]
-                try: conn.close()
-                except: pass
-        elif hello.get('role') == 'primary':
-            # we are backup connecting to primary: receive state updates
-            print(f"[{self.node_id}] connected as backup to primary replication socket")
+            self.log.info(f"backup {peer_id} connected for replication")
+
+            # REPL_HELLO carries the version the backup has of each room it holds
+            versions = hello.get('versions') or {}
+            counts = {'moves': 0, 'snapshots': 0}
+
+            def catch_up():
+                # bring every room up to date on connect, deltas after that
+                for room in self.rooms.all():
+                    if self.sharding != 'ring' or (room.primary and peer_id in room.replicas):
+                        yield from self._catch_up(room, versions.get(room.room_id), counts)
+            if self.workers:
+                # the rooms live in the workers (our copies are only current up to a promotion):
+                # each worker catches the backup up on its own rooms
+                peer = self.workers.add_backup(peer_id, conn, versions)
+            else:
+                peer = self.replicator.add_peer(peer_id, conn, catch_up)
+                self.log.info(f"caught up backup {peer_id}: {counts['moves']} moves, "
+                      f"{counts['snapshots']} snapshots")
             try:
                 while True:
-                    msg = recv_msg(conn)
+                    msg = reader.recv()
                     if not msg:
                         break
-                    if msg.get('type') == 'STATE_UPDATE':
-                        state = msg.get('state')
-                        print(f"[{self.node_id}] received state update v{state.get('version')}")
-                        self.game.set_state(state)
-                        # update primary_info from hello meta if present
-                        # continue loop
-            except Exception as e:
-                print(f"[{self.node_id}] replication read error: {e}")
+                    mtype = msg.get('type')
+                    if mtype == 'REPL_ACK':
+                        self.replicator.on_ack(peer, msg)
+                    elif mtype == 'RESYNC' and self.workers:
+                        self.log.info(f"backup {peer_id} resync room {msg.get('room')} from v{msg.get('version')}")
+                        self.workers.resync(peer_id, str(msg.get('room', DEFAULT_ROOM)), msg.get('version'))
+                    elif mtype == 'RESYNC':
+                        room = self.rooms.get(msg.get('room', DEFAULT_ROOM), create=self.sharding != 'ring')
+                        if room is None:
+                            continue
+                        self.log.info(f"backup {peer_id} resync room {room.room_id} from v{msg.get('version')}")
+                        peer.ship_all(self._catch_up(room, msg.get('version')))
+            except Exception:
+                pass
             finally:
-                try: conn.close()
-                except: pass
+                self.log.info(f"replication socket for {peer_id} closed")
+                self.replicator.remove_peer(peer)
+        elif hello.get('role') == 'primary':
+            # a primary dialled us: receive state updates
+            self._receive_replication(conn, reader)
         else:
             conn.close()
 
-    def _replicate_state_to_backups(self, state):
-        # primary writes full state to each connected backup
-        for nid, sock in list(self.replication_sockets.items()):
+    def _receive_replication(self, conn, reader=None, source=None):
+        # backup side of a replication connection: apply snapshots and deltas from the primary
+        # (source: its node id, ring mode)
+        self.log.info("connected as backup to primary replication socket")
+        reader = reader or FrameReader(conn, bufsize=65536)
+        count = 0  # records received on this link
+        acked = {}  # room -> version, applied since our last REPL_ACK
+        partial = {}  # room -> (STATE_BEGIN, rows so far) while a big snapshot streams in
+        fanout = {}  # room -> deltas applied this burst, for the spectators we relay to
+        try:
+            while True:
+                if acked and not reader.has_frame():
+                    # end of a burst: one cumulative ack for everything applied so far
+                    send_msg(conn, {'type':'REPL_ACK','count':count,'versions':acked})
+                    acked = {}
+                    for room, deltas in fanout.items():
+                        self._broadcast_deltas_to_clients(room, deltas)
+                    fanout = {}
+                msg = reader.recv()
+                if not msg:
+                    break
+                count += 1
+                mtype = msg.get('type')
+                room_id = msg.get('room', DEFAULT_ROOM)
+                if mtype == 'STATE_UPDATE':
+                    acked[room_id] = self._apply_snapshot(room_id, msg['state'], msg.get('perm'), source,
+                                                          msg.get('handoff', False))
+                elif mtype == 'STATE_BEGIN':
+                    partial[room_id] = (msg, [])
+                elif mtype == 'STATE_ROWS':
+                    begin, rows = partial.get(room_id, (None, None))
+                    if begin is None or begin['state']['version'] != msg.get('version'):
+                        continue
+                    rows.extend(msg['rows'])
+                    if len(rows) == begin['state']['n']:
+                        del partial[room_id]
+                        state = dict(begin['state'], board=rows)
+                        acked[room_id] = self._apply_snapshot(room_id, state, begin.get('perm'), source)
+                elif mtype == 'MOVE_DELTA':
+                    room = self.rooms.get(room_id, create=False)
+                    if room is not None and self._serves(room):
+                        acked[room_id] = room.game.version
+                        continue  # stale delta from a room's previous owner
+                    before = room.game.version if room else -1
+                    if room is None or not room.game.apply_delta(msg):
+                        # fell behind (or never saw this room): ask the primary for a full snapshot
+                        send_msg(conn, {'type':'RESYNC','room':room_id,'version':before})
+                    else:
+                        if room.game.version > before:
+                            if self.wal:
+                                self.wal.append(room, msg)
+                            if room.clients:
+                                fanout.setdefault(room, []).append(msg)
+                        acked[room_id] = room.game.version
+        except Exception as e:
+            self.log.warning(f"replication read error: {e}")
+        finally:
+            for key, sock in list(self.backup_connections.items()):
+                if sock is conn:
+                    del self.backup_connections[key]
+            try: conn.close()
+            except: pass
+
+    def _apply_snapshot(self, room_id, state, perm, source=None, handoff=False):
+        # backup side: replace a room's state wholesale; returns the new version
+        self.log.debug("received state snapshot room %s v%s", room_id, state.get('version'))
+        room = self.rooms.get(room_id, create=False)
+        if room is not None and self._serves(room):
+            # ours: a late snapshot from the room's previous owner must not undo moves we took
+            return room.game.version
+        if source is not None:
+            # whoever replicates a room to us owns it (before a ROOMS announce may have said so)
+            self.room_owners[room_id] = source
+        if room is None:
+            room = self.rooms.get(room_id)
+        room.game.set_state(state, perm)
+        if self.wal:
+            self.wal.snapshot(room)
+        for conn in room.members():
+            # spectators relayed from here: the board was replaced, not moved forward
+            if not conn.send_frame(room.state_frame(conn.codec), droppable=True):
+                room.leave(conn)
+        if handoff and self.sharding == 'ring' and not room.primary and self.ring.owner(room_id) == self.node_id:
+            # the previous owner stopped taking moves before sending this: the room is ours now
+            self._take_room(room)
+        if self.sharding == 'ring' and room.primary:
+            # handed off to us: our own backups need the real state, not our fresh board
+            self._replicate_frame(encode_msg(self._state_update(room), self.codec), room.replicas)
+        return room.game.version
+
+    def _catch_up(self, room, version, counts=None):
+        # frames that bring a backup holding `version` of room up to date: just the missed
+        # deltas while history still covers them, otherwise a full snapshot
+        deltas = room.game.deltas_since(version) if version is not None else None
+        if deltas is not None:
+            if counts is not None:
+                counts['moves'] += len(deltas)
+            for delta in deltas:
+                yield encode_msg(dict(delta, type='MOVE_DELTA', room=room.room_id), self.codec)
+            return
+        if counts is not None:
+            counts['snapshots'] += 1
+        snap = room.game.as_dict()
+        n = snap['n']
+        if n * n <= SNAPSHOT_CHUNK_CELLS:
+            yield encode_msg(self._state_update(room), self.codec)
+            return
+        # big board: header first, then the rows a chunk at a time, so no frame (or encode)
+        # grows with the whole board
+        header = {k: v for k, v in snap.items() if k != 'board'}
+        yield encode_msg({'type':'STATE_BEGIN','room':room.room_id,'state':header,
+                          'perm':room.game.perm}, self.codec)
+        step = max(1, SNAPSHOT_CHUNK_CELLS // n)
+        for row in range(0, n, step):
+            yield encode_msg({'type':'STATE_ROWS','room':room.room_id,'version':snap['version'],
+                              'row':row,'rows':snap['board'][row:row + step]}, self.codec)
+
+    def _serves(self, room):
+        # does this node accept moves for room?
+        return room.primary if self.sharding == 'ring' else self.is_primary
+
+    def _serves_id(self, room_id):
+        if self.sharding == 'ring':
+            room = self.rooms.get(room_id, create=False)
+            return room is not None and room.primary
+        return self.is_primary
+
+    def _relays(self, room):
+        # a backup relays a room to spectators while its replication link from the room's primary is up
+        # (room None: any room, single mode)
+        if self.sharding == 'ring':
+            return room is not None and not room.primary and self._room_owner(room.room_id) in self.backup_connections
+        return not self.is_primary and self.backup_connections.get('primary') is not None
+
+    def _relay_candidates(self, room_id):
+        # connected backups holding room_id, which can take its spectators
+        room = self.rooms.get(room_id, create=False)
+        if room is None or not self._serves_id(room_id):
+            return []
+        candidates = room.replicas if self.sharding == 'ring' else sorted(self.replicator.peers)
+        return [nid for nid in candidates if nid in self.replicator.peers and nid in self.known_nodes]
+
+    def _pick_relay(self, room_id):
+        # a connected backup of the room to send a spectator to, round robin; None: serve it here
+        candidates = self._relay_candidates(room_id)
+        if not candidates:
+            return None
+        return candidates[next(self._relay_turn) % len(candidates)]
+
+    def _replica_count(self, room):
+        # backups a room should have: its ring replicas, or every other live node in single mode
+        if self.sharding == 'ring':
+            return len(room.replicas)
+        return sum(1 for nid in list(self.known_nodes) if nid != self.node_id)
+
+    def _replica_targets(self, room):
+        return room.replicas if self.sharding == 'ring' else None
+
+    def _recover(self):
+        for room_id, state, perm, deltas in self.wal.recover():
+            room = self.rooms.get(room_id)
+            applied = replay(room.game, state, perm, deltas)
+            self.log.info(f"recovered room {room_id} at v{room.game.version} ({applied} logged moves)")
+
+    def _room_owner(self, room_id):
+        # the node that announced the room (it may still hold it during a handoff), else its ring owner
+        nid = self.room_owners.get(room_id)
+        if nid is not None and nid != self.node_id and nid in self.known_nodes:
+            return nid
+        return self.ring.owner(room_id)
+
+    def _room_created(self, room):
+        if self.wal:
+            self.wal.attach(room)
+        if self.sharding == 'ring':
+            owners = self.ring.owners(room.room_id, 1 + self.ring_replicas)
+            # not while the room's previous owner is up: it hands the room over (_apply_snapshot)
+            room.primary = owners[0] == self.node_id and self._room_owner(room.room_id) == self.node_id
+            room.replicas = owners[1:] if room.primary else []
+            if room.primary:
+                self._announce_rooms([room.room_id])
+        # a primary announces new rooms right away, so a backup never holds a board of its own making
+        # (with --workers the room's worker makes the board and ships it through us)
+        if not self._serves(room) or self.workers:
+            return
+        self._replicate_frame(encode_msg(self._state_update(room), self.codec), self._replica_targets(room))
+
+    def _state_update(self, room):
+        # backups also get the solution permutations so they can validate moves after a failover
+        return {'type':'STATE_UPDATE','room':room.room_id,'state': room.game.as_dict(),
+                'perm': room.game.perm}
+
+    def _replicate_deltas_to_backups(self, room, deltas):
+        # primary ships a batch of deltas to its backups as one write, each tagged with its room;
+        # returns the peers it went to
+        t0 = time.perf_counter()
+        frame = self._delta_frames(room, deltas)
+        peers = self.replicator.ship(frame, self._replica_targets(room), len(deltas))
+        if self.profiler.enabled:
+            self.profiler.record('replicate', time.perf_counter() - t0)
+        return peers
+
+    def _delta_frames(self, room, deltas):
+        t0 = time.perf_counter()
+        frame = b''.join(encode_msg(dict(delta, type='MOVE_DELTA', room=room.room_id), self.codec)
+                         for delta in deltas)
+        self.m_serialize.observe(time.perf_counter() - t0)
+        return frame
+
+    def _replicate_frame(self, frame, targets=None):
+        # targets: node ids to send to, or None for every connected backup
+        return self.replicator.ship(frame, targets)
+
+    def _send_to_peer(self, nid, frame):
+        # returns False if nid has no live replication connection to us
+        return bool(self.replicator.ship(frame, [nid]))
+
+    def _ring_maintainer(self):
+        # ring sharding: rebuild the ring from live membership and move the rooms whose placement changed
+        pending = False
+        while not self.stop_event.is_set():
+            members = set(self.known_nodes) | {self.node_id}
+            changed = self.ring.set_nodes(members)
+            if changed:
+                self.log.info(f"ring members now {sorted(members)}")
+            if changed or pending:
+                pending = False
+                for room in self.rooms.all():
+                    pending |= self._place_room(room)
+            time.sleep(self.heartbeat_interval)
+
+    def _place_room(self, room):
+        # returns True while a handoff is still waiting for the new owner to connect
+        owners = self.ring.owners(room.room_id, 1 + self.ring_replicas)
+        if owners[0] == self.node_id:
+            if not room.primary:
+                if self._room_owner(room.room_id) != self.node_id:
+                    # its previous owner is up and may still be taking moves: it stops, then hands
+                    # us its final state (_apply_snapshot). Until then HELLOs are sent to it.
+                    return True
+                # the previous owner left: our backup copy is all there is
+                self._take_room(room)
+                return False
+            added = [nid for nid in owners[1:] if nid not in room.replicas]
+            room.replicas = owners[1:]
+            if added:
+                # new backups without a connection yet get the snapshot when they connect
+                self._replicate_frame(encode_msg(self._state_update(room), self.codec), added)
+            return False
+        room.replicas = []
+        if room.primary:
+            # hand off: stop taking moves, ship the snapshot to the new owner, send our players there
+            room.primary = False
+            if not self._send_to_peer(owners[0], encode_msg(dict(self._state_update(room), handoff=True), self.codec)):
+                room.primary = True
+                return True
+            self.room_owners[room.room_id] = owners[0]
+            self.log.info(f"handed room {room.room_id} to node {owners[0]} at v{room.game.version}")
+            self._redirect_room_clients(room, owners[0])
+        elif self.node_id not in owners:
+            # no longer a backup for this room: its spectators go to the owner, which finds them a relay
+            if room.clients:
+                self._redirect_room_clients(room, owners[0])
+            self.rooms.remove(room.room_id)
+            if self.wal:
+                self.wal.detach(room.room_id)
+        return False
+
+    def _take_room(self, room):
+        room.primary = True
+        room.replicas = self.ring.owners(room.room_id, 1 + self.ring_replicas)[1:]
+        self.room_owners[room.room_id] = self.node_id
+        self.log.info(f"taking over room {room.room_id} at v{room.game.version}")
+        self._announce_rooms([room.room_id])
+
+    def _redirect_room_clients(self, room, nid):
+        host, tcp, _, _ = self.known_nodes.get(nid, (None, None, None, 0))
+        for conn in room.members():
             try:
-                send_msg(sock, {'type':'STATE_UPDATE','state':state})
-            except Exception as e:
-                print(f"[{self.node_id}] replication write to {nid} failed: {e}")
-                try:
-                    sock.close()
-                except:
-                    pass
-                del self.replication_sockets[nid]
-
-    def _start_election_if_needed(self):
-        # simple bully: if we are max id among known nodes+us, become primary
-        highest = self.node_id
-        for nid in self.known_nodes.keys():
-            if nid > highest:
-                highest = nid
-        if highest == self.node_id:
-            # become primary
-            self._become_primary()
-        else:
-            # else wait for primary announce; if none after timeout, start election
-            print(f"[{self.node_id}] higher node exists -> waiting for primary")
-            # wait for primary announce for a while
-            t0 = time.time()
-            while time.time() - t0 < 3.0:
-                if self.primary_info:
-                    return
-                time.sleep(0.2)
-            # if still none, broadcast ELECTION
-            send_multicast_message({'type':'ELECTION','node_id':self.node_id})
-            # wait short for OK messages
-            t1 = time.time()
-            got_ok = False
-            while time.time() - t1 < 2.0:
-                # during this time, mcast listener may receive ELECTION_OK and spawn higher election
-                time.sleep(0.1)
-            # after waiting, if no primary_info, check again
-            if not self.primary_info:
-                # determine again
-                highest = self.node_id
-                for nid in self.known_nodes.keys():
-                    if nid > highest:
-                        highest = nid
-                if highest == self.node_id:
-                    self._become_primary()
+                send_msg(conn, {'type':'REDIRECT','host':host,'port':tcp,'reason':'room_moved','room':room.room_id})
+            except Exception:
+                pass
+            self._drop_client(conn)
+
+    def _elector(self):
+        # runs an election whenever one is asked for: at start, when the primary is suspected,
+        # or when a lower node calls one
+        while not self.stop_event.is_set():
+            self._election_needed.wait()
+            self._election_needed.clear()
+            self._run_election()
+
+    def _run_election(self):
+        # bully: the highest live node leads, but a live primary is never pre-empted
+        while not self.stop_event.is_set() and not self.is_primary:
+            info = self.primary_info
+            if info and info[0] in self.known_nodes:
+                return
+            higher = [nid for nid in list(self.known_nodes) if nid > self.node_id]
+            if not higher:
+                self._become_primary()
+                return
+            # a higher node should lead: ask, and wait for its PRIMARY (or for it to be suspected)
+            self.log.info("higher node exists -> waiting for primary")
+            self._primary_seen.clear()
+            self.publisher.send({'type':'ELECTION','node_id':self.node_id})
+            if self._primary_seen.wait(self.election_timeout):
+                return
 
     def _become_primary(self):
         self.is_primary = True
         self.primary_info = (self.node_id, '127.0.0.1', self.tcp_port, self.replication_port)
-        print(f"[{self.node_id}] I am becoming primary")
-        send_multicast_message({'type':'PRIMARY','node_id':self.node_id,'tcp_port':self.tcp_port,'replication_port':self.replication_port})
-        # accept backup replication connections: backups will connect to my replication port
-        # Additionally, attempt to connect to other nodes' replication ports? Not necessary.
-        # If backups existed and previously connected to me, replication sockets will be populated in _accept_replication_connections.
-        # Nothing else to do special here.
-
-    def connect_to_primary_for_replication(self, primary_host, primary_repl_port):
+        self.log.info("I am becoming primary")
+        if self.workers:
+            self.workers.promote()
+        self._announce_primary()
+        # backups connect to my replication port; their sockets are picked up in _accept_replication_connections
+
+    def _announce_primary(self):
+        self.publisher.send(self._primary_msg())
+
+    def _primary_msg(self):
+        return {'type':'PRIMARY','node_id':self.node_id,'tcp_port':self.tcp_port,'replication_port':self.replication_port}
+
+    def _primary_announced(self, nid, host, tcp, repl):
+        if nid == self.node_id:
+            return
+        if self.is_primary:
+            if nid < self.node_id:
+                # two primaries after a partition: the higher id keeps the role
+                self._announce_primary()
+                return
+            self.log.info(f"stepping down for primary {nid}")
+            self.is_primary = False
+            if self.workers:
+                self.workers.demote()
+        self._primary_seen.set()
+        info = (nid, host, tcp, repl)
+        if info == self.primary_info:
+            return  # the primary repeats its announce with every heartbeat
+        self.primary_info = info
+        self.log.info(f"saw primary announce: {self.primary_info}")
+        if self.sharding != 'ring':
+            threading.Thread(target=self.follow_primary, daemon=True).start()
+
+    def follow_primary(self):
+        # backup: keep one replication connection, to the current primary
+        with self._follow_lock:
+            info = self.primary_info
+            if self.is_primary or not info:
+                return
+            pid, phost, ptcp, prepl = info
+            old = self.backup_connections.get('primary')
+            if old is not None:
+                if self._following == pid:
+                    return
+                try: old.close()  # the old primary's link; its reader thread cleans up
+                except: pass
+            self._following = pid
+            self.connect_to_primary_for_replication(phost, prepl)
+
+    def connect_to_primary_for_replication(self, primary_host, primary_repl_port, key='primary'):
         # called when this node is backup: connect to primary's replication port and send REPL_HELLO role=backup
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((primary_host, primary_repl_port))
-            send_msg(s, {'role':'backup','node_id':self.node_id})
-            # store socket so primary can write? No: primary stores incoming sockets. Here backup must listen for incoming STATE_UPDATE messages.
-            # Start background thread to receive state updates from primary
-            t = threading.Thread(target=self._handle_replication_conn, args=(s,), daemon=True)
+            versions = {room.room_id: room.game.version for room in self.rooms.all()}
+            send_msg(s, {'type':'REPL_HELLO','role':'backup','node_id':self.node_id,'versions':versions})
+            # primary stores our socket, catches us up (missed deltas or snapshots), then streams MOVE_DELTAs
+            self.backup_connections[key] = s
+            t = threading.Thread(target=self._receive_replication, args=(s, None, None if key == 'primary' else key),
+                                 daemon=True)
             t.start()
-            self.backup_connections['primary'] = s
         except Exception as e:
-            print(f"[{self.node_id}] failed to connect to primary repl {primary_host}:{primary_repl_port} -> {e}")
+            self.log.warning(f"failed to connect to primary repl {primary_host}:{primary_repl_port} -> {e}")
 
     def stop(self):
         self.stop_event.set()
+        self.pipeline.stop()
+        if self.profiler.enabled:
+            self.profiler.stop()
+            path = self.profiler.dump()
+            self.log.info(f"{self.profiler.report()}\ncollapsed stacks in {path}")
+        if self.wal:
+            self.wal.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.workers:
+            self.workers.stop()
         self.mcast_running = False
         try:
+            self.publisher.close()
             self.mcast_sock.close()
         except:
             pass
         try:
-            if self.server_sock:
+            if self.frontend:
+                self.frontend.stop()
+            elif self.server_sock:
                 self.server_sock.close()
         except:
             pass
@@ -387,18 +1175,100 @@ if __name__ == '__main__':
     parser.add_argument('--id', required=True, type=int, help='numeric node id')
     parser.add_argument('--tcp-port', type=int, default=9001)
     parser.add_argument('--replication-port', type=int, default=9101)
+    parser.add_argument('--io', choices=['threads','asyncio'], default='threads',
+                        help='client I/O model: thread per client or a single asyncio event loop')
+    parser.add_argument('--backlog', type=int, default=128, help='listen backlog for the client port')
+    parser.add_argument('--accept-batch', type=int, default=64,
+                        help='max clients accepted per event-loop iteration (asyncio mode)')
+    parser.add_argument('--client-queue', type=int, default=256,
+                        help='max outbound frames queued per client before the overflow policy applies')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default='drop_stale',
+                        help='slow client policy: drop stale broadcasts for a fresh STATE, or disconnect')
+    parser.add_argument('--codec', choices=sorted(CODECS), default='json',
+                        help='encoding for heartbeats and replication (clients negotiate their own)')
+    parser.add_argument('--board-size', type=int, default=3, help='n for the n x n board of each new room')
+    parser.add_argument('--blanks', type=int, default=3, help='blank cells in each new room')
+    parser.add_argument('--sharding', choices=['single','ring'], default='single',
+                        help='single elected primary for all rooms, or rooms spread over nodes by consistent hashing')
+    parser.add_argument('--replicas', type=int, default=1, help='backups per room (--sharding ring)')
+    parser.add_argument('--data-dir', default=None, help='keep a write-ahead move log and snapshots here')
+    parser.add_argument('--fsync-ms', type=int, default=10,
+                        help='group-commit interval for the move log (0 = fsync as soon as moves are logged, <0 = never)')
+    parser.add_argument('--durability', choices=DURABILITY_LEVELS, default='async',
+                        help='when MOVE_ACK is sent: right away, after one backup acks, or after a quorum')
+    parser.add_argument('--ack-timeout-ms', type=int, default=1000,
+                        help='ack a move as durable:false if its backups have not acked it by then')
+    parser.add_argument('--history', type=int, default=1024,
+                        help='recent moves kept per room to catch up a reconnecting backup without a snapshot')
+    parser.add_argument('--tick-ms', type=int, default=0,
+                        help='apply queued moves per room once per tick (0 = as they arrive, batching what queued meanwhile)')
+    parser.add_argument('--heartbeat-ms', type=float, default=HEARTBEAT_INTERVAL * 1000,
+                        help='multicast heartbeat interval')
+    parser.add_argument('--phi-threshold', type=float, default=PHI_THRESHOLD,
+                        help='failure detector suspicion level (higher = slower but fewer false alarms)')
+    parser.add_argument('--election-timeout-ms', type=float, default=ELECTION_TIMEOUT * 1000,
+                        help='how long to wait for a higher node to announce itself before calling the election again')
+    parser.add_argument('--snapshot-every', type=int, default=1000,
+                        help='moves per room between snapshots (the log is truncated at each one)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--log-level', choices=['debug','info','warning','error'], default='info')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='serve rooms from N worker processes while primary (0 = in this process)')
+    parser.add_argument('--max-clients', type=int, default=0,
+                        help='turn away HELLOs with ERROR busy past this many clients (0 = no cap)')
+    parser.add_argument('--player-rate', type=float, default=0.0,
+                        help='MOVEs per second per player and room before ERROR busy (0 = no limit)')
+    parser.add_argument('--player-burst', type=int, default=0, help='player bucket size (default: one second of --player-rate)')
+    parser.add_argument('--room-rate', type=float, default=0.0,
+                        help='MOVEs per second per room across its players (0 = no limit)')
+    parser.add_argument('--room-burst', type=int, default=0, help='room bucket size (default: one second of --room-rate)')
+    parser.add_argument('--max-queued', type=int, default=0,
+                        help='shed MOVEs for a room with this many already waiting to be applied (0 = no limit)')
+    parser.add_argument('--max-rooms', type=int, default=MAX_ROOMS,
+                        help='rooms HELLOs may create on this node before ERROR busy (0 = no cap)')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile from the start (also toggled at runtime: python3 profiler.py start|stop)')
+    parser.add_argument('--profile-dir', default='.', help='where collapsed stack files go')
+    parser.add_argument('--profile-interval-ms', type=float, default=5.0, help='stack sampling interval')
+    parser.add_argument('--profile-idle', action='store_true',
+                        help='also sample threads parked in socket reads and waits (wall clock profile)')
     args = parser.parse_args()
+    if args.workers and (args.sharding != 'single' or args.io != 'threads'):
+        parser.error('--workers needs --sharding single and --io threads')
+    if args.workers and args.metrics_port is not None:
+        # the moves, clients and queues live in the workers, which nothing would scrape
+        parser.error('--metrics-port is not supported with --workers')
 
-    node = ServerNode(node_id=args.id, tcp_port=args.tcp_port, replication_port=args.replication_port)
+    logging.basicConfig(level=args.log_level.upper(), format='%(message)s', stream=sys.stdout)
+    if args.io == 'asyncio':
+        raise_fd_limit()
+    node = ServerNode(node_id=args.id, tcp_port=args.tcp_port, replication_port=args.replication_port,
+                      io_mode=args.io, backlog=args.backlog, accept_batch=args.accept_batch,
+                      client_queue=args.client_queue, overflow=args.overflow, codec=args.codec,
+                      board_size=args.board_size, blanks=args.blanks,
+                      sharding=args.sharding, replicas=args.replicas,
+                      data_dir=args.data_dir, fsync_ms=args.fsync_ms, snapshot_every=args.snapshot_every,
+                      durability=args.durability, ack_timeout_ms=args.ack_timeout_ms, history=args.history,
+                      tick_ms=args.tick_ms, heartbeat_ms=args.heartbeat_ms, phi_threshold=args.phi_threshold,
+                      election_timeout_ms=args.election_timeout_ms, metrics_port=args.metrics_port,
+                      workers=args.workers, max_clients=args.max_clients, player_rate=args.player_rate,
+                      player_burst=args.player_burst, room_rate=args.room_rate, room_burst=args.room_burst,
+                      max_queued=args.max_queued, max_rooms=args.max_rooms, profile=args.profile, profile_dir=args.profile_dir,
+                      profile_interval_ms=args.profile_interval_ms, profile_idle=args.profile_idle)
     try:
         node.start()
         print("server running. press Ctrl+C to stop")
         while True:
             time.sleep(1.0)
-            # if backup and primary_info known, and not connected for replication, try to connect
-            if not node.is_primary and node.primary_info and 'primary' not in node.backup_connections:
-                pid, phost, ptcp, prepl = node.primary_info
-                node.connect_to_primary_for_replication(phost, prepl)
+            if node.sharding == 'ring':
+                # replication mesh: subscribe to every live peer; each one streams us the rooms we back up
+                for nid, (host, tcp, repl, _) in list(node.known_nodes.items()):
+                    if nid != node.node_id and repl and nid not in node.backup_connections:
+                        node.connect_to_primary_for_replication(host, repl, key=nid)
+                continue
+            # backup: reconnect to the primary if our replication link dropped
+            node.follow_primary()
     except KeyboardInterrupt:
         print("shutting down")
         node.stop()
@@ -1,8 +1,13 @@
 
+import logging
 import socket
 import struct
-import json
 import threading
+from codec import JSON, decode as decode_payload
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
 
 MCAST_GRP = '224.1.1.1'
 MCAST_PORT = 5007
@@ -18,32 +23,240 @@ def create_multicast_socket(bind=True, reuse=True):
     s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
     return s
 
-def send_multicast_message(msg_obj, addr=MCAST_ADDR):
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-    data = json.dumps(msg_obj).encode('utf-8')
-    s.sendto(data, addr)
-    s.close()
-
-# Simple length-prefixed JSON framing for TCP
-def send_msg(sock, obj):
-    data = json.dumps(obj).encode('utf-8')
-    length = len(data)
-    sock.sendall(length.to_bytes(4, 'big') + data)
-
-def recv_msg(sock):
-    # read 4 bytes length
-    buf = b''
-    while len(buf) < 4:
-        chunk = sock.recv(4 - len(buf))
-        if not chunk:
+class NodeLog(logging.LoggerAdapter):
+    # "[node_id] message" lines on the 'puzzle' logger (server.py --log-level).
+    # Per-message and per-connection lines use debug, which is off by default and costs
+    # only a level check when disabled: pass the arguments separately instead of an f-string.
+    def process(self, msg, kwargs):
+        return f"[{self.extra['node_id']}] {msg}", kwargs
+
+def node_logger(node_id):
+    return NodeLog(logging.getLogger('puzzle'), {'node_id': node_id})
+
+class MulticastPublisher:
+    # One long-lived multicast sender socket per node, shared by all of its threads.
+    # send() puts messages out right away; queue() holds them until the next flush(),
+    # which the heartbeat sender calls once per interval. Either way, messages that go
+    # out together are packed into one BATCH datagram while they fit in max_datagram.
+    def __init__(self, addr=MCAST_ADDR, codec=JSON, ttl=2, max_datagram=1400, batch=True):
+        self.addr = addr
+        self.codec = codec
+        self.max_datagram = max_datagram
+        self.batch = batch  # False: one datagram per message
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.packets = 0
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def send(self, *msgs):
+        with self._lock:
+            self._send_locked(msgs)
+
+    def queue(self, msg):
+        with self._lock:
+            self._pending.append(msg)
+
+    def flush(self, *msgs):
+        # everything queued, plus msgs, in as few datagrams as fit
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._send_locked(pending + list(msgs))
+
+    def _send_locked(self, msgs):
+        group = []
+        size = 32  # BATCH envelope
+        for msg in msgs:
+            data = self.codec.encode(msg)
+            if group and (not self.batch or size + len(data) + 2 > self.max_datagram):
+                self._send_group(group)
+                group = []
+                size = 32
+            group.append((msg, data))
+            size += len(data) + 2
+        if group:
+            self._send_group(group)
+
+    def _send_group(self, group):
+        if len(group) == 1:
+            data = group[0][1]
+        else:
+            data = self.codec.encode({'type':'BATCH','msgs':[msg for msg, _ in group]})
+        try:
+            self.sock.sendto(data, self.addr)
+        except OSError:
+            self.errors += 1
+            return
+        self.packets += 1
+        self.messages += len(group)
+        self.bytes += len(data)
+
+    def stats(self):
+        return {'packets': self.packets, 'messages': self.messages, 'bytes': self.bytes,
+                'errors': self.errors}
+
+    def close(self):
+        self.sock.close()
+
+# Simple length-prefixed framing for TCP; payload is JSON or a binary record (see codec.py)
+def encode_msg(obj, codec=JSON):
+    # serialize + length-prefix once; the returned frame can be written to any number of sockets
+    data = codec.encode(obj)
+    return len(data).to_bytes(4, 'big') + data
+
+def send_msg(sock, obj, codec=JSON):
+    sock.sendall(encode_msg(obj, codec))
+
+def send_frame(sock, frame):
+    sock.sendall(frame)
+
+# largest frame we accept; a bogus length prefix must not make us allocate gigabytes
+MAX_FRAME = 16 * 1024 * 1024
+
+class FrameTooLarge(ValueError):
+    pass
+
+def decode_msg(data):
+    # data may be bytes, a bytearray or a memoryview into a receive buffer;
+    # JSON vs binary is detected from the first byte
+    return decode_payload(data)
+
+def _recv_exact(sock, view):
+    got = 0
+    while got < len(view):
+        n = sock.recv_into(view[got:])
+        if not n:
+            return False
+        got += n
+    return True
+
+def recv_msg(sock, max_frame=MAX_FRAME):
+    # one-shot read of a single frame (reads exactly one frame, never past it).
+    # Long-lived connections should use FrameReader instead.
+    header = bytearray(4)
+    if not _recv_exact(sock, memoryview(header)):
+        return None
+    length = int.from_bytes(header, 'big')
+    if length > max_frame:
+        raise FrameTooLarge(f"frame of {length} bytes exceeds limit {max_frame}")
+    data = bytearray(length)
+    if not _recv_exact(sock, memoryview(data)):
+        return None
+    return decode_msg(data)
+
+class FrameReader:
+    # Buffered reader for length-prefixed frames.
+    # Reads big chunks with recv_into into one reusable bytearray and parses every
+    # complete frame in it; frames are decoded straight from a memoryview of the buffer.
+    # Socket mode: FrameReader(sock).recv() is a drop-in for recv_msg(sock).
+    # Feed mode (asyncio): feed(data) then drain messages().
+    # The buffer starts small (one per client connection adds up at 10k sockets) and
+    # _make_room doubles it when a frame (or a fed chunk) does not fit; links that carry bulk
+    # traffic (replication) ask for a big one up front.
+    def __init__(self, sock=None, bufsize=4096, max_frame=MAX_FRAME, decode=decode_msg):
+        self.sock = sock
+        self.max_frame = max_frame
+        self.decode = decode
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0  # first unparsed byte
+        self._end = 0    # end of received data
+
+    def recv(self):
+        # next message, or None on EOF
+        while True:
+            msg = self._parse_one()
+            if msg is not None:
+                return msg
+            self._make_room()
+            n = self.sock.recv_into(self._view[self._end:])
+            if not n:
+                return None
+            self._end += n
+
+    def feed(self, data):
+        # for transports that hand us bytes (asyncio streams) instead of a socket
+        n = len(data)
+        self._make_room(n)
+        self._view[self._end:self._end + n] = data
+        self._end += n
+
+    def messages(self):
+        # every complete message currently buffered
+        out = []
+        while True:
+            msg = self._parse_one()
+            if msg is None:
+                return out
+            out.append(msg)
+
+    def pending(self):
+        # bytes received but not parsed yet (e.g. to hand a connection to another process)
+        return bytes(self._view[self._start:self._end])
+
+    def has_frame(self):
+        # is another complete frame already buffered (the next recv() will not block)?
+        length = self._frame_length()
+        return length is not None and self._end - self._start >= 4 + length
+
+    def _frame_length(self):
+        if self._end - self._start < 4:
             return None
-        buf += chunk
-    length = int.from_bytes(buf, 'big')
-    data = b''
-    while len(data) < length:
-        chunk = sock.recv(length - len(data))
-        if not chunk:
+        length = int.from_bytes(self._view[self._start:self._start + 4], 'big')
+        if length > self.max_frame:
+            raise FrameTooLarge(f"frame of {length} bytes exceeds limit {self.max_frame}")
+        return length
+
+    def _parse_one(self):
+        length = self._frame_length()
+        if length is None or self._end - self._start < 4 + length:
             return None
-        data += chunk
-    return json.loads(data.decode('utf-8'))
+        body = self._start + 4
+        frame = self._view[body:body + length]
+        try:
+            msg = self.decode(frame)
+        finally:
+            frame.release()
+        self._start = body + length
+        if self._start == self._end:
+            self._start = self._end = 0
+        return msg
+
+    def _make_room(self, extra=1):
+        # make sure the buffer can take at least `extra` more bytes, and the whole
+        # pending frame once its length is known
+        pending = self._end - self._start
+        length = self._frame_length()
+        need = max(pending + extra, 4 + length if length is not None else 0)
+        if self._start + need <= len(self._buf):
+            return
+        if need <= len(self._buf):
+            # compact: move the partial frame to the front
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            size = len(self._buf)
+            while size < need:
+                size *= 2
+            buf = bytearray(size)
+            buf[:pending] = self._view[self._start:self._end]
+            self._view.release()
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start, self._end = 0, pending
+
+def raise_fd_limit():
+    # lift the soft open-files limit up to the hard limit so one process can hold 10k+ sockets
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        target = hard if hard != resource.RLIM_INFINITY else max(soft, 65536)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
@@ -0,0 +1,230 @@
+import mmap
+import os
+import struct
+import threading
+from urllib.parse import quote, unquote
+from codec import JSON, BINARY
+from utils import encode_msg, decode_msg
+
+# Write-ahead move log (server.py --data-dir DIR).
+#
+# One directory per room under DIR:
+#   snapshot - compact snapshot: a binary STATE_UPDATE frame, then a JSON frame with
+#              the solution permutations. Replaced atomically (write tmp, fsync, rename).
+#   log      - append-only MOVE_DELTA frames (4-byte length + binary record) since
+#              that snapshot
+#
+# Group commit: appends only queue the frame; one flusher thread writes and fsyncs
+# every room's pending frames once per fsync_ms, so N moves cost one fsync per room
+# per interval instead of N. With fsync_ms=0 an append wakes the flusher, which fsyncs
+# at once (moves arriving during an fsync share the next one), and a negative value
+# never fsyncs (the flusher writes and the OS flushes when it likes). Either way the
+# caller, possibly the asyncio event loop, never blocks on the disk.
+# append() takes an optional callback, run once that frame is fsynced (or written, when
+# fsync is off), in the room's version order; the primary holds a batch's MOVE_ACKs and
+# broadcast until then, so an acked move survives a crash.
+#
+# Every snapshot_every moves a room's snapshot is rewritten and its log truncated.
+# Recovery mmaps the snapshot and the log, replays the deltas newer than the snapshot
+# and cuts off a torn last frame.
+
+SNAPSHOT = 'snapshot'
+LOG = 'log'
+_LEN = struct.Struct('>I')
+
+
+class RoomLog:
+    def __init__(self, path, room):
+        self.path = path
+        self.room = room
+        self.lock = threading.Lock()  # guards pending and since_snapshot
+        self.io_lock = threading.Lock()  # held across a write + fsync (or snapshot), taken before lock
+        self.pending = []  # (version, frame, callback or None) appended but not yet written
+        self.since_snapshot = 0
+        os.makedirs(path, exist_ok=True)
+        self.f = open(os.path.join(path, LOG), 'ab')
+
+    def append(self, delta, callback=None):
+        frame = encode_msg({'type':'MOVE_DELTA','r':delta['r'],'c':delta['c'],'val':delta['val'],
+                            'player':delta['player'],'score_delta':delta['score_delta'],
+                            'version':delta['version']}, BINARY)
+        with self.lock:
+            self.pending.append((delta['version'], frame, callback))
+            self.since_snapshot += 1
+
+    def flush(self, fsync=True):
+        # appends go on queueing while the write and fsync run; callbacks fire after them,
+        # still under io_lock so a room's callbacks run one at a time and in order
+        with self.io_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = []
+            if not pending or self.f.closed:
+                return False
+            self.f.write(b''.join(frame for _, frame, _ in pending))
+            self.f.flush()
+            if fsync:
+                os.fsync(self.f.fileno())
+            _run_callbacks(pending)
+            return True
+
+    def snapshot(self, fsync=True):
+        game = self.room.game
+        with self.io_lock:
+            if self.f.closed:
+                return  # detached while the flusher still held it
+            with self.lock:
+                state = game.as_dict()
+                data = (encode_msg({'type':'STATE_UPDATE','room':self.room.room_id,'state':state}, BINARY)
+                        + encode_msg({'perm': game.perm}, JSON))
+                tmp = os.path.join(self.path, SNAPSHOT + '.tmp')
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp, os.path.join(self.path, SNAPSHOT))
+                # the snapshot covers everything up to its version: start an empty log
+                self.f.close()
+                self.f = open(os.path.join(self.path, LOG), 'wb')
+                covered = [p for p in self.pending if p[0] <= state['version']]
+                self.pending = [p for p in self.pending if p[0] > state['version']]
+                self.since_snapshot = len(self.pending)
+            _run_callbacks(covered)
+
+    def close(self):
+        with self.io_lock:
+            self.f.close()
+
+
+def _run_callbacks(pending):
+    for _, _, callback in pending:
+        if callback is not None:
+            callback()
+
+
+class WriteAheadLog:
+    def __init__(self, data_dir, fsync_ms=10, snapshot_every=1000):
+        self.data_dir = data_dir
+        self.fsync_ms = fsync_ms
+        self.snapshot_every = snapshot_every
+        self.logs = {}  # room_id -> RoomLog
+        self.fsyncs = 0
+        self._stop = threading.Event()
+        self._wake = threading.Event()  # fsync_ms <= 0: set by append, frames are waiting
+        os.makedirs(data_dir, exist_ok=True)
+        threading.Thread(target=self._flusher, daemon=True).start()
+
+    def _room_path(self, room_id):
+        return os.path.join(self.data_dir, quote(room_id, safe=''))
+
+    def attach(self, room):
+        log = self.logs.get(room.room_id)
+        if log is None:
+            log = self.logs[room.room_id] = RoomLog(self._room_path(room.room_id), room)
+            if not os.path.exists(os.path.join(log.path, SNAPSHOT)):
+                # a new room: its log needs a board to replay onto
+                log.snapshot(fsync=self.fsync_ms >= 0)
+        return log
+
+    def append(self, room, delta, callback=None):
+        # callback() once the frame is durable (see the header)
+        log = self.attach(room)
+        log.append(delta, callback)
+        if self.fsync_ms <= 0:
+            # no interval: the flusher writes it right away
+            self._wake.set()
+
+    def detach(self, room_id):
+        # the room left this node: write what it still had queued and close its file.
+        # Its directory stays, so it recovers like any room we held when we stopped.
+        log = self.logs.pop(room_id, None)
+        if log is not None:
+            log.flush(fsync=self.fsync_ms >= 0)
+            log.close()
+
+    def snapshot(self, room):
+        # e.g. after a backup replaced the room's state wholesale
+        self.attach(room).snapshot(fsync=self.fsync_ms >= 0)
+
+    def _flusher(self):
+        if self.fsync_ms > 0:
+            interval = self.fsync_ms / 1000.0
+            while not self._stop.wait(interval):
+                self.flush_all()
+            return
+        while True:
+            self._wake.wait()
+            self._wake.clear()  # before flushing, so an append during the flush wakes us again
+            if self._stop.is_set():
+                return
+            self.flush_all()
+
+    def flush_all(self):
+        for log in list(self.logs.values()):
+            if log.flush(fsync=self.fsync_ms >= 0):
+                self.fsyncs += 1
+            if log.since_snapshot >= self.snapshot_every:
+                log.snapshot(fsync=self.fsync_ms >= 0)
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self.flush_all()
+        for log in list(self.logs.values()):
+            log.close()
+
+    def recover(self):
+        # -> [(room_id, state, perm, deltas)] for every room on disk
+        rooms = []
+        for name in sorted(os.listdir(self.data_dir)):
+            path = os.path.join(self.data_dir, name)
+            if not os.path.isdir(path):
+                continue
+            snap = _read_frames(os.path.join(path, SNAPSHOT))[0]
+            deltas = _read_frames(os.path.join(path, LOG), repair=True)[0]
+            if len(snap) < 2:
+                continue  # never snapshotted: a log alone has no board to apply to
+            rooms.append((unquote(name), snap[0]['state'], snap[1]['perm'], deltas))
+        return rooms
+
+
+def _read_frames(path, repair=False):
+    # decode every complete frame in a length-framed file; with repair, cut off a torn tail
+    try:
+        f = open(path, 'r+b' if repair else 'rb')
+    except FileNotFoundError:
+        return [], 0
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return [], 0
+        msgs = []
+        off = 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while off + _LEN.size <= size:
+                (length,) = _LEN.unpack_from(mm, off)
+                end = off + _LEN.size + length
+                if end > size:
+                    break
+                try:
+                    msgs.append(decode_msg(mm[off + _LEN.size:end]))
+                except (ValueError, struct.error):
+                    break
+                off = end
+        if repair and off < size:
+            f.truncate(off)
+        return msgs, off
+
+
+def replay(game, state, perm, deltas):
+    # rebuild a GameState from recovered snapshot + log; returns deltas applied
+    game.set_state(state, perm)
+    applied = 0
+    for delta in deltas:
+        if delta['version'] <= game.version:
+            continue
+        if not game.apply_delta(delta):
+            break  # gap: nothing after it can be applied
+        applied += 1
+    return applied
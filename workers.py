@@ -0,0 +1,397 @@
+import logging
+import multiprocessing
+import socket
+import struct
+import sys
+import threading
+import zlib
+from utils import FrameReader, encode_msg, send_frame, decode_msg, node_logger
+from rooms import DEFAULT_ROOM
+from server import ServerNode
+
+# Room worker processes (server.py --workers N).
+#
+# One CPython process shares one GIL across every room, so a node can use more cores
+# by splitting its rooms over N worker processes. Rooms go to workers by crc32(room_id).
+#
+#   front process  - the ServerNode that owns the client listener, multicast heartbeats,
+#                    election and the replication links. It reads each new client's HELLO
+#                    and, while it is primary, passes the socket to the room's worker
+#                    (socket.send_fds over a SOCK_SEQPACKET pair) with the bytes read so far:
+#                    a 4-byte length and the first HANDOFF_CHUNK bytes ride with the fd, the
+#                    rest (a client that pipelined a lot behind its HELLO) follows in more
+#                    messages of at most HANDOFF_CHUNK.
+#   worker process - a WorkerNode (a ServerNode without multicast, election or listeners)
+#                    serving those clients, spectators included: move pipeline, move log,
+#                    acks, broadcasts, GET_STATE. Its replication writes go to the front
+#                    instead of to backups.
+#
+# While the workers serve, the front never decodes a move: it forwards each batch's bytes
+# to the backups as they came, so a batch costs it one link read and one queue append.
+# Its own copies of the rooms are only kept current (and logged) while the node is a
+# backup; they seed the workers when it takes over.
+#
+# Worker -> front, over a stream socketpair, framed like any other link:
+#   'R' + _BATCH(version, records, room id length) + room id + frames
+#                 a move batch as it goes to the backups. The front forwards the bytes, and for
+#                 --durability one/quorum answers DURABLE once the backups have acked version.
+#   'S' + frames  a new room's STATE_UPDATE: the front keeps the room (to send its spectators
+#                 to relays, and for a later takeover) and forwards it
+#   'C' + _CATCHUP(node, records, moves, snapshots) + frames
+#                 the worker's rooms brought up to date for one backup (CATCHUP below)
+# Front -> worker:
+#   'R' + frames  STATE_UPDATEs seeding the worker's rooms when the node becomes primary
+#   {'type':'PRIMARY'} / {'type':'DEMOTE'}  start / stop serving (DEMOTE drops its clients,
+#                 which reconnect through the front and get redirected)
+#   {'type':'DURABLE','room','version','ok'}
+#   {'type':'CATCHUP','node','versions','room'}  a backup connected (or asked to resync
+#                 'room'): answer 'C' with what it is missing
+#
+# A backup that connects gets no batches from a worker until that worker's 'C' for it. The
+# worker builds 'C' under its link lock, so batches sent before it are in it and batches
+# sent after it follow it (one the backup already holds is skipped by version).
+#
+# A backup node's workers stay idle. The front holds the replicas, as it does without
+# workers, and seeds the workers from them when it takes over.
+
+HANDOFF_CHUNK = 65536  # bytes per hand-off message (SOCK_SEQPACKET cuts off what does not fit)
+_BATCH = struct.Struct('>QIH')
+_CATCHUP = struct.Struct('>iIII')
+
+
+def worker_index(room_id, count):
+    # stable across processes, unlike hash()
+    return zlib.crc32(room_id.encode('utf-8')) % count
+
+
+class WorkerLink:
+    # one framed stream socket between the front and a worker; sends from any thread
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send_raw(self, *parts, kind=b'R'):
+        with self.lock:
+            self.send_locked(kind, *parts)
+
+    def send_locked(self, kind, *parts):
+        # the caller holds lock: one frame of kind + parts
+        size = 1 + sum(len(part) for part in parts)
+        send_frame(self.sock, b''.join((size.to_bytes(4, 'big'), kind) + parts))
+
+    def send_msg(self, msg):
+        frame = encode_msg(msg)
+        with self.lock:
+            send_frame(self.sock, frame)
+
+    def messages(self):
+        # yields (kind, payload view) for raw frames or ('msg', dict) until the other side goes away
+        reader = FrameReader(self.sock, bufsize=65536, decode=bytes)
+        while True:
+            try:
+                payload = reader.recv()
+            except OSError:
+                return
+            if payload is None:
+                return
+            kind = payload[:1]
+            if kind in (b'R', b'S', b'C'):
+                yield kind, memoryview(payload)[1:]
+            else:
+                yield 'msg', decode_msg(payload)
+
+
+def split_frames(frames):
+    reader = FrameReader(bufsize=len(frames) + 4)
+    reader.feed(frames)
+    return reader.messages()
+
+
+class FrontLink:
+    # stands in for the Replicator inside a worker
+    def __init__(self, link, durability):
+        self.link = link
+        self.durability = durability
+        self.peers = {}  # none here: the front tracks the backups and picks relays
+        self._waiters = {}  # (room, version) -> callback(ok)
+        self._early = {}  # (room, version) -> ok, DURABLE that beat after_durable
+        self._lock = threading.Lock()
+
+    def ship(self, frame, targets=None, records=1):
+        # only a new room's STATE_UPDATE comes this way; move batches go through forward()
+        self.link.send_raw(frame, kind=b'S')
+        return []
+
+    def forward(self, room_id, version, records, frames):
+        room = room_id.encode('utf-8')
+        self.link.send_raw(_BATCH.pack(version, records, len(room)), room, frames)
+
+    def after_durable(self, room_id, version, peers, replicas, callback):
+        if self.durability == 'async':
+            callback(True)
+            return
+        key = (room_id, version)
+        with self._lock:
+            ok = self._early.pop(key, None)
+            if ok is None:
+                self._waiters[key] = callback
+                return
+        callback(ok)
+
+    def durable(self, room_id, version, ok):
+        key = (room_id, version)
+        with self._lock:
+            callback = self._waiters.pop(key, None)
+            if callback is None:
+                self._early[key] = ok
+                return
+        callback(ok)
+
+    def stats(self):
+        return []
+
+
+class WorkerNode(ServerNode):
+    def __init__(self, index, link, handoff, node_id, durability='async', **options):
+        super().__init__(node_id, **options)
+        self.log = node_logger(f"{node_id}.w{index}")
+        self.index = index
+        # no multicast, election or listeners here: the front process does all of that
+        self.mcast_running = False
+        self.mcast_sock.close()
+        self.publisher.close()
+        self.link = WorkerLink(link)
+        self.handoff = handoff
+        self.replicator = FrontLink(self.link, durability)
+        self._serving = threading.Event()  # set between PRIMARY and DEMOTE
+
+    def run(self):
+        threading.Thread(target=self._accept_handoffs, daemon=True).start()
+        for kind, data in self.link.messages():
+            if kind != 'msg':
+                for msg in split_frames(data):
+                    if msg.get('type') == 'STATE_UPDATE':
+                        # seeding while not serving: the room's board comes from the front
+                        self.rooms.get(msg.get('room', DEFAULT_ROOM)).game.set_state(msg['state'], msg.get('perm'))
+                continue
+            mtype = data.get('type')
+            if mtype == 'DURABLE':
+                self.replicator.durable(data['room'], data['version'], data['ok'])
+            elif mtype == 'CATCHUP':
+                self._catch_up_backup(data)
+            elif mtype == 'PRIMARY':
+                self.is_primary = True
+                self._serving.set()
+                self.log.info(f"serving {len(self.rooms)} rooms")
+            elif mtype == 'DEMOTE':
+                self._serving.clear()
+                self.is_primary = False
+                for conn in list(self.clients):
+                    self._drop_client(conn)
+        # the front went away
+        self.stop()
+
+    def _replicate_deltas_to_backups(self, room, deltas):
+        # tagged with the room and its last version, so the front forwards the bytes undecoded
+        self.replicator.forward(room.room_id, deltas[-1]['version'], len(deltas), self._delta_frames(room, deltas))
+        return []
+
+    def _catch_up_backup(self, msg):
+        # built and sent under the link lock: see the header
+        versions = msg.get('versions') or {}
+        only = msg.get('room')
+        counts = {'moves': 0, 'snapshots': 0}
+        with self.link.lock:
+            frames = [frame for room in self.rooms.all() if only is None or room.room_id == only
+                      for frame in self._catch_up(room, versions.get(room.room_id), counts)]
+            self.link.send_locked(b'C', _CATCHUP.pack(msg['node'], len(frames), counts['moves'], counts['snapshots']),
+                                  *frames)
+
+    def _accept_handoffs(self):
+        while True:
+            try:
+                data, fds, _, _ = socket.recv_fds(self.handoff, HANDOFF_CHUNK, 1)
+                if not fds:
+                    return
+                size = int.from_bytes(data[:4], 'big')
+                parts = [data[4:]]
+                got = len(data) - 4
+                while got < size:
+                    chunk = self.handoff.recv(HANDOFF_CHUNK)
+                    if not chunk:
+                        return
+                    parts.append(chunk)
+                    got += len(chunk)
+            except OSError:
+                return
+            sock = socket.socket(fileno=fds[0])
+            data = b''.join(parts)
+            threading.Thread(target=self._adopt, args=(sock, data), daemon=True).start()
+
+    def _adopt(self, sock, data):
+        # a PRIMARY may still be on its way behind the seeds
+        if not self._serving.wait(2.0):
+            sock.close()
+            return
+        self._handle_client(sock, data)
+
+
+def worker_main(index, link, handoff, options, log_level):
+    logging.basicConfig(level=log_level, format='%(message)s', stream=sys.stdout)
+    WorkerNode(index, link, handoff, **options).run()
+
+
+class WorkerPool:
+    # front side: the worker processes and their links
+    def __init__(self, node, count):
+        self.node = node
+        self.count = count
+        self.workers = []  # [(process, WorkerLink, handoff socket)]
+        self.handed_off = 0
+        self.forwarded = 0  # move batches forwarded to the backups
+        self._catching_up = {}  # backup node id -> {worker index: None} whose 'C' it still waits for
+        self._counts = {}  # backup node id -> {'moves','snapshots'} caught up so far
+        self._lock = threading.Lock()
+        self._hand_lock = threading.Lock()
+
+    def start(self, options):
+        # spawn, not fork: the front already runs threads
+        ctx = multiprocessing.get_context('spawn')
+        level = logging.getLogger('puzzle').getEffectiveLevel()
+        for i in range(self.count):
+            front_link, worker_link = socket.socketpair()
+            front_hand, worker_hand = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            proc = ctx.Process(target=worker_main, args=(i, worker_link, worker_hand, options, level), daemon=True)
+            proc.start()
+            worker_link.close()
+            worker_hand.close()
+            link = WorkerLink(front_link)
+            self.workers.append((proc, link, front_hand))
+            threading.Thread(target=self._from_worker, args=(i, link), daemon=True).start()
+
+    def hand_off(self, sock, hello, pending):
+        # pass a client socket to its room's worker; False if that worker is gone
+        _, _, hand = self.workers[worker_index(str(hello.get('room', DEFAULT_ROOM)), self.count)]
+        data = encode_msg(hello) + pending
+        first = HANDOFF_CHUNK - 4
+        try:
+            # one hand-off at a time: its follow-up messages must not interleave with another's
+            with self._hand_lock:
+                socket.send_fds(hand, [len(data).to_bytes(4, 'big') + data[:first]], [sock.fileno()])
+                for off in range(first, len(data), HANDOFF_CHUNK):
+                    hand.send(data[off:off + HANDOFF_CHUNK])
+        except OSError:
+            return False
+        sock.close()
+        self.handed_off += 1
+        return True
+
+    def promote(self):
+        # the node became primary: seed each worker with its rooms, then let it serve
+        node = self.node
+        for room in node.rooms.all():
+            _, link, _ = self.workers[worker_index(room.room_id, self.count)]
+            link.send_raw(encode_msg(node._state_update(room), node.codec))
+        for _, link, _ in self.workers:
+            link.send_msg({'type':'PRIMARY'})
+
+    def demote(self):
+        for _, link, _ in self.workers:
+            try:
+                link.send_msg({'type':'DEMOTE'})
+            except OSError:
+                pass
+
+    def add_backup(self, node_id, sock, versions):
+        # a backup connected: each worker's batches reach it from that worker's catch-up on
+        with self._lock:
+            self._catching_up[node_id] = dict.fromkeys(range(self.count))
+            self._counts[node_id] = {'moves': 0, 'snapshots': 0}
+        peer = self.node.replicator.add_peer(node_id, sock, lambda: ())
+        for _, link, _ in self.workers:
+            link.send_msg({'type':'CATCHUP','node':node_id,'versions':versions})
+        return peer
+
+    def resync(self, node_id, room_id, version):
+        _, link, _ = self.workers[worker_index(room_id, self.count)]
+        link.send_msg({'type':'CATCHUP','node':node_id,'versions':{room_id: version},'room':room_id})
+
+    def _from_worker(self, index, link):
+        node = self.node
+        try:
+            for kind, data in link.messages():
+                if kind == b'R':
+                    self._forward(index, link, data)
+                elif kind == b'S':
+                    self._new_room(index, data)
+                elif kind == b'C':
+                    self._caught_up(index, data)
+        except Exception as e:
+            if not node.stop_event.is_set():
+                node.log.error(f"worker {index} link error: {e}")
+        if not node.stop_event.is_set():
+            node.log.error(f"worker {index} exited")
+
+    def _targets(self, index):
+        # backups worker `index`'s frames go to: None (all) unless one still waits for its catch-up
+        if not self._catching_up:
+            return None
+        with self._lock:
+            return [nid for nid in list(self.node.replicator.peers)
+                    if index not in self._catching_up.get(nid, ())]
+
+    def _forward(self, index, link, data):
+        # a worker's move batch: the bytes go to the backups as they are
+        node = self.node
+        version, records, size = _BATCH.unpack_from(data)
+        start = _BATCH.size + size
+        peers = node.replicator.ship(data[start:], self._targets(index), records)
+        self.forwarded += 1
+        if node.replicator.durability != 'async':
+            room_id = str(data[_BATCH.size:start], 'utf-8')
+            node.replicator.after_durable(
+                room_id, version, peers, node._replica_count(None),
+                lambda ok: link.send_msg({'type':'DURABLE','room':room_id,'version':version,'ok':ok}))
+
+    def _new_room(self, index, frames):
+        # a room a worker made (and logged): kept here, then forwarded
+        node = self.node
+        for msg in split_frames(frames):
+            if msg.get('type') == 'STATE_UPDATE':
+                node.rooms.get(msg.get('room', DEFAULT_ROOM)).game.set_state(msg['state'], msg.get('perm'))
+        node.replicator.ship(frames, self._targets(index))
+
+    def _caught_up(self, index, data):
+        node = self.node
+        node_id, records, moves, snapshots = _CATCHUP.unpack_from(data)
+        if records:
+            node.replicator.ship(data[_CATCHUP.size:], [node_id], records)
+        with self._lock:
+            waiting = self._catching_up.get(node_id)
+            if waiting is None or index not in waiting:
+                return  # the answer to a RESYNC
+            del waiting[index]
+            counts = self._counts[node_id]
+            counts['moves'] += moves
+            counts['snapshots'] += snapshots
+            if waiting:
+                return
+            del self._catching_up[node_id]
+            del self._counts[node_id]
+        node.log.info(f"caught up backup {node_id}: {counts['moves']} moves, {counts['snapshots']} snapshots")
+
+    def stats(self):
+        return {'workers': self.count, 'alive': sum(1 for proc, _, _ in self.workers if proc.is_alive()),
+                'handed_off': self.handed_off, 'forwarded': self.forwarded}
+
+    def stop(self):
+        for proc, link, hand in self.workers:
+            for sock in (link.sock, hand):
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+        for proc, _, _ in self.workers:
+            proc.join(1.0)
+            if proc.is_alive():
+                proc.terminate()